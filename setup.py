@@ -12,6 +12,15 @@ setup(
     author='Simon Bächler',
     author_email='b@chler.com',
     install_requires=['thumbor'],
+    entry_points={
+        'console_scripts': [
+            'universalimages-precompute=universalimages.commands.precompute:main',
+            'universalimages-render=universalimages.commands.render:main',
+            'universalimages-index=universalimages.commands.index:main',
+            'universalimages-loadtest=universalimages.commands.loadtest:main',
+            'universalimages-benchmark=universalimages.commands.benchmark:main',
+        ],
+    },
     description='A Thumbor Filter that interprets the Universal Images Metadata',
     classifiers=[
         # How mature is this project? Common values are
@@ -0,0 +1,74 @@
+# coding: utf-8
+"""
+Measures the peak resident memory of an operation. Unlike tracemalloc, it
+works on Python 2.7 and counts the memory allocated by C extensions such
+as the pixels of PIL images. Requires the /proc filesystem of Linux.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import gc
+import io
+import threading
+
+
+def read_status(field):
+    """
+    :return: A memory field of /proc/self/status in bytes, or None.
+    """
+    try:
+        with io.open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak():
+    """
+    Resets the peak resident memory (VmHWM) of the process.
+    :return: False if the kernel does not allow it.
+    """
+    try:
+        with io.open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss(operation, sample_interval=0.001):
+    """
+    Runs operation and returns its result and the growth of the resident
+    memory of the process at its peak, in bytes. If the peak cannot be
+    reset, the resident memory is sampled every sample_interval seconds.
+    :return: (result, bytes) or (result, None) without /proc.
+    """
+    gc.collect()
+    reset = reset_peak()
+    before = read_status('VmRSS')
+    if before is None:
+        return operation(), None
+    if reset:
+        result = operation()
+        return result, read_status('VmHWM') - before
+
+    samples = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            samples.append(read_status('VmRSS'))
+            done.wait(sample_interval)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    try:
+        result = operation()
+        samples.append(read_status('VmRSS'))
+    finally:
+        done.set()
+        sampler.join()
+    return result, max(samples) - before
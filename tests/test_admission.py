@@ -0,0 +1,71 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import io
+
+from PIL import Image
+from tornado.testing import AsyncTestCase
+
+from universalimages.admission import PixelBudget, image_size, estimate_cost
+
+
+class PixelBudgetTestCase(AsyncTestCase):
+
+    def test_budget(self):
+        budget = PixelBudget(100)
+        first = budget.acquire(60)
+        second = budget.acquire(60)
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertEqual(len(budget), 1)
+
+        budget.release(first.result())
+        self.assertTrue(second.done())
+        self.assertEqual(budget.used, 60)
+
+    def test_oversized_request_runs_alone(self):
+        budget = PixelBudget(100)
+        first = budget.acquire(500)
+        self.assertTrue(first.done())
+        second = budget.acquire(1)
+        self.assertFalse(second.done())
+        budget.release(500)
+        self.assertTrue(second.done())
+
+    def test_small_outputs_first(self):
+        budget = PixelBudget(100)
+        running = budget.acquire(100)
+        large = budget.acquire(50, priority=1000)
+        small = budget.acquire(50, priority=10)
+        other = budget.acquire(60, priority=10)
+        budget.release(running.result())
+        self.assertTrue(small.done())
+        self.assertFalse(other.done())
+        # The queue is ordered, the large output is not admitted before the others.
+        self.assertFalse(large.done())
+        budget.release(small.result())
+        self.assertTrue(other.done())
+        self.assertFalse(large.done())
+
+    def test_cancel(self):
+        budget = PixelBudget(100)
+        running = budget.acquire(100)
+        waiting = budget.acquire(50)
+        budget.cancel(waiting)
+        self.assertEqual(len(budget), 0)
+        budget.release(running.result())
+        self.assertEqual(budget.used, 0)
+
+        admitted = budget.acquire(50)
+        budget.cancel(admitted)
+        self.assertEqual(budget.used, 0)
+
+    def test_estimate(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 900)).save(buffer, 'JPEG')
+        size = image_size(buffer.getvalue())
+        self.assertEqual(size, (1200, 900))
+        self.assertEqual(estimate_cost(size, (320, 240)), 1200 * 900 + 320 * 240)
+        self.assertEqual(estimate_cost(size, (320, 240), (640, 480)),
+                         1200 * 900 + 320 * 240 + 640 * 480)
+        self.assertIsNone(image_size(b'not an image'))
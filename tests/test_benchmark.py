@@ -0,0 +1,72 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from universalimages.commands.benchmark import (
+    median, mad, measure, fingerprint, compare, read_result, write_result, main)
+
+
+def result(key='abc', **benchmarks):
+    return {
+        'fingerprint': key,
+        'benchmarks': dict((name, {'median': values[0], 'mad': values[1]})
+                           for name, values in benchmarks.items()),
+    }
+
+
+class BenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_statistics(self):
+        self.assertEqual(median([3, 1, 2]), 2)
+        self.assertEqual(median([4, 1, 2, 3]), 2.5)
+        self.assertEqual(mad([1, 2, 3, 4, 100]), 1)
+
+    def test_measure(self):
+        samples = measure(lambda: None, rounds=3, min_time=0.01)
+        self.assertEqual(len(samples), 3)
+        self.assertTrue(all(sample >= 0 for sample in samples))
+
+    def test_fingerprint(self):
+        key, description = fingerprint()
+        self.assertEqual(key, fingerprint()[0])
+        self.assertEqual(len(key), 12)
+        self.assertIn('python', description)
+
+    def test_compare(self):
+        baseline = result(a=(1.0, 0.01), b=(1.0, 0.01), c=(1.0, 0.01), d=(1.0, 0.2),
+                          gone=(1.0, 0.01))
+        current = result(a=(1.2, 0.01), b=(0.8, 0.01), c=(1.03, 0.01), d=(1.2, 0.2),
+                         added=(1.0, 0.01))
+        statuses = dict((row[0], row[4]) for row in compare(baseline, current))
+        self.assertEqual(statuses, {
+            'a': 'slower', 'b': 'faster', 'c': 'same',
+            'd': 'same',  # Within the noise
+            'gone': 'missing', 'added': 'new',
+        })
+
+    def test_result_directory(self):
+        data = result('0123456789ab', a=(1.0, 0.01))
+        path = write_result(self.path, data)
+        self.assertEqual(path, os.path.join(self.path, '0123456789ab.json'))
+        self.assertEqual(read_result(self.path, '0123456789ab'), data)
+
+    def test_compare_command(self):
+        write_result(self.path, result(a=(1.0, 0.01)))
+        current = os.path.join(self.path, 'current.json')
+        with open(current, 'w') as f:
+            json.dump(result(a=(1.01, 0.01)), f)
+        self.assertEqual(main(['compare', self.path, current]), 0)
+        with open(current, 'w') as f:
+            json.dump(result(a=(1.5, 0.01)), f)
+        self.assertEqual(main(['compare', self.path, current]), 1)
@@ -0,0 +1,100 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import threading
+import time
+
+import tornado.gen as gen
+from concurrent.futures import ThreadPoolExecutor
+from tornado.testing import AsyncTestCase, gen_test
+
+from universalimages.budget import (
+    MetadataTask, get_deferred_plan, set_deferred_plan, read_deferred_entry, load_deferred_plan)
+from universalimages.plan import CropPlan
+
+
+class Config(object):
+    UNIVERSALIMAGES_CACHE_BACKEND = None
+    UNIVERSALIMAGES_CACHE_SIZE = 100
+
+
+class MetadataTaskTestCase(AsyncTestCase):
+
+    def setUp(self):
+        super(MetadataTaskTestCase, self).setUp()
+        self.executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.executor.shutdown)
+
+    @gen_test
+    def test_metadata_task(self):
+        task = MetadataTask(self.executor.submit(lambda: 'metadata'), 1000)
+        metadata = yield task.wait()
+        self.assertEqual(metadata, 'metadata')
+
+    @gen_test
+    def test_budget_exceeded(self):
+        event = threading.Event()
+        self.addCleanup(event.set)
+        task = MetadataTask(self.executor.submit(event.wait), 10)
+        # The IOLoop is not blocked while the task waits.
+        ticks = []
+        self.io_loop.add_callback(ticks.append, 1)
+        with self.assertRaises(gen.TimeoutError):
+            yield task.wait()
+        self.assertEqual(ticks, [1])
+        # The metadata is still read.
+        event.set()
+        self.assertTrue(task.future.result(timeout=1))
+
+    def test_planning_time(self):
+        self.addCleanup(setattr, MetadataTask, 'planning_time', MetadataTask.planning_time)
+        MetadataTask.planning_time = 0.0
+        task = MetadataTask(self.executor.submit(lambda: 'metadata'), 1000)
+        self.assertFalse(task.planned(0.5))
+        # The wait leaves room for the planning.
+        self.assertEqual(MetadataTask.planning_time, 0.1)
+        self.assertLessEqual(task.remaining(), 0.9)
+        task.deadline = time.time() - 1
+        self.assertTrue(task.planned(0.5))
+        self.assertEqual(task.remaining(), 0)
+
+
+class BudgetTestCase(AsyncTestCase):
+
+    def test_deferred_plan(self):
+        rmd_plan = CropPlan((95, 231, 952, 797), True, False, 360, 238)
+        set_deferred_plan(Config, '/unsafe/360x0/filters:rmd()/a.jpg', 'abc',
+                          rmd_plan, (500.5, 400))
+        entry = get_deferred_plan(Config, '/unsafe/360x0/filters:rmd()/a.jpg', 'abc')
+        self.assertEqual(entry['plan'], rmd_plan)
+        self.assertEqual(entry['focal_point'], [500.5, 400])
+        # The source has changed
+        self.assertIsNone(get_deferred_plan(Config, '/unsafe/360x0/filters:rmd()/a.jpg', 'def'))
+
+        set_deferred_plan(Config, '/unsafe/360x0/filters:rmd()/b.jpg', 'abc', None)
+        self.assertIsNone(get_deferred_plan(Config, '/unsafe/360x0/filters:rmd()/b.jpg', 'abc')['plan'])
+
+    @gen_test
+    def test_read_deferred_entry(self):
+        class BudgetConfig(Config):
+            UNIVERSALIMAGES_RMD_BUDGET = 1000
+            UNIVERSALIMAGES_RMD_WORKERS = 1
+
+        class Request(object):
+            url = '/unsafe/360x0/filters:rmd()/c.jpg'
+            filters = 'rmd()'
+
+        class Context(object):
+            config = BudgetConfig
+            request = Request()
+
+        rmd_plan = CropPlan((95, 231, 952, 797), True, False, 360, 238)
+        set_deferred_plan(Config, Request.url, 'abc', rmd_plan)
+        yield read_deferred_entry(Context)
+        self.assertEqual(load_deferred_plan(Context.request.rmd_deferred, 'abc')['plan'], rmd_plan)
+        self.assertIsNone(load_deferred_plan(Context.request.rmd_deferred, 'def'))
+        # Without a budget, the engine looks the plan up itself.
+        Context.config = Config
+        Context.request = Request()
+        yield read_deferred_entry(Context)
+        self.assertFalse(hasattr(Context.request, 'rmd_deferred'))
@@ -0,0 +1,238 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from os.path import join
+from unittest import TestCase
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.testing import AsyncTestCase, gen_test
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from universalimages.caches import memory, sqlite, redis, get_backend
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for a Redis server. Speaks the part of the protocol
+    the cache backend uses.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RedisHandler)
+        self.data = {}
+        self.commands = []
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            name = command[0].upper()
+            self.server.commands.append(name)
+            if name == b'SET':
+                expires = time.time() + int(command[4]) if len(command) > 4 else None
+                data[command[1]] = (command[2], expires)
+                reply = b'+OK\r\n'
+            elif name == b'MGET':
+                reply = [b'*%d\r\n' % (len(command) - 1)]
+                for key in command[1:]:
+                    value, expires = data.get(key, (None, None))
+                    if value is None or (expires and expires < time.time()):
+                        reply.append(b'$-1\r\n')
+                    else:
+                        reply.append(b'$%d\r\n%s\r\n' % (len(value), value))
+                reply = b''.join(reply)
+            elif name == b'DEL':
+                reply = b':%d\r\n' % int(data.pop(command[1], None) is not None)
+            else:
+                reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+class CacheContract(object):
+
+    def test_get_set_delete(self):
+        cache = self.create_cache('documents')
+        self.assertIsNone(cache.get('a.jpg'))
+        document = {'source': 'abc', 'rmd': 'def', 'time': 1.5}
+        cache.set('a.jpg', document)
+        self.assertEqual(cache.get('a.jpg'), document)
+        cache.set('a.jpg', 'rmd/1')
+        self.assertEqual(cache.get('a.jpg'), 'rmd/1')
+        cache.delete('a.jpg')
+        self.assertIsNone(cache.get('a.jpg'))
+
+    def test_bulk(self):
+        cache = self.create_cache('plans')
+        cache.set_many({'a': [1, 2, 3], 'b': 'rmd/2'})
+        self.assertEqual(cache.get_many(['b', 'missing', 'a']),
+                         ['rmd/2', None, [1, 2, 3]])
+        self.assertEqual(cache.get_many([]), [])
+
+    def test_names_are_separated(self):
+        aliases = self.create_cache('aliases')
+        plans = self.create_cache('plans')
+        aliases.set('a', 'rmd/1')
+        self.assertIsNone(plans.get('a'))
+
+
+class MemoryCacheTestCase(CacheContract, TestCase):
+
+    def create_cache(self, name):
+        return memory.Cache(100)
+
+
+class SqliteCacheTestCase(CacheContract, TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create_cache(self, name, ttl=60):
+        return sqlite.Cache(name, join(self.root, 'cache.sqlite'), ttl)
+
+    def test_shared_and_wal(self):
+        first = self.create_cache('aliases')
+        second = self.create_cache('aliases')
+        first.set('a', 'rmd/1')
+        self.assertEqual(second.get('a'), 'rmd/1')
+        mode = first.connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode.lower(), 'wal')
+
+    def test_threads(self):
+        cache = self.create_cache('aliases')
+        results = []
+        thread = threading.Thread(target=lambda: results.append(cache.get('a')))
+        cache.set('a', 'rmd/1')
+        thread.start()
+        thread.join()
+        self.assertEqual(results, ['rmd/1'])
+
+    def test_expiry(self):
+        cache = self.create_cache('aliases', ttl=-1)
+        cache.set('a', 'rmd/1')
+        self.assertIsNone(cache.get('a'))
+        cache.purge()
+        count = cache.connection.execute(
+            'SELECT COUNT(*) FROM universalimages_cache').fetchone()[0]
+        self.assertEqual(count, 0)
+
+
+class RedisCacheTestCase(CacheContract, TestCase):
+
+    def setUp(self):
+        self.server = RedisStandIn()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_cache(self, name, ttl=60):
+        port = self.server.server_address[1]
+        return redis.Cache(name, redis.Connection('127.0.0.1', port, timeout=1), ttl)
+
+    def test_pipelining(self):
+        cache = self.create_cache('plans')
+        cache.set_many(dict(('key%d' % i, i) for i in range(10)))
+        self.assertEqual(cache.get_many(['key%d' % i for i in range(10)]), list(range(10)))
+        self.assertEqual(self.server.commands, [b'SET'] * 10 + [b'MGET'])
+        self.assertIn(b'universalimages:plans:key3', self.server.data)
+
+    def test_unavailable_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        cache = redis.Cache('plans', redis.Connection('127.0.0.1', port, timeout=1))
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['a', 'b']), [None, None])
+
+    def test_reconnect(self):
+        cache = self.create_cache('plans')
+        cache.set('a', 1)
+        # The connection breaks.
+        cache.connection._file.close()
+        cache.connection._socket.close()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class Config(object):
+    UNIVERSALIMAGES_CACHE_BACKEND = 'universalimages.caches.redis'
+    UNIVERSALIMAGES_CACHE_BACKENDS = {'aliases': 'universalimages.caches.memory'}
+
+
+class AsyncCacheTestCase(AsyncTestCase):
+
+    def setUp(self):
+        super(AsyncCacheTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.executor = ThreadPoolExecutor(1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.root)
+        super(AsyncCacheTestCase, self).tearDown()
+
+    def test_backend_per_cache(self):
+        self.assertEqual(get_backend('aliases', Config), 'universalimages.caches.memory')
+        self.assertEqual(get_backend('plans', Config), 'universalimages.caches.redis')
+        self.assertEqual(get_backend('plans', None), 'universalimages.caches.memory')
+
+    @gen_test
+    def test_blocking_backend_runs_on_the_executor(self):
+        cache = sqlite.Cache('aliases', join(self.root, 'cache.sqlite'))
+        self.assertTrue(cache.blocking)
+        cache.executor = self.executor
+        threads = []
+        get = cache.get
+
+        def record(key):
+            threads.append(threading.current_thread())
+            return get(key)
+
+        cache.get = record
+        yield cache.set_async('a', 'rmd/1')
+        value = yield cache.get_async('a')
+        self.assertEqual(value, 'rmd/1')
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+    @gen_test
+    def test_memory_backend_runs_inline(self):
+        cache = memory.Cache(10)
+        self.assertFalse(cache.blocking)
+        future = cache.set_async('a', 'rmd/1')
+        self.assertTrue(future.done())
+        value = yield cache.get_async('a')
+        self.assertEqual(value, 'rmd/1')
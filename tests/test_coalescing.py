@@ -0,0 +1,81 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import tornado.gen as gen
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages.coalescing import SingleFlight, FlightError
+
+
+class RenderHandler(tornado.web.RequestHandler):
+    """
+    Minimal handler which coalesces requests the same way as the
+    universal images imaging handler.
+    """
+
+    def initialize(self, flights, renders):
+        self.flights = flights
+        self.renders = renders
+
+    @gen.coroutine
+    def get(self, key):
+        if self.flights.lead(key):
+            self.renders.append(key)
+            yield gen.sleep(0.05)
+            if key == 'broken':
+                self.flights.reject(key, FlightError(500))
+                self.set_status(500)
+                return
+            body = ('rendered %s' % key).encode('utf-8')
+            self.flights.resolve(key, body)
+        else:
+            try:
+                body = yield self.flights.wait(key, timeout=1)
+            except FlightError as e:
+                self.set_status(e.status)
+                return
+        self.write(body)
+
+
+class CoalescingTestCase(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.flights = SingleFlight()
+        self.renders = []
+        return tornado.web.Application([
+            (r'/(.*)', RenderHandler,
+             {'flights': self.flights, 'renders': self.renders}),
+        ])
+
+    @gen_test
+    def test_concurrent_requests_render_once(self):
+        responses = yield [self.http_client.fetch(self.get_url('/image'))
+                           for _ in range(10)]
+        self.assertEqual(self.renders, ['image'])
+        self.assertEqual(set(r.body for r in responses), {b'rendered image'})
+        self.assertEqual(len(self.flights), 0)
+
+    @gen_test
+    def test_different_keys_render_separately(self):
+        yield [self.http_client.fetch(self.get_url('/a')),
+               self.http_client.fetch(self.get_url('/b'))]
+        self.assertEqual(sorted(self.renders), ['a', 'b'])
+
+    @gen_test
+    def test_errors_are_propagated(self):
+        responses = yield [self.http_client.fetch(self.get_url('/broken'),
+                                                  raise_error=False)
+                           for _ in range(3)]
+        self.assertEqual(self.renders, ['broken'])
+        self.assertEqual([r.code for r in responses], [500, 500, 500])
+
+    @gen_test
+    def test_timeout(self):
+        flights = SingleFlight()
+        self.assertTrue(flights.lead('slow'))
+        self.assertFalse(flights.lead('slow'))
+        with self.assertRaises(gen.TimeoutError):
+            yield flights.wait('slow', timeout=0.01)
+        flights.resolve('slow', b'done')
+        self.assertNotIn('slow', flights)
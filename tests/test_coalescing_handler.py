@@ -0,0 +1,67 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from os.path import abspath, join, dirname
+
+from thumbor.config import Config
+from thumbor.context import Context, ServerParameters
+from thumbor.importer import Importer
+from thumbor.transformer import Transformer
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages import caches
+from universalimages.app import App
+from universalimages.handlers.imaging import ImagingHandler
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class CoalescingHandlerTestCase(AsyncHTTPTestCase):
+    """
+    Sends concurrent identical requests to the universal images app.
+    """
+
+    def setUp(self):
+        self.addCleanup(caches._caches.clear)
+        caches._caches.clear()
+
+        # Counts the transforms and keeps the leader in flight for a while,
+        # so the other requests arrive while it renders.
+        self.transforms = []
+        original = Transformer.transform
+
+        def transform(transformer, callback):
+            self.transforms.append(transformer.context.request.url)
+            IOLoop.current().call_later(0.2, original, transformer, callback)
+
+        Transformer.transform = transform
+        self.addCleanup(setattr, Transformer, 'transform', original)
+        super(CoalescingHandlerTestCase, self).setUp()
+
+    def get_app(self):
+        config = Config(
+            SECURITY_KEY='ACME-SEC',
+            LOADER='thumbor.loaders.file_loader',
+            FILE_LOADER_ROOT_PATH=STORAGE_PATH,
+            STORAGE='thumbor.storages.no_storage',
+            ENGINE='universalimages.engines.pil',
+            FILTERS=['universalimages.filters.rmd'],
+            UNIVERSALIMAGES_BUILTIN_XMP_READER=True,
+            UNIVERSALIMAGES_COALESCING=True)
+        importer = Importer(config)
+        importer.import_modules()
+        server = ServerParameters(8889, 'localhost', 'thumbor.conf', None, 'info', None)
+        server.security_key = 'ACME-SEC'
+        return App(Context(server, config, importer))
+
+    @gen_test(timeout=30)
+    def test_concurrent_requests_transform_once(self):
+        url = self.get_url('/unsafe/320x0/filters:rmd()/monks-regions.jpg')
+        responses = yield [self.http_client.fetch(url) for _ in range(5)]
+        self.assertEqual([response.code for response in responses], [200] * 5)
+        self.assertEqual(self.transforms, ['/unsafe/320x0/filters:rmd()/monks-regions.jpg'])
+        self.assertEqual(len(set(response.body for response in responses)), 1)
+        self.assertEqual(set(response.headers['Content-Type'] for response in responses),
+                         {'image/jpeg'})
+        self.assertEqual(len(ImagingHandler.flights), 0)
@@ -0,0 +1,67 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import json
+from unittest import TestCase
+
+from universalimages.compiler import (
+    CropFunction, Segment, SHOULD_CROP, FIT_IN, SNAP, CLAMP, LINEAR)
+
+SIZE = (1200, 900)
+SAFE_AREA = (400.0, 300.0, 800.0, 600.0)
+
+
+class CropFunctionTestCase(TestCase):
+
+    def setUp(self):
+        self.function = CropFunction(SIZE, [1, 321, 800], [
+            Segment(SAFE_AREA, SHOULD_CROP, ()),
+            Segment((600.0, 450.0, 2.0, 2.0, 1.0, 0.0, 0.0),
+                    LINEAR | SHOULD_CROP | SNAP | CLAMP, ()),
+            Segment((100.0, 50.0, 1100.0, 850.0), SHOULD_CROP | FIT_IN,
+                    ((None, 1.0, (0.0, 0.0, 1200.0, 800.0)),)),
+        ], SAFE_AREA)
+
+    def test_segments(self):
+        self.assertEqual(len(self.function), 3)
+        result = self.function.evaluate(320)
+        self.assertEqual(result.crop, SAFE_AREA)
+        self.assertTrue(result.should_crop)
+        self.assertFalse(result.snap)
+
+        # Width 400 and height 300 around the pivot point.
+        result = self.function.evaluate(400)
+        self.assertEqual(result.crop, (400.0, 300.0, 800.0, 600.0))
+        self.assertTrue(result.snap)
+        # Wider than the safe area
+        self.assertEqual(self.function.evaluate(600).crop, (300.0, 225.0, 900.0, 675.0))
+
+    def test_safe_area_stays_inside(self):
+        function = CropFunction(SIZE, [1], [
+            Segment((500.0, 450.0, 2.0, 2.0, 1.0, 0.0, 0.0), LINEAR | SHOULD_CROP | CLAMP, ()),
+        ], SAFE_AREA)
+        left, top, right, bottom = function.evaluate(500).crop
+        self.assertEqual((left, right), (300.0, 800.0))
+
+    def test_recommended_frames(self):
+        # The target aspect of a width-only request is the source aspect.
+        # Like the filter, frames with a MaxAspectRatio above it are skipped.
+        result = self.function.evaluate(1000)
+        self.assertEqual(result.crop, (0.0, 0.0, 1200.0, 800.0))
+        self.assertFalse(result.fit_in)
+
+        self.function.segments[2] = Segment(
+            (100.0, 50.0, 1100.0, 850.0), SHOULD_CROP | FIT_IN,
+            ((None, 1.5, (0.0, 0.0, 1200.0, 800.0)),))
+        result = self.function.evaluate(1000)
+        self.assertEqual(result.crop, (100.0, 50.0, 1100.0, 850.0))
+        self.assertTrue(result.fit_in)
+
+    def test_serialization(self):
+        function = CropFunction.load(json.loads(json.dumps(self.function.dump())))
+        for width in (1, 100, 320, 321, 500, 799, 800, 2000):
+            self.assertEqual(function.evaluate(width), self.function.evaluate(width))
+        self.assertIsNone(CropFunction.load(None))
+
+    def test_invalid_widths(self):
+        self.assertIsNone(self.function.evaluate(0))
@@ -0,0 +1,105 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import zipfile
+from io import BytesIO
+from os.path import abspath, join, dirname
+
+from thumbor.config import Config
+from thumbor.context import Context, ServerParameters
+from thumbor.importer import Importer
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages import caches
+from universalimages.app import App
+from universalimages.engines.pil import Engine
+from universalimages.ladder import create_context, load_master, render
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class LadderHandlerTestCase(AsyncHTTPTestCase):
+    """
+    Requests a ladder from the universal images app with an RMD budget.
+    """
+
+    ladder = [(320, 0), (400, 400), (240, 160)]
+
+    def setUp(self):
+        self.addCleanup(caches._caches.clear)
+        caches._caches.clear()
+
+        self.tasks = []
+        original = Engine.start_metadata_task
+
+        def start_metadata_task(engine, buffer, extension):
+            started = original(engine, buffer, extension)
+            self.tasks.append(engine.metadata_task)
+            return started
+
+        Engine.start_metadata_task = start_metadata_task
+        self.addCleanup(setattr, Engine, 'start_metadata_task', original)
+        super(LadderHandlerTestCase, self).setUp()
+
+    def get_config(self, **kw):
+        return Config(
+            SECURITY_KEY='ACME-SEC',
+            LOADER='thumbor.loaders.file_loader',
+            FILE_LOADER_ROOT_PATH=STORAGE_PATH,
+            STORAGE='thumbor.storages.no_storage',
+            ENGINE='universalimages.engines.pil',
+            FILTERS=['universalimages.filters.rmd'],
+            UNIVERSALIMAGES_BUILTIN_XMP_READER=True,
+            **kw)
+
+    def get_app(self):
+        config = self.get_config(UNIVERSALIMAGES_RMD_BUDGET=1000, AUTO_WEBP=True,
+                                 QUALITY=70, WEBP_QUALITY=60)
+        importer = Importer(config)
+        importer.import_modules()
+        server = ServerParameters(8889, 'localhost', 'thumbor.conf', None, 'info', None)
+        server.security_key = 'ACME-SEC'
+        return App(Context(server, config, importer))
+
+    def render_offline(self, width, height):
+        config = self.get_config(QUALITY=70)
+        importer = Importer(config)
+        importer.import_modules()
+        with open(join(STORAGE_PATH, 'monks-regions.jpg'), 'rb') as f:
+            master = load_master(create_context(config, importer, 'monks-regions.jpg', 0, 0),
+                                 f.read())
+        return render(master, create_context(config, importer, 'monks-regions.jpg',
+                                             width, height))
+
+    @gen_test(timeout=30)
+    def test_ladder_with_budget(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/ladder/unsafe/320,400x400,240x160/monks-regions.jpg?format=zip'))
+        self.assertEqual(response.code, 200)
+        # The metadata was read in a worker thread and waited for.
+        self.assertEqual(len(self.tasks), 1)
+        self.assertIsNotNone(self.tasks[0])
+        self.assertTrue(self.tasks[0].future.done())
+
+        archive = zipfile.ZipFile(BytesIO(response.body))
+        for width, height in self.ladder:
+            self.assertEqual(archive.read('%sx%s.jpg' % (width, height)),
+                             self.render_offline(width, height))
+
+    @gen_test(timeout=30)
+    def test_same_bytes_as_the_imaging_handler(self):
+        # A ladder with one size renders from the master, like the imaging handler.
+        for accept in ('image/jpeg', 'image/webp,image/*'):
+            for width, height in self.ladder:
+                size = '%sx%s' % (width, height)
+                expected = yield self.http_client.fetch(
+                    self.get_url('/unsafe/%s/filters:rmd()/monks-regions.jpg' % size),
+                    headers={'Accept': accept})
+                response = yield self.http_client.fetch(
+                    self.get_url('/ladder/unsafe/%s/monks-regions.jpg?format=zip' % size),
+                    headers={'Accept': accept})
+                self.assertEqual(response.headers['Vary'], 'Accept')
+                archive = zipfile.ZipFile(BytesIO(response.body))
+                name = archive.namelist()[0]
+                self.assertEqual(name.endswith('.webp'), 'webp' in accept)
+                self.assertEqual(archive.read(name), expected.body)
@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from collections import Counter
+from unittest import TestCase
+
+from universalimages.commands.loadtest import (
+    read_log, zipf_workload, percentile, hit_ratios, report)
+
+
+class LoadTestTestCase(TestCase):
+
+    def test_read_log(self):
+        lines = [
+            '127.0.0.1 - - [19/Oct/2016:10:00:00 +0000] '
+            '"GET /unsafe/320x0/filters:rmd()/a.jpg HTTP/1.1" 200 1234',
+            '/unsafe/640x0/filters:rmd()/b.jpg',
+            '',
+            'garbage',
+        ]
+        self.assertEqual(list(read_log(lines)), [
+            '/unsafe/320x0/filters:rmd()/a.jpg', '/unsafe/640x0/filters:rmd()/b.jpg'])
+
+    def test_zipf_workload(self):
+        sources = ['%d.jpg' % i for i in range(20)]
+        urls = list(zipf_workload(sources, [(320, 0), (640, 0)], 2000))
+        self.assertEqual(len(urls), 2000)
+        self.assertEqual(urls, list(zipf_workload(sources, [(320, 0), (640, 0)], 2000)))
+        self.assertTrue(all(url.startswith('/unsafe/') and '/filters:rmd()/' in url
+                            for url in urls))
+        counts = Counter(url.rsplit('/', 1)[1] for url in urls).most_common()
+        # The most popular source is requested about twice as often as the second one.
+        self.assertGreater(counts[0][1], 1.5 * counts[1][1])
+        self.assertGreater(counts[0][1], 10 * counts[-1][1])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_report(self):
+        counters = {'result_storage.hit': 30, 'result_storage.miss': 10,
+                    'universalimages.region.hit': 5}
+        summary = report({'latencies': [0.01] * 90 + [0.5] * 10, 'statuses': {200: 100},
+                          'elapsed': 2.0, 'rss': [(0, 50000000), (1, 80000000)]},
+                         {'counters': counters})
+        self.assertEqual(summary['throughput'], 50)
+        self.assertEqual(summary['latency'], {'p50': 0.01, 'p95': 0.5, 'p99': 0.5})
+        self.assertEqual(summary['max_rss'], 80000000)
+        self.assertEqual(summary['hit_ratios']['result_storage'], 0.75)
+        self.assertEqual(summary['hit_ratios']['region'], 0.05)
+        self.assertIsNone(summary['hit_ratios']['storage'])
+        self.assertEqual(hit_ratios({}, 0)['region'], None)
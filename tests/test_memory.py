@@ -0,0 +1,122 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import os
+import struct
+from io import BytesIO
+from os.path import abspath, join, dirname
+
+import numpy as np
+from PIL import Image
+
+from .base import FilterTestCase
+from .rss import peak_rss
+from universalimages.engines.pil import Engine
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+MIB = 1024 * 1024
+
+# Memory ceilings per stage in MiB: the growth of the resident memory at the
+# peak of the stage. PIL keeps RGB images with 4 bytes per pixel, the decoded
+# master uses 103 MiB. Override them with
+# e.g. UNIVERSALIMAGES_MEMORY_CEILINGS=decode=120,crop=40
+CEILINGS = {
+    'metadata': 4,
+    'decode': 110,
+    'crop': 40,
+    'resize': 8,
+}
+
+
+def get_ceilings():
+    ceilings = dict(CEILINGS)
+    for item in os.environ.get('UNIVERSALIMAGES_MEMORY_CEILINGS', '').split(','):
+        if item:
+            stage, value = item.split('=')
+            ceilings[stage.strip()] = float(value)
+    return ceilings
+
+
+def large_master(width, height):
+    """
+    A JPEG image of the given size with the RMD of monks.xml.
+    """
+    x = (np.arange(width) * 255 // width).astype(np.uint8)
+    y = (np.arange(height) * 255 // height).astype(np.uint8)
+    pixels = np.empty((height, width, 3), np.uint8)
+    pixels[..., 0] = x
+    pixels[..., 1] = y[:, np.newaxis]
+    pixels[..., 2] = x[::-1]
+    image = Image.fromarray(pixels)
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    buffer = buffer.getvalue()
+
+    with open(join(STORAGE_PATH, 'monks.xml'), 'rb') as f:
+        packet = f.read()
+    packet = packet.replace(b'<stDim:w>2816<', ('<stDim:w>%d<' % width).encode('ascii'))
+    packet = packet.replace(b'<stDim:h>2112<', ('<stDim:h>%d<' % height).encode('ascii'))
+    app1 = b'http://ns.adobe.com/xap/1.0/\x00' + packet
+    return buffer[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + buffer[2:]
+
+
+class MemoryBudgetTestCase(FilterTestCase):
+    """
+    Runs the get_filtered flow on a large master and records the memory
+    of each stage.
+    """
+
+    size = 6000, 4500
+
+    @classmethod
+    def setUpClass(cls):
+        cls.buffer = large_master(*cls.size)
+
+    def measure(self, stage, operation):
+        result, peak = peak_rss(operation)
+        if peak is None:
+            self.skipTest('The resident memory cannot be measured.')
+        self.usage[stage] = peak / float(MIB)
+        return result
+
+    def test_stage_ceilings(self):
+        def config_context(context):
+            context.request.width = 360
+            context.config.UNIVERSALIMAGES_BUILTIN_XMP_READER = True
+            context.modules.engine = context.request.engine = Engine(context)
+
+        self.usage = {}
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=config_context)
+        engine = fltr.engine
+        transformer = fltr.context.transformer
+
+        metadata = self.measure(
+            'metadata', lambda: engine.read_metadata(self.buffer, '.jpg'))
+        self.assertTrue(metadata.xmp_keys)
+
+        def decode():
+            engine.load(self.buffer, '.jpg')
+            # PIL decodes the pixels on first access.
+            engine.image.load()
+
+        self.measure('decode', decode)
+        self.assertEqual(engine.size, self.size)
+
+        def crop():
+            fltr.run()
+            transformer.manual_crop()
+
+        self.measure('crop', crop)
+        self.assertTrue(fltr.context.request.should_crop)
+
+        # The crop is applied already.
+        transformer.manual_crop = lambda: None
+        self.measure('resize', transformer.img_operation_worker)
+        self.assertEqual(engine.size[0], 360)
+
+        for stage, ceiling in sorted(get_ceilings().items()):
+            self.assertLessEqual(
+                self.usage[stage], ceiling,
+                '%s uses %.1f MiB, the ceiling is %.1f MiB' % (stage, self.usage[stage], ceiling))
@@ -0,0 +1,93 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from unittest import TestCase
+
+from universalimages.caches.memory import Cache
+from universalimages.plan import (
+    CropPlan, final_dimensions, canonical_key, output_options, etag,
+    etag_matches)
+
+
+class Request(object):
+    width = 0
+    height = 0
+    fit_in = False
+    filters = 'rmd()'
+    format = None
+    quality = None
+    horizontal_flip = vertical_flip = False
+    halign = 'center'
+    valign = 'middle'
+    smart = False
+    trim = None
+    full = adaptive = meta = debug = False
+    accepts_webp = False
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class CropPlanTestCase(TestCase):
+
+    def test_final_dimensions(self):
+        crop = (95, 231, 952, 797)
+        self.assertEqual(final_dimensions(crop, 0, 0), (857, 566))
+        self.assertEqual(final_dimensions(crop, 'orig', 0), (857, 566))
+        self.assertEqual(final_dimensions(crop, 'orig', 'orig'), (857, 566))
+        self.assertEqual(final_dimensions(crop, 360, 0), (360, 238))
+        self.assertEqual(final_dimensions(crop, 360, 200), (360, 200))
+        self.assertEqual(final_dimensions(crop, 0, 238), (360, 238))
+
+    def test_final_dimensions_fit_in(self):
+        crop = (0, 0, 1200, 900)
+        self.assertEqual(final_dimensions(crop, 400, 400, True), (400, 300))
+        self.assertEqual(final_dimensions(crop, 2000, 2000, True), (1200, 900))
+
+    def test_equivalent_requests_share_a_key(self):
+        crop = (95, 231, 952, 797)
+        plan1 = CropPlan(crop, True, False, *final_dimensions(crop, 'orig', 0))
+        plan2 = CropPlan(crop, True, False, *final_dimensions(crop, 857, 566))
+        options = output_options(Request())
+        self.assertEqual(canonical_key('monks.jpg', plan1, options),
+                         canonical_key('monks.jpg', plan2, options))
+
+    def test_output_options_change_the_key(self):
+        crop = (95, 231, 952, 797)
+        plan = CropPlan(crop, True, False, 360, 238)
+        key = canonical_key('monks.jpg', plan, output_options(Request()))
+        self.assertNotEqual(
+            key, canonical_key('other.jpg', plan, output_options(Request())))
+        self.assertNotEqual(key, canonical_key(
+            'monks.jpg', plan, output_options(Request(quality=50))))
+        self.assertNotEqual(key, canonical_key(
+            'monks.jpg', plan,
+            output_options(Request(filters='rmd():grayscale()'))))
+        # The rmd filter itself does not change the output.
+        self.assertEqual(key, canonical_key(
+            'monks.jpg', plan, output_options(Request(filters='rmd(2)'))))
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = Cache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_etag(self):
+        tag = etag('source', 'rmd', 'rmd/key')
+        self.assertTrue(tag.startswith('"') and tag.endswith('"'))
+        self.assertEqual(tag, etag('source', 'rmd', 'rmd/key'))
+        self.assertNotEqual(tag, etag('source', 'rmd2', 'rmd/key'))
+        self.assertNotEqual(tag, etag('source', 'rmd', 'rmd/other'))
+
+        self.assertTrue(etag_matches(tag, tag))
+        self.assertTrue(etag_matches(tag, '"abc", %s' % tag))
+        self.assertTrue(etag_matches(tag, 'W/%s' % tag))
+        self.assertTrue(etag_matches(tag, '*'))
+        self.assertFalse(etag_matches(tag, '"abc"'))
+        self.assertFalse(etag_matches(None, '*'))
@@ -0,0 +1,96 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import json
+from os.path import abspath, join, dirname
+from unittest import TestCase
+
+from pyexiv2 import ImageMetadata
+from thumbor.config import Config
+from thumbor.context import RequestParameters
+
+from universalimages import caches
+from universalimages.compiler import CropFunction, compile_rmd
+from universalimages.filters.xmp.v01 import Xmp_API
+from universalimages.planner import compute_plan, compute_plans, plan_request
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class PlannerTestCase(TestCase):
+
+    def setUp(self):
+        self.metadata = ImageMetadata(join(STORAGE_PATH, 'monks-regions.jpg'))
+        self.metadata.read()
+        self.size = self.metadata.dimensions
+
+    def test_plan_matches_the_filter(self):
+        # Same results as test_step1 without decoding the image.
+        plan = compute_plan(self.metadata, self.size, 360, 0)
+        self.assertEqual(plan.crop, (95, 231, 952, 797))
+        self.assertTrue(plan.should_crop)
+        self.assertEqual((plan.width, plan.height), (360, 238))
+
+        plan = compute_plan(self.metadata, self.size, 400, 400)
+        self.assertEqual(plan.crop, (120, 44, 974, 900))
+        self.assertEqual((plan.width, plan.height), (400, 400))
+
+    def test_plan_request(self):
+        # The deferred plan of a smart request bypasses the detectors.
+        request = RequestParameters(
+            width=360, height=0, smart=True, filters='rmd()', image='monks-regions.jpg',
+            url='/unsafe/360x0/smart/filters:rmd()/monks-regions.jpg')
+        plan = plan_request(request, self.metadata, self.size)
+        self.assertEqual(plan, compute_plan(self.metadata, self.size, 360, 0))
+        self.assertFalse(request.smart)
+        self.assertTrue(request.rmd_detection_bypassed)
+        self.assertEqual(len(request.focal_points), 1)
+
+    def test_no_side_effects(self):
+        self.addCleanup(caches._caches.clear)
+        caches._caches.clear()
+        config = Config()
+        config.UNIVERSALIMAGES_CROP_FUNCTIONS = True
+        compute_plan(self.metadata, self.size, 360, 0, source='monks-regions.jpg',
+                     config=config)
+        for name in ('plans', 'aliases', 'documents', 'functions'):
+            self.assertEqual(len(caches.get_cache(name, config)), 0, name)
+
+    def test_ladder(self):
+        plans = compute_plans(self.metadata, self.size, [(320, 0), (360, 200)])
+        self.assertEqual([p.crop for p in plans],
+                         [(214, 274, 932, 774), (95, 231, 952, 797)])
+
+    def test_grid_snapping(self):
+        config = Config()
+        config.UNIVERSALIMAGES_CROP_GRID = 16
+        xmp = Xmp_API()
+        xmp.metadata = self.metadata
+        x0, y0, x1, y1 = xmp.get_absolute_area_for(b'Xmp.rmd.SafeArea', self.size)
+
+        for width, height in [(360, 0), (400, 400), (320, 0), (1000, 0)]:
+            plan = compute_plan(self.metadata, self.size, width, height)
+            snapped = compute_plan(self.metadata, self.size, width, height, config=config)
+            if snapped.crop == plan.crop:
+                continue
+            for value, limit in zip(snapped.crop, self.size + self.size):
+                self.assertTrue(value % 16 == 0 or value == limit)
+            for value, original in zip(snapped.crop, plan.crop):
+                self.assertLessEqual(abs(value - original), 8)
+            left, top, right, bottom = snapped.crop
+            self.assertTrue(left <= x0 and top <= y0 and right >= x1 and bottom >= y1)
+
+    def test_compiled_crop_function(self):
+        xmp = Xmp_API()
+        xmp.metadata = self.metadata
+        function = CropFunction.load(json.loads(json.dumps(
+            compile_rmd(xmp, self.size).dump())))
+        self.assertEqual(function.breakpoints, [1, 321, 340, 361, 400])
+
+        for width in range(1, 1500, 7):
+            plan = compute_plan(self.metadata, self.size, width, 0)
+            result = function.evaluate(width)
+            crop = tuple(int(round(value)) for value in result.crop)
+            self.assertEqual(crop if result.should_crop else (0, 0) + self.size, plan.crop)
+            self.assertEqual(result.should_crop, plan.should_crop)
+            self.assertEqual(result.fit_in, plan.fit_in)
@@ -0,0 +1,95 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import io
+import os
+import shutil
+import tempfile
+from os.path import join, dirname, abspath
+from unittest import TestCase
+
+from universalimages.commands import precompute
+from universalimages.commands.precompute import walk, recover
+from universalimages.plan import CropPlan, parse_ladder, dump_plan, load_plan
+
+
+class PrecomputeTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['b.jpg', 'a/z.jpg', 'a/b/x.jpg', 'a/b/y.jpg', 'c/d.jpg',
+                     'c/d.jpg.crypto', '.hidden']:
+            full_path = join(self.root, path)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            open(full_path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_walk_order(self):
+        self.assertEqual(list(walk(self.root)),
+                         ['a/b/x.jpg', 'a/b/y.jpg', 'a/z.jpg', 'b.jpg', 'c/d.jpg'])
+
+    def test_walk_resume(self):
+        self.assertEqual(list(walk(self.root, 'a/b/x.jpg')),
+                         ['a/b/y.jpg', 'a/z.jpg', 'b.jpg', 'c/d.jpg'])
+        self.assertEqual(list(walk(self.root, 'a/z.jpg')), ['b.jpg', 'c/d.jpg'])
+        # The last processed file has been deleted in the meantime.
+        self.assertEqual(list(walk(self.root, 'a/c.jpg')),
+                         ['a/z.jpg', 'b.jpg', 'c/d.jpg'])
+        self.assertEqual(list(walk(self.root, 'c/d.jpg')), [])
+
+    def test_recover(self):
+        index_path = join(self.root, 'index.jsonl')
+        self.assertIsNone(recover(index_path))
+
+        with io.open(index_path, 'wb') as index:
+            index.write(b'{"source":"a/b/x.jpg","plans":null}\n'
+                        b'{"source":"a/b/y.jpg","plans":null}\n'
+                        b'{"source":"a/z.j')
+        self.assertEqual(recover(index_path), 'a/b/y.jpg')
+        with io.open(index_path, 'rb') as index:
+            self.assertEqual(index.read(),
+                             b'{"source":"a/b/x.jpg","plans":null}\n'
+                             b'{"source":"a/b/y.jpg","plans":null}\n')
+
+        # A complete index is not changed.
+        self.assertEqual(recover(index_path), 'a/b/y.jpg')
+        with io.open(index_path, 'rb') as index:
+            self.assertEqual(len(index.read().splitlines()), 2)
+
+    def test_ladder_and_plan_serialization(self):
+        self.assertEqual(parse_ladder([320, '640', '800x600']),
+                         [(320, 0), (640, 0), (800, 600)])
+        plan = CropPlan((95, 231, 952, 797), True, False, 360, 238)
+        self.assertEqual(load_plan(dump_plan(plan)), plan)
+        self.assertIsNone(load_plan(dump_plan(None)))
+
+    def test_malformed_rmd(self):
+        from universalimages import planner
+
+        def compute_plans(*args, **kwargs):
+            raise ValueError('Malformed RMD')
+
+        precompute._init_worker(abspath(join(dirname(__file__), 'fixtures')), None, [(320, 0)])
+        original = planner.compute_plans
+        planner.compute_plans = compute_plans
+        try:
+            entry = precompute._precompute('monks-regions.jpg')
+        finally:
+            planner.compute_plans = original
+        self.assertEqual(entry['source'], 'monks-regions.jpg')
+        self.assertIsNotNone(entry['size'])
+        self.assertIsNone(entry['plans'])
+
+    def test_builtin_xmp_reader(self):
+        config_path = join(self.root, 'thumbor.conf')
+        with io.open(config_path, 'w') as conf:
+            conf.write('UNIVERSALIMAGES_BUILTIN_XMP_READER = True\n')
+        precompute._init_worker(abspath(join(dirname(__file__), 'fixtures')), config_path,
+                                [(360, 0)])
+        self.assertTrue(precompute._worker['config'].UNIVERSALIMAGES_BUILTIN_XMP_READER)
+        entry = precompute._precompute('monks-regions.jpg')
+        self.assertEqual(load_plan(entry['plans']['360x0']).crop, (95, 231, 952, 797))
+        self.assertIn('Xmp.rmd.SafeArea', entry['rmd'])
@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import threading
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+from universalimages.prefetch import Prefetcher
+
+
+class PrefetcherTestCase(AsyncTestCase):
+
+    @gen_test
+    def test_callback_on_the_ioloop(self):
+        prefetcher = Prefetcher(workers=1, queue_size=2)
+        done = Future()
+        main_thread = threading.current_thread()
+
+        def callback(future):
+            done.set_result((future.result(), threading.current_thread()))
+
+        self.assertIsNone(prefetcher.submit(lambda: threading.current_thread(), callback))
+        self.assertEqual(len(prefetcher), 1)
+        worker, thread = yield done
+        self.assertIsNot(worker, main_thread)
+        self.assertIs(thread, main_thread)
+        self.assertEqual(len(prefetcher), 0)
+
+    @gen_test
+    def test_queue_size(self):
+        prefetcher = Prefetcher(workers=1, queue_size=2)
+        release = threading.Event()
+        done = Future()
+        results = []
+
+        def callback(future):
+            results.append(future.result())
+            if len(results) == 2:
+                done.set_result(None)
+
+        self.assertIsNone(prefetcher.submit(lambda: release.wait(1), callback))
+        self.assertIsNone(prefetcher.submit(lambda: 'second', callback))
+        self.assertEqual(prefetcher.submit(lambda: 'third', callback), 'queue_full')
+        release.set()
+        yield done
+        self.assertEqual(results, [True, 'second'])
+        self.assertEqual(len(prefetcher), 0)
+
+    def test_rate(self):
+        prefetcher = Prefetcher(workers=1, queue_size=0, rate=2)
+        refused = [prefetcher.submit(lambda: None, lambda future: None) for _ in range(3)]
+        self.assertEqual(refused, [None, None, 'rate_limited'])
+        prefetcher._updated -= 0.5
+        self.assertIsNone(prefetcher.submit(lambda: None, lambda future: None))
+        self.assertEqual(prefetcher.submit(lambda: None, lambda future: None), 'rate_limited')
@@ -0,0 +1,129 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+from os.path import abspath, join, dirname
+
+import tornado.gen as gen
+from thumbor.config import Config
+from thumbor.context import Context, ServerParameters
+from thumbor.importer import Importer
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages import caches, prefetch
+from universalimages.app import App
+from universalimages.handlers import imaging
+from universalimages.ladder import create_context
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class PrefetchHandlerTestCase(AsyncHTTPTestCase):
+    """
+    Requests an rmd() derivative from the universal images app and waits for
+    the other ladder sizes to appear in the result storage.
+    """
+
+    ladder = [320, 480, 640]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.makedirs(join(self.path, 'sources'))
+        shutil.copy(join(STORAGE_PATH, 'monks-regions.jpg'), join(self.path, 'sources'))
+        # The prefetcher and the caches are process wide.
+        self.addCleanup(setattr, prefetch, '_prefetcher', None)
+        self.addCleanup(caches._caches.clear)
+        caches._caches.clear()
+
+        self.prefetched = []
+        original = imaging.prefetch
+
+        def record(context, master):
+            self.prefetched.append(context.request.url)
+            return original(context, master)
+
+        imaging.prefetch = record
+        self.addCleanup(setattr, imaging, 'prefetch', original)
+        super(PrefetchHandlerTestCase, self).setUp()
+
+    def get_app(self):
+        self.config = Config(
+            SECURITY_KEY='ACME-SEC',
+            LOADER='thumbor.loaders.file_loader',
+            FILE_LOADER_ROOT_PATH=join(self.path, 'sources'),
+            STORAGE='thumbor.storages.file_storage',
+            FILE_STORAGE_ROOT_PATH=join(self.path, 'storage'),
+            ENGINE='universalimages.engines.pil',
+            FILTERS=['universalimages.filters.rmd'],
+            RESULT_STORAGE='thumbor.result_storages.file_storage',
+            RESULT_STORAGE_FILE_STORAGE_ROOT_PATH=join(self.path, 'results'),
+            RESULT_STORAGE_STORES_UNSAFE=True,
+            UNIVERSALIMAGES_BUILTIN_XMP_READER=True,
+            UNIVERSALIMAGES_LADDER=self.ladder,
+            UNIVERSALIMAGES_PREFETCH=True,
+            UNIVERSALIMAGES_PREFETCH_RATE=0)
+        self.importer = Importer(self.config)
+        self.importer.import_modules()
+        server = ServerParameters(8889, 'localhost', 'thumbor.conf', None, 'info', None)
+        server.security_key = 'ACME-SEC'
+        return App(Context(server, self.config, self.importer))
+
+    @gen.coroutine
+    def stored(self, width):
+        context = create_context(self.config, self.importer, 'monks-regions.jpg', width, 0)
+        result = yield context.modules.result_storage.get()
+        raise gen.Return(result is not None)
+
+    @gen.coroutine
+    def wait_until_stored(self, widths, timeout=10):
+        end = time.time() + timeout
+        while True:
+            stored = yield [self.stored(width) for width in widths]
+            if all(stored) or time.time() > end:
+                raise gen.Return(stored)
+            yield gen.sleep(0.05)
+
+    @gen_test(timeout=30)
+    def test_ladder_is_prefetched(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/unsafe/320x0/filters:rmd()/monks-regions.jpg'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.prefetched, ['/unsafe/320x0/filters:rmd()/monks-regions.jpg'])
+        self.assertIsNotNone(caches.get_cache('prefetched', self.config).get('monks-regions.jpg'))
+
+        # The derivatives are rendered from the decoded image of the request.
+        os.remove(join(self.path, 'sources', 'monks-regions.jpg'))
+        stored = yield self.wait_until_stored([480, 640])
+        self.assertEqual(stored, [True, True])
+        self.assertEqual(len(prefetch.get_prefetcher(self.config)), 0)
+
+    @gen_test(timeout=30)
+    def test_source_is_prefetched_once(self):
+        for width in (320, 400):
+            response = yield self.http_client.fetch(
+                self.get_url('/unsafe/%dx0/filters:rmd()/monks-regions.jpg' % width))
+            self.assertEqual(response.code, 200)
+        # The 'prefetched' cache suppresses the second prefetch.
+        self.assertEqual(self.prefetched, ['/unsafe/320x0/filters:rmd()/monks-regions.jpg'])
+        stored = yield self.wait_until_stored([480, 640])
+        self.assertEqual(stored, [True, True])
+
+    @gen_test(timeout=30)
+    def test_source_from_the_storage(self):
+        # A request without rmd() stores the source.
+        response = yield self.http_client.fetch(
+            self.get_url('/unsafe/100x0/monks-regions.jpg'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.prefetched, [])
+        os.remove(join(self.path, 'sources', 'monks-regions.jpg'))
+
+        response = yield self.http_client.fetch(
+            self.get_url('/unsafe/320x0/filters:rmd()/monks-regions.jpg'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.prefetched, ['/unsafe/320x0/filters:rmd()/monks-regions.jpg'])
+        stored = yield self.wait_until_stored([480, 640])
+        self.assertEqual(stored, [True, True])
@@ -0,0 +1,191 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import functools
+import hashlib
+import re
+import struct
+
+import tornado.gen as gen
+import tornado.web
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages.filters.xmp.reader import read_rmd
+from universalimages.probe import header_length, fetch_with_probe
+from .test_xmp_reader import PACKET, MonksTestCase, jpeg, png, webp
+
+KB = 1024
+
+
+def large_jpeg(padding=0, data=256 * KB):
+    """
+    A JPEG with padding bytes of APP2 segments before the XMP packet
+    and data bytes of compressed data.
+    """
+    buffer = jpeg(PACKET)
+    segments = b''
+    while padding > 0:
+        size = min(padding, 60000)
+        segments += b'\xff\xe2' + struct.pack('>H', size + 2) + b'\x00' * size
+        padding -= size
+    sos = buffer.index(b'\xff\xda')
+    return buffer[:2] + segments + buffer[2:sos + 4] + b'\x01' * data + buffer[sos + 4:]
+
+
+class SourceHandler(tornado.web.RequestHandler):
+    """
+    Stand-in for an image server. Answers Range requests in chunks
+    of 16KB, with a pause in between.
+    """
+
+    def initialize(self, sources, log, ranges):
+        self.sources = sources
+        self.log = log
+        self.ranges = ranges
+
+    @gen.coroutine
+    def get(self, name):
+        body = self.sources[name]
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        requested = self.request.headers.get('Range')
+        self.log.append(requested)
+        self.set_header('ETag', etag)
+        match = re.match(r'^bytes=(\d+)-(\d*)$', requested or '')
+        if_range = self.request.headers.get('If-Range')
+        if not self.ranges or match is None or (if_range and if_range != etag):
+            self.write(body)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(body) - 1, len(body) - 1)
+        if start >= len(body):
+            self.set_status(416)
+            return
+        self.set_status(206)
+        self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))
+        for offset in range(start, end + 1, 16 * KB):
+            self.write(body[offset:min(offset + 16 * KB, end + 1)])
+            yield self.flush()
+            yield gen.sleep(0.001)
+        self.log.append('sent %d-%d' % (start, end))
+
+
+class ProbeTestCase(AsyncHTTPTestCase, MonksTestCase):
+
+    def get_app(self):
+        self.sources = {}
+        self.log = []
+        return tornado.web.Application([
+            (r'/ranges/(.*)', SourceHandler,
+             {'sources': self.sources, 'log': self.log, 'ranges': True}),
+            (r'/plain/(.*)', SourceHandler,
+             {'sources': self.sources, 'log': self.log, 'ranges': False}),
+        ])
+
+    @gen.coroutine
+    def fetch(self, path, headers, header_callback=None):
+        request = HTTPRequest(self.get_url(path), headers=headers,
+                              header_callback=header_callback)
+        try:
+            response = yield self.http_client.fetch(request)
+        except HTTPError as e:
+            response = e.response
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def probe(self, source, probe_bytes=64 * KB, path='/ranges/image'):
+        self.sources['image'] = source
+        headers = []
+
+        def on_header(header):
+            headers.append(header)
+            self.log.append('header')
+
+        body, probed = yield fetch_with_probe(
+            functools.partial(self.fetch, path), on_header, probe_bytes)
+        raise gen.Return((body, probed, headers))
+
+    def test_header_length(self):
+        buffer = large_jpeg()
+        length = header_length(buffer)
+        self.assertEqual(buffer[length:length + 2], b'\xff\xda')
+        self.assertGreater(header_length(buffer[:100]), 100)
+        self.assertEqual(header_length(buffer[:length + 2]), length)
+        self.assertEqual(header_length(buffer[:length]), length + 2)
+        self.assertEqual(png(PACKET)[header_length(png(PACKET)) + 4:][:4], b'IDAT')
+        self.assertIsNone(header_length(webp(PACKET)))
+
+    @gen_test
+    def test_header_in_prefix(self):
+        source = large_jpeg()
+        body, probed, headers = yield self.probe(source)
+        self.assertEqual(body, source)
+        self.assertTrue(probed)
+        self.assertMonks(read_rmd(headers[0]))
+        self.assertEqual(self.log[0], 'bytes=0-65535')
+        self.assertEqual(self.log[2], 'bytes=65536-')
+        # The header is probed while the rest of the body is sent.
+        self.assertLess(self.log.index('header'), self.log.index('sent 65536-%d' % (len(source) - 1)))
+
+    @gen_test
+    def test_header_crosses_the_prefix(self):
+        source = large_jpeg(padding=100 * KB)
+        body, probed, headers = yield self.probe(source, probe_bytes=16 * KB)
+        self.assertEqual(body, source)
+        self.assertTrue(probed)
+        self.assertMonks(read_rmd(headers[0]))
+        ranges = [entry for entry in self.log if entry and entry.startswith('bytes=')]
+        # The first extension fetches the APP2 segment which crosses the
+        # prefix and the marker of the next segment.
+        self.assertEqual(ranges[:2], ['bytes=0-16383', 'bytes=16384-60007'])
+        self.assertEqual(ranges[-1], 'bytes=%d-' % len(headers[0]))
+        self.assertGreaterEqual(len(headers[0]), header_length(source))
+        self.assertLess(len(headers[0]), header_length(source) + 16 * KB + 4)
+
+    @gen_test
+    def test_small_image(self):
+        source = jpeg(PACKET)
+        body, probed, headers = yield self.probe(source)
+        self.assertEqual(body, source)
+        self.assertTrue(probed)
+        self.assertEqual([entry for entry in self.log if entry and entry.startswith('bytes=')],
+                         ['bytes=0-65535'])
+
+    @gen_test
+    def test_without_range_support(self):
+        source = large_jpeg()
+        body, probed, headers = yield self.probe(source, path='/plain/image')
+        self.assertEqual(body, source)
+        self.assertFalse(probed)
+        self.assertEqual(self.log, ['bytes=0-65535'])
+
+    @gen_test
+    def test_format_without_header(self):
+        source = webp(PACKET) + b'\x00' * 100 * KB
+        body, probed, headers = yield self.probe(source, probe_bytes=16 * KB)
+        self.assertEqual(body, source)
+        self.assertFalse(probed)
+        self.assertEqual(headers, [])
+
+    @gen_test
+    def test_source_changed(self):
+        source = large_jpeg()
+        changed = large_jpeg(data=300 * KB)
+        self.sources['image'] = source
+
+        @gen.coroutine
+        def fetch(headers, header_callback):
+            response = yield self.fetch('/ranges/image', headers, header_callback)
+            self.sources['image'] = changed
+            raise gen.Return(response)
+
+        body, probed = yield fetch_with_probe(fetch, lambda header: None, 64 * KB)
+        self.assertEqual(body, changed)
+        self.assertFalse(probed)
+
+    @gen_test
+    def test_missing_image(self):
+        body, probed = yield fetch_with_probe(
+            functools.partial(self.fetch, '/ranges/missing'), lambda header: None)
+        self.assertIsNone(body)
+        self.assertFalse(probed)
@@ -0,0 +1,112 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from os.path import abspath, join, dirname
+
+import tornado.gen as gen
+import tornado.web
+from thumbor.config import Config
+from thumbor.importer import Importer
+from thumbor.transformer import Transformer
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from universalimages.filters.rmd import Filter
+from universalimages.ladder import create_context
+from universalimages.loaders import http_probe
+from universalimages.plan import CropPlan
+from .test_probe import SourceHandler, KB
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class ProbeLoaderTestCase(AsyncHTTPTestCase):
+    """
+    Loads an image from a local image server with the http_probe loader,
+    decodes it and runs the rmd filter, the same way the imaging handler does.
+    """
+
+    sizes = [(320, 0), (360, 0), (400, 400), (240, 160)]
+
+    def get_app(self):
+        with open(join(STORAGE_PATH, 'monks-regions.jpg'), 'rb') as f:
+            self.sources = {'monks-regions.jpg': f.read()}
+        self.log = []
+        return tornado.web.Application([
+            (r'/ranges/(.*)', SourceHandler,
+             {'sources': self.sources, 'log': self.log, 'ranges': True}),
+        ])
+
+    def get_context(self, width, height, probe_bytes):
+        config = Config(
+            ENGINE='universalimages.engines.pil',
+            LOADER='universalimages.loaders.http_probe',
+            FILTERS=['universalimages.filters.rmd'],
+            UNIVERSALIMAGES_PROBE_BYTES=probe_bytes,
+            UNIVERSALIMAGES_BUILTIN_XMP_READER=True)
+        importer = Importer(config)
+        importer.import_modules()
+        return create_context(config, importer, self.get_url('/ranges/monks-regions.jpg'),
+                              width, height)
+
+    @gen.coroutine
+    def run_filter(self, width, height, probe_bytes=16 * KB, change_probe=None):
+        """
+        :param probe_bytes: 0 loads the image without the probe.
+        :param change_probe: Called with the probe before the image is decoded.
+        :return: The request and the engine after the rmd filter.
+        """
+        context = self.get_context(width, height, probe_bytes)
+        result = yield http_probe.load(context, context.request.image_url)
+        self.assertTrue(result.successful)
+        self.assertEqual(result.buffer, self.sources['monks-regions.jpg'])
+        probe = getattr(context.request, 'rmd_probe', None)
+        if change_probe is not None:
+            change_probe(probe)
+
+        engine = context.request.engine = context.modules.engine
+        engine.load(result.buffer, None)
+        context.transformer = Transformer(context)
+        Filter.pre_compile()
+        fltr = Filter('rmd()', context)
+        fltr.engine = engine
+        fltr.run()
+        raise gen.Return((context.request, engine))
+
+    def assertSameCrop(self, request, reference):
+        self.assertEqual(request.crop, reference.crop)
+        self.assertEqual(request.should_crop, reference.should_crop)
+        self.assertEqual(request.fit_in, reference.fit_in)
+        self.assertEqual(request.rmd_plan, reference.rmd_plan)
+
+    @gen_test
+    def test_probed_crop_matches_the_loaded_image(self):
+        for width, height in self.sizes:
+            reference, engine = yield self.run_filter(width, height, probe_bytes=0)
+            self.assertIsNone(getattr(reference, 'rmd_probe', None))
+            self.assertIsNotNone(reference.rmd_plan)
+
+            del self.log[:]
+            request, engine = yield self.run_filter(width, height)
+            # The header crosses the first range.
+            self.assertEqual([entry for entry in self.log if entry and entry.startswith('bytes=')],
+                             ['bytes=0-16383', 'bytes=16384-32767', 'bytes=32768-'])
+            probe = request.rmd_probe
+            self.assertEqual(tuple(probe['size']), engine.size)
+            self.assertIsNotNone(probe['plan'])
+            # The engine does not read the metadata again.
+            self.assertIs(engine.metadata, probe['document'])
+            self.assertSameCrop(request, reference)
+
+    @gen_test
+    def test_size_mismatch(self):
+        def change_probe(probe):
+            # A plan for another image, which the filter must not apply.
+            probe['size'] = (600, 450)
+            probe['plan'] = CropPlan((0, 0, 60, 45), True, False, 60, 45)
+
+        for width, height in self.sizes:
+            reference, engine = yield self.run_filter(width, height, probe_bytes=0)
+            request, engine = yield self.run_filter(width, height, change_probe=change_probe)
+            # The crop is computed from the probed RMD instead.
+            self.assertIs(engine.metadata, request.rmd_probe['document'])
+            self.assertSameCrop(request, reference)
@@ -0,0 +1,97 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from universalimages.profiling import Profiler, ProfiledThreadPool, profiled
+
+LINE_RE = re.compile(r'^(\S[^;]* \([^;]+:\d+\))(;\S[^;]* \([^;]+:\d+\))* \d+$')
+
+
+def busy_rmd_stage(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(1000))
+
+
+class ThreadPool(object):
+    """
+    Stand-in for the thumbor thread pool.
+    """
+
+    def queue(self, operation, callback):
+        results = []
+        worker = threading.Thread(target=lambda: results.append(operation()))
+        worker.start()
+        worker.join()
+        callback(results[0])
+
+
+class Context(object):
+    thread_pool = ThreadPool()
+
+
+class ProfilerTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_collapsed_stacks(self):
+        profiler = Profiler(self.path, interval=3600, sample_interval=0.001)
+        token = profiler.start()
+        busy_rmd_stage(0.2)
+        profiler.stop(token)
+        filename = profiler.flush()
+
+        self.assertEqual(os.listdir(self.path), [os.path.basename(filename)])
+        self.assertTrue(filename.endswith('.collapsed'))
+        with io.open(filename, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(LINE_RE.match(line), line)
+        stacks = [line.rsplit(' ', 1) for line in lines]
+        busy = sum(int(count) for stack, count in stacks if 'busy_rmd_stage (' in stack)
+        self.assertGreater(busy, 10)
+        # Outermost frame first
+        self.assertTrue(all(stack.index('test_collapsed_stacks (') < stack.index('busy_rmd_stage (')
+                            for stack, count in stacks if 'busy_rmd_stage (' in stack))
+
+    def test_no_samples_without_requests(self):
+        profiler = Profiler(self.path, interval=3600, sample_interval=0.001)
+        profiler.stop(profiler.start())
+        time.sleep(0.05)
+        profiler.flush()
+        busy_rmd_stage(0.05)
+        self.assertIsNone(profiler.flush())
+        self.assertFalse(profiler._active.is_set())
+
+    def test_worker_threads(self):
+        profiler = Profiler(self.path, interval=3600, sample_interval=0.001)
+        context = Context()
+        # Not profiled
+        self.assertIs(profiled(context, busy_rmd_stage), busy_rmd_stage)
+
+        context.thread_pool = ProfiledThreadPool(context.thread_pool, profiler)
+        results = []
+        context.thread_pool.queue(lambda: busy_rmd_stage(0.2) or 'done', results.append)
+        metadata_task = threading.Thread(target=profiled(context, busy_rmd_stage), args=(0.2,))
+        metadata_task.start()
+        metadata_task.join()
+
+        self.assertEqual(results, ['done'])
+        self.assertFalse(profiler._active.is_set())
+        with io.open(profiler.flush(), encoding='utf-8') as f:
+            stacks = [line.rsplit(' ', 1) for line in f.read().splitlines()]
+        busy = [stack for stack, count in stacks if 'busy_rmd_stage (' in stack]
+        self.assertTrue(busy)
+        # Sampled in the worker threads, not in the thread of the test.
+        self.assertFalse(any('test_worker_threads (' in stack for stack in busy))
@@ -0,0 +1,107 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from unittest import TestCase
+
+from PIL import Image
+
+from universalimages.caches.regions import RegionCache, pixel_bytes
+from universalimages.plan import snap_box
+
+
+class Engine(object):
+
+    def __init__(self, image):
+        self.image = image
+        self.context = object()
+        self.metadata = object()
+        self.extension = '.jpg'
+        self.icc_profile = b'icc'
+
+    @property
+    def size(self):
+        return self.image.size
+
+
+class RegionCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.engine = Engine(Image.new('RGB', (1200, 900)))
+
+    def test_snap_box(self):
+        self.assertEqual(snap_box((95, 231, 952.4, 797), 64, (1200, 900)),
+                         (64, 192, 960, 832))
+        self.assertEqual(snap_box((0, 0, 1190, 900), 64, (1200, 900)),
+                         (0, 0, 1200, 900))
+
+    def test_get_containing_region(self):
+        cache = RegionCache(10 * 1024 * 1024, grid=64)
+        region_box = cache.put('a.jpg', (95, 231, 952, 797), self.engine)
+        self.assertEqual(region_box, (64, 192, 960, 832))
+        self.assertEqual(cache.size, 896 * 640 * 3)
+
+        box, engine = cache.get('a.jpg', (120, 250, 900, 780))
+        self.assertEqual(box, region_box)
+        self.assertEqual(engine.size, (896, 640))
+        self.assertEqual(engine.extension, '.jpg')
+        self.assertIsNone(engine.context)
+        # The cached engine is a copy, the source engine is unchanged.
+        self.assertEqual(self.engine.size, (1200, 900))
+
+        self.assertIsNone(cache.get('a.jpg', (0, 0, 952, 797)))
+        self.assertIsNone(cache.get('b.jpg', (120, 250, 900, 780)))
+
+        # The smallest containing region is used.
+        cache.put('a.jpg', (0, 0, 1200, 900), self.engine)
+        self.assertEqual(cache.get('a.jpg', (120, 250, 900, 780))[0], region_box)
+        self.assertEqual(cache.get('a.jpg', (0, 0, 952, 797))[0], (0, 0, 1200, 900))
+
+    def test_eviction_by_pixel_bytes(self):
+        region_bytes = pixel_bytes(Image.new('RGB', (128, 128)))
+        cache = RegionCache(2 * region_bytes, grid=64)
+        cache.put('a.jpg', (0, 0, 128, 128), self.engine)
+        cache.put('b.jpg', (0, 0, 128, 128), self.engine)
+        cache.get('a.jpg', (0, 0, 100, 100))
+        cache.put('c.jpg', (0, 0, 128, 128), self.engine)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 2 * region_bytes)
+        self.assertIsNotNone(cache.get('a.jpg', (0, 0, 100, 100)))
+        self.assertIsNone(cache.get('b.jpg', (0, 0, 100, 100)))
+
+        # Regions larger than the cache are not stored.
+        self.assertIsNone(cache.put('d.jpg', (0, 0, 1200, 900), self.engine))
+
+    def test_admission_and_ttl(self):
+        cache = RegionCache(10 * 1024 * 1024, min_requests=2, ttl=-1)
+        self.assertFalse(cache.admit('a.jpg'))
+        self.assertTrue(cache.admit('a.jpg'))
+
+        cache.put('a.jpg', (0, 0, 128, 128), self.engine)
+        self.assertIsNone(cache.get('a.jpg', (0, 0, 100, 100)))
+        self.assertEqual(cache.size, 0)
+
+    def test_validator(self):
+        cache = RegionCache(10 * 1024 * 1024)
+        cache.put('a.jpg', (0, 0, 128, 128), self.engine, 'digest')
+        self.assertIsNotNone(cache.get('a.jpg', (0, 0, 100, 100), 'digest'))
+        # The source changed.
+        self.assertIsNone(cache.get('a.jpg', (0, 0, 100, 100), 'changed'))
+        self.assertEqual(len(cache), 0)
+
+    def test_restore(self):
+        cache = RegionCache(10 * 1024 * 1024)
+        cache.put('a.jpg', (0, 0, 128, 128), self.engine)
+        template = cache.get('a.jpg', (0, 0, 100, 100))[1]
+        self.assertIsNone(template.metadata)
+
+        context = object()
+        engine = Engine(Image.new('RGB', (10, 10)))
+        engine.context = context
+        engine.icc_profile = None
+        cache.restore(template, engine)
+        self.assertIs(engine.image, template.image)
+        self.assertEqual(engine.size, (128, 128))
+        self.assertEqual(engine.icc_profile, b'icc')
+        self.assertIs(engine.context, context)
+        self.assertIsNot(engine.metadata, None)
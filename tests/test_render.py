@@ -0,0 +1,101 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from os.path import abspath, join, dirname
+
+import zipfile
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from .base import FilterTestCase
+from universalimages.handlers.ladder import multipart, zip_archive, clamp_ladder
+from universalimages.ladder import (
+    create_context, load_master, render, render_many, derivative_url)
+
+STORAGE_PATH = abspath(join(dirname(__file__), 'fixtures'))
+
+
+class LadderRenderTestCase(FilterTestCase):
+
+    def read_fixture(self, file_name):
+        with open(join(STORAGE_PATH, file_name), 'rb') as im:
+            return im.read()
+
+    def render_live(self, file_name, width, height):
+        def config_context(context):
+            context.request.width = width
+            context.request.height = height
+
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=config_context)
+        fltr.engine.load(self.read_fixture(file_name), None)
+        fltr.run()
+        fltr.context.transformer.img_operation_worker()
+        return fltr.engine.read(fltr.engine.extension, fltr.context.config.QUALITY)
+
+    def test_derivative_url(self):
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()')
+        self.assertEqual(
+            derivative_url(fltr.context.config, 'monks-regions.jpg', 320, 0),
+            '/unsafe/320x0/filters:rmd()/monks-regions.jpg')
+
+    def test_offline_render_matches_live_path(self):
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()')
+        config = fltr.context.config
+        importer = fltr.context.modules.importer
+
+        context = create_context(config, importer, 'monks-regions.jpg', 0, 0)
+        master = load_master(context, self.read_fixture('monks-regions.jpg'))
+
+        for width, height in [(320, 0), (360, 0), (400, 400), (240, 160)]:
+            context = create_context(config, importer, 'monks-regions.jpg',
+                                     width, height)
+            self.assertEqual(render(master, context),
+                             self.render_live('monks-regions.jpg', width, height))
+            self.assertIsNotNone(context.request.rmd_plan)
+
+    def test_render_many(self):
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()')
+        config = fltr.context.config
+        importer = fltr.context.modules.importer
+        ladder = [(320, 0), (400, 400), (800, 0), (360, 0)]
+
+        context = create_context(config, importer, 'monks-regions.jpg', 0, 0)
+        master = load_master(context, self.read_fixture('monks-regions.jpg'))
+
+        contexts = [create_context(config, importer, 'monks-regions.jpg', w, h)
+                    for w, h in ladder]
+        unchained = render_many(master, contexts, chain=False)
+        for (width, height), buffer in zip(ladder, unchained):
+            self.assertEqual(buffer, self.render_live('monks-regions.jpg', width, height))
+
+        contexts = [create_context(config, importer, 'monks-regions.jpg', w, h)
+                    for w, h in ladder]
+        chained = render_many(master, contexts)
+        for buffer, expected in zip(chained, unchained):
+            image = np.array(Image.open(BytesIO(buffer)))
+            expected = np.array(Image.open(BytesIO(expected)))
+            self.assertEqual(image.shape, expected.shape)
+            self.assertGreater(self.get_ssim(image, expected), 0.95)
+
+    def test_response_encoding(self):
+        parts = [('/unsafe/320x0/filters:rmd()/a.jpg', 'image/jpeg', b'first'),
+                 ('/unsafe/640x0/filters:rmd()/a.jpg', 'image/jpeg', b'second')]
+        body = multipart(parts, 'boundary')
+        self.assertTrue(body.startswith(b'--boundary\r\nContent-Type: image/jpeg\r\n'
+                                        b'Content-Location: /unsafe/320x0/filters:rmd()/a.jpg\r\n'
+                                        b'Content-Length: 5\r\n\r\nfirst\r\n'))
+        self.assertTrue(body.endswith(b'second\r\n--boundary--\r\n'))
+
+        archive = zipfile.ZipFile(BytesIO(zip_archive(
+            [('320x0.jpg', 'image/jpeg', b'first')])))
+        self.assertEqual(archive.read('320x0.jpg'), b'first')
+
+    def test_clamp_ladder(self):
+        ladder = [(320, 0), (4000, 0), (5000, 300), (0, 9000)]
+        self.assertEqual(clamp_ladder(ladder), ladder)
+        self.assertEqual(clamp_ladder(ladder, 2000, 2000),
+                         [(320, 0), (2000, 0), (2000, 300), (0, 2000)])
+        self.assertEqual(clamp_ladder([(3000, 0), (4000, 0)], 2000), [(2000, 0)])
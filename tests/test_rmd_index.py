@@ -0,0 +1,96 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import os
+import shutil
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+from universalimages.plan import CropPlan
+from universalimages.rmd_index import RmdIndex, write_index, get_rmd_index
+
+RMD = {
+    'Xmp.rmd.AppliedToDimensions': 'type="Struct"',
+    'Xmp.rmd.AppliedToDimensions/stDim:w': '1200',
+    'Xmp.rmd.AppliedToDimensions/stDim:h': '900',
+    'Xmp.rmd.Interpolation': 'linear',
+}
+
+
+class Config(object):
+    UNIVERSALIMAGES_RMD_INDEX_CHECK_INTERVAL = 0
+
+    def __init__(self, path):
+        self.UNIVERSALIMAGES_RMD_INDEX = path
+
+
+class RmdIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = join(self.root, 'rmd.index')
+        self.entries = [
+            {'source': 'monks.jpg', 'size': [1200, 900], 'digest': 'ab' * 20, 'rmd': RMD,
+             'plans': {'360x0': [95, 231, 952, 797, 1, 0, 360, 238],
+                       '400x400': [120, 44, 974, 900, 1, 0, 400, 400]}},
+            {'source': 'plain.jpg', 'size': [640, 480], 'plans': None},
+            {'source': 'broken.jpg', 'size': None, 'plans': None},
+        ] + [{'source': 'images/%d.jpg' % i, 'size': [i, i], 'plans': None}
+             for i in range(1, 100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lookup(self):
+        count = write_index(self.path, self.entries, [(360, 0), (400, 400), (800, 0)])
+        self.assertEqual(count, 101)
+        index = RmdIndex(self.path)
+        self.assertEqual(len(index), 101)
+
+        record = index.lookup('monks.jpg')
+        self.assertEqual(record.size, (1200, 900))
+        self.assertEqual(record.digest, 'ab' * 20)
+        self.assertEqual(record.plans, {
+            (360, 0): CropPlan((95, 231, 952, 797), True, False, 360, 238),
+            (400, 400): CropPlan((120, 44, 974, 900), True, False, 400, 400),
+        })
+        document = record.document
+        self.assertEqual(document.xmp_keys, sorted(RMD))
+        self.assertEqual(document[b'Xmp.rmd.AppliedToDimensions/stDim:w'].value, '1200')
+        self.assertEqual(document.get('Xmp.rmd.Interpolation').value, 'linear')
+        self.assertIsNone(document.get('Xmp.rmd.SafeArea'))
+
+        # Indexed images without RMD have an empty document.
+        record = index.lookup('plain.jpg')
+        self.assertEqual(record.digest, '')
+        self.assertEqual(record.plans, {})
+        self.assertFalse(record.document)
+
+        for i in range(1, 100):
+            self.assertEqual(index.lookup('images/%d.jpg' % i).size, (i, i))
+        self.assertIsNone(index.lookup('broken.jpg'))
+        self.assertIsNone(index.lookup('missing.jpg'))
+        index.close()
+
+    def test_empty_index(self):
+        write_index(self.path, [], [])
+        self.assertIsNone(RmdIndex(self.path).lookup('monks.jpg'))
+
+    def test_atomic_replacement(self):
+        config = Config(self.path)
+        self.assertIsNone(get_rmd_index(config))
+
+        write_index(self.path, self.entries[:1], [(360, 0)])
+        index = get_rmd_index(config)
+        self.assertIsNotNone(index.lookup('monks.jpg'))
+        self.assertIs(get_rmd_index(config), index)
+
+        write_index(self.path, self.entries[1:2], [(360, 0)])
+        self.assertEqual(os.listdir(self.root), ['rmd.index'])
+        new_index = get_rmd_index(config)
+        self.assertIsNot(new_index, index)
+        self.assertIsNone(new_index.lookup('monks.jpg'))
+        self.assertIsNotNone(new_index.lookup('plain.jpg'))
+        # The old index can still be read.
+        self.assertIsNotNone(index.lookup('monks.jpg'))
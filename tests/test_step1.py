@@ -1,7 +1,11 @@
 # coding: utf-8
 from __future__ import unicode_literals, absolute_import
 
+from io import BytesIO
+
 import numpy as np
+from PIL import Image
+from thumbor.point import FocalPoint
 
 from .base import FilterTestCase
 from universalimages.filters.xmp.v01 import Xmp_API
@@ -89,6 +93,9 @@ class RmdFilterUnittestsTestCase(FilterTestCase):
         area = api.get_area_values_for('Xmp.rmd.PivotPoint')
         self.assertEqual(area, {})
 
+        self.assertEqual(len(api.digest()), 40)
+        self.assertEqual(api.digest(), Xmp_API(filt.engine.metadata).digest())
+
     def test_small_crop_exact_safe_area1(self):
         def config_context(context):
             context.request.width = 320
@@ -284,4 +291,71 @@ class RmdFilterUnittestsTestCase(FilterTestCase):
         fltr.context.transformer.img_operation_worker()
         image = np.array(fltr.engine.image)
         self.assertEqual(len(image[0]), 360)
-        self.assertEqual(len(image), 360)
\ No newline at end of file
+        self.assertEqual(len(image), 360)
+    def test_smart_detection_bypass(self):
+        def config_context(context):
+            context.request.width = 360
+            context.request.smart = True
+
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=config_context)
+        self.load_file('monks-regions.jpg', fltr.engine)
+        fltr.run()
+        self.assertFalse(fltr.context.request.smart)
+        self.assertCrop(fltr.context.request.crop, (95, 231, 952, 797))
+
+        pivot_point = fltr._get_pivot_point()
+        focal_points = fltr.context.request.focal_points
+        self.assertEqual(len(focal_points), 1)
+        self.assertEqual((focal_points[0].x, focal_points[0].y),
+                         (pivot_point.x, pivot_point.y))
+        self.assertEqual(focal_points[0].origin, 'RMD')
+
+    def test_smart_detection_without_rmd(self):
+        def config_context(context):
+            context.request.smart = True
+
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=config_context)
+        buffer = BytesIO()
+        Image.new('RGB', (640, 480)).save(buffer, 'JPEG')
+        fltr.engine.load(buffer.getvalue(), None)
+        fltr.run()
+        self.assertTrue(fltr.context.request.smart)
+
+    def test_synthesized_rmd(self):
+        buffer = BytesIO()
+        Image.new('RGB', (640, 480)).save(buffer, 'JPEG')
+
+        def smart_request(width):
+            def config_context(context):
+                context.config.UNIVERSALIMAGES_SYNTHESIZE_RMD = True
+                context.request.image_url = 'synthesized.jpg'
+                context.request.width = width
+                context.request.smart = True
+            return config_context
+
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=smart_request(600))
+        fltr.engine.load(buffer.getvalue(), None)
+        fltr.run()
+        self.assertTrue(fltr.context.request.smart)
+
+        # The detectors find a face.
+        transformer = fltr.context.transformer
+        transformer.running_smart_detection = True
+        fltr.context.request.focal_points.append(
+            FocalPoint.from_square(200, 100, 200, 160))
+        transformer.after_smart_detect()
+
+        # The next size uses the synthesized RMD instead of the detectors.
+        fltr = self.get_filter('universalimages.filters.rmd', 'rmd()',
+                               config_context=smart_request(160))
+        fltr.engine.load(buffer.getvalue(), None)
+        fltr.run()
+        self.assertFalse(fltr.context.request.smart)
+        focal_point = fltr.context.request.focal_points[0]
+        self.assertEqual((focal_point.x, focal_point.y), (300, 180))
+        # Smaller than the face, the image is cropped to the safe area.
+        self.assertTrue(fltr.context.request.should_crop)
+        self.assertCrop(fltr.context.request.crop, (200, 100, 400, 260))
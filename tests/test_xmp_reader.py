@@ -0,0 +1,193 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import struct
+import zlib
+from os.path import abspath, join, dirname
+from unittest import TestCase
+
+from universalimages.filters.xmp.reader import (
+    extract_xmp, parse_rmd, read_rmd, XmpLimits, XmpLimitError)
+from universalimages.filters.xmp.v01 import Xmp_API
+from universalimages.rmd_index import RmdDocument
+from .rss import peak_rss
+
+FIXTURES = join(dirname(abspath(__file__)), 'fixtures')
+
+with open(join(FIXTURES, 'monks.xml'), 'rb') as f:
+    PACKET = f.read()
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I4s', len(data), kind) + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png(packet, compressed=False):
+    text = zlib.compress(packet) if compressed else packet
+    itxt = b'XML:com.adobe.xmp\x00' + (b'\x01\x00' if compressed else b'\x00\x00') + \
+        b'\x00\x00' + text
+    return b'\x89PNG\r\n\x1a\n' + \
+        png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) + \
+        png_chunk(b'tEXt', b'Comment\x00test') + \
+        png_chunk(b'iTXt', itxt) + \
+        png_chunk(b'IDAT', zlib.compress(b'\x00\x00\x00\x00')) + \
+        png_chunk(b'IEND', b'')
+
+
+def webp(packet):
+    chunks = b''
+    for kind, data in ((b'VP8X', b'\x04' + b'\x00' * 9), (b'VP8L', b'\x2f\x00\x00'),
+                       (b'XMP ', packet)):
+        chunks += struct.pack('<4sI', kind, len(data)) + data + b'\x00' * (len(data) & 1)
+    return b'RIFF' + struct.pack('<I', len(chunks) + 4) + b'WEBP' + chunks
+
+
+def tiff(packet, order='<'):
+    # Header, one IFD with the image width and the XMP tag, then the packet.
+    entries = [(256, 3, 1, 1), (700, 1, len(packet), 8 + 2 + 12 * 2 + 4)]
+    ifd = struct.pack(order + 'H', len(entries)) + b''.join(
+        struct.pack(order + 'HHII', *entry) for entry in entries) + b'\x00' * 4
+    header = (b'II*\x00' if order == '<' else b'MM\x00*') + struct.pack(order + 'I', 8)
+    return header + ifd + packet
+
+
+BILLION_LAUGHS = b"""<?xml version="1.0"?>
+<!DOCTYPE lolz [<!ENTITY lol "lol"><!ENTITY lol2 "&lol;&lol;&lol;&lol;&lol;&lol;">]>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">&lol2;</x:xmpmeta>"""
+
+GUID = b'2B4A64C7B7B5A4A1DDB5D1D4A5E3F401'
+
+STANDARD_PACKET = (
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF '
+    'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    '<rdf:Description rdf:about="" xmlns:xmpNote="http://ns.adobe.com/xmp/note/" '
+    'xmpNote:HasExtendedXMP="%s"/></rdf:RDF></x:xmpmeta>' % GUID.decode('ascii')
+).encode('utf-8')
+
+
+def app1(data):
+    return b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data
+
+
+def jpeg(packet, extended=None, segment_size=4000):
+    app0 = b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    segments = [app1(b'http://ns.adobe.com/xap/1.0/\x00' + packet)]
+    if extended is not None:
+        for offset in range(0, len(extended), segment_size):
+            segments.append(app1(
+                b'http://ns.adobe.com/xmp/extension/\x00' + GUID +
+                struct.pack('>II', len(extended), offset) +
+                extended[offset:offset + segment_size]))
+        # Readers must not depend on the order of the segments.
+        segments[1:] = segments[:0:-1]
+    return b'\xff\xd8' + \
+        b'\xff\xe0' + struct.pack('>H', len(app0) + 2) + app0 + \
+        b''.join(segments) + \
+        b'\xff\xda\x00\x02' + b'\x00' * 16 + b'\xff\xd9'
+
+
+class MonksTestCase(TestCase):
+
+    def assertMonks(self, values):
+        self.assertEqual(values['Xmp.rmd.Interpolation'], 'step')
+        self.assertEqual(values['Xmp.rmd.AppliedToDimensions'], 'type="Struct"')
+        self.assertEqual(values['Xmp.rmd.AppliedToDimensions/stDim:w'], '2816')
+        self.assertEqual(values['Xmp.rmd.RecommendedFrames'], 'type="Bag"')
+        self.assertEqual(values['Xmp.rmd.RecommendedFrames[2]/rmd:MaxWidth'], '360')
+        self.assertEqual(values['Xmp.rmd.SafeArea/stArea:x'], '0.4776278409090909')
+        self.assertEqual(values['Xmp.rmd.AllowedDerivates/rmd:Crop'], 'all')
+        self.assertFalse([key for key in values if not key.startswith('Xmp.rmd.')])
+
+
+class XmpReaderTestCase(MonksTestCase):
+
+    def test_containers(self):
+        for buffer in (png(PACKET), png(PACKET, compressed=True), webp(PACKET),
+                       tiff(PACKET), tiff(PACKET, '>'), jpeg(PACKET)):
+            self.assertEqual(extract_xmp(buffer), PACKET)
+            self.assertEqual(extract_xmp(memoryview(buffer)), PACKET)
+            self.assertMonks(read_rmd(buffer))
+
+    def test_views(self):
+        # Containers at an offset of a larger buffer.
+        for buffer in (png(PACKET, compressed=True), webp(PACKET), tiff(PACKET), jpeg(PACKET)):
+            view = memoryview(b'padding' + buffer + b'padding')[7:-7]
+            self.assertMonks(read_rmd(view))
+            self.assertMonks(read_rmd(bytearray(buffer)))
+
+    def test_only_the_packet_is_copied(self):
+        packet = PACKET.replace(b'</x:xmpmeta>', b' ' * 50000 + b'</x:xmpmeta>')
+        # Image data after the packet. A copy of the buffer would stand out
+        # from the noise of the resident memory.
+        image_data = b'\x00' * (32 * 1024 * 1024)
+        for buffer in (png(packet), webp(packet), tiff(packet), jpeg(packet)):
+            buffer += image_data
+            extracted, peak = peak_rss(lambda: extract_xmp(buffer))
+            if peak is None:
+                self.skipTest('The resident memory cannot be measured.')
+            self.assertEqual(extracted, packet)
+            self.assertLess(peak, 4 * 1024 * 1024)
+
+    def test_without_xmp(self):
+        self.assertIsNone(extract_xmp(png(PACKET).replace(b'XML:com.adobe.xmp', b'XML:com.example.x')))
+        self.assertIsNone(extract_xmp(b'GIF89a'))
+        self.assertEqual(read_rmd(webp(b'<x:xmpmeta')), {})
+        # Truncated containers
+        self.assertIsNone(extract_xmp(tiff(PACKET)[:12]))
+        self.assertIsNone(extract_xmp(jpeg(PACKET)[:30]))
+
+    def test_extended_xmp(self):
+        buffer = jpeg(STANDARD_PACKET, PACKET)
+        self.assertMonks(read_rmd(buffer))
+        self.assertMonks(read_rmd(memoryview(buffer)))
+        # Incomplete extended packet
+        self.assertEqual(read_rmd(jpeg(STANDARD_PACKET, PACKET)[:-2000]), {})
+
+    def test_extended_xmp_is_not_read_with_standard_rmd(self):
+        standard = PACKET.replace(
+            b'xmlns:rmd=', b'xmpNote:HasExtendedXMP="%s" xmlns:xmpNote='
+            b'"http://ns.adobe.com/xmp/note/" xmlns:rmd=' % GUID)
+        # The extended packet is invalid, the reader must not parse it.
+        self.assertMonks(read_rmd(jpeg(standard, b'<invalid', segment_size=3)))
+
+    def test_attribute_structs(self):
+        with open(join(FIXTURES, 'regions2.jpg'), 'rb') as f:
+            values = read_rmd(f.read())
+        self.assertEqual(values['Xmp.rmd.Interpolation'], 'linear')
+        self.assertEqual(values['Xmp.rmd.AppliedToDimensions/stDim:w'], '640')
+        self.assertEqual(values['Xmp.rmd.PivotPoint/stArea:x'], '0.34375')
+        self.assertEqual(values['Xmp.rmd.RecommendedFrames[1]/rmd:MinAspectRatio'], '1')
+
+    def test_xmp_api(self):
+        xmp = Xmp_API(RmdDocument(parse_rmd(PACKET)))
+        self.assertTrue(xmp.check_valid((2816, 2112)))
+        self.assertTrue(xmp.check_allowed())
+
+
+class XmpLimitsTestCase(MonksTestCase):
+
+    def test_dtds_are_refused(self):
+        self.assertRaises(XmpLimitError, parse_rmd, BILLION_LAUGHS)
+        self.assertRaises(XmpLimitError, read_rmd, png(BILLION_LAUGHS))
+        # Entities need a DTD
+        self.assertEqual(read_rmd(png(b'<x:xmpmeta xmlns:x="adobe:ns:meta/">&lol;</x:xmpmeta>')), {})
+
+    def test_max_bytes(self):
+        limits = XmpLimits(len(PACKET) - 1, 0, 0, 0)
+        self.assertRaises(XmpLimitError, parse_rmd, PACKET, limits)
+        self.assertRaises(XmpLimitError, read_rmd, png(PACKET, compressed=True), limits)
+        self.assertRaises(XmpLimitError, read_rmd, jpeg(STANDARD_PACKET, PACKET), limits)
+        self.assertMonks(read_rmd(png(PACKET, compressed=True), XmpLimits(len(PACKET), 0, 0, 0)))
+
+    def test_max_depth(self):
+        packet = b'<a>' * 100 + b'</a>' * 100
+        self.assertRaises(XmpLimitError, parse_rmd, packet, XmpLimits(0, 64, 0, 0))
+        self.assertEqual(parse_rmd(packet, XmpLimits(0, 100, 0, 0)), {})
+
+    def test_max_nodes(self):
+        self.assertRaises(XmpLimitError, parse_rmd, PACKET, XmpLimits(0, 0, 100, 0))
+        self.assertMonks(parse_rmd(PACKET, XmpLimits(0, 0, 1000, 0)))
+
+    def test_timeout(self):
+        self.assertRaises(XmpLimitError, parse_rmd, PACKET, XmpLimits(0, 0, 0, 1e-9))
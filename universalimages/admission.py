@@ -0,0 +1,99 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import heapq
+import io
+import itertools
+
+from tornado.concurrent import Future
+
+
+def image_size(buffer):
+    """
+    Reads the dimensions of an image from its header, without decoding it.
+    :return: (width, height) or None
+    """
+    from PIL import Image
+    try:
+        return Image.open(io.BytesIO(buffer)).size
+    except Exception:
+        return None
+
+
+def estimate_cost(source_size, *output_sizes):
+    """
+    Estimates the memory cost of a request in pixels: the decoded source
+    and the resized outputs are in memory at the same time.
+    """
+    return source_size[0] * source_size[1] + sum(
+        width * height for width, height in output_sizes)
+
+
+class PixelBudget(object):
+    """
+    Admits requests as long as the total cost of the admitted requests stays
+    within the budget. The other requests wait, the ones with the smallest
+    output first. A request which exceeds the budget on its own is admitted
+    when no other request is running.
+    All methods must be called from the IOLoop thread.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self._queue = []
+        self._counter = itertools.count()
+
+    def acquire(self, cost, priority=0):
+        """
+        :param priority: Lower values are admitted first.
+        :return: A future which resolves when the request is admitted.
+        """
+        future = Future()
+        heapq.heappush(self._queue, (priority, next(self._counter), cost, future))
+        self._admit()
+        return future
+
+    def release(self, cost):
+        self.used -= cost
+        self._admit()
+
+    def cancel(self, future):
+        """
+        Withdraws a request which gave up waiting.
+        """
+        if future.done():
+            self.release(future.result())
+            return
+        self._queue = [entry for entry in self._queue if entry[3] is not future]
+        heapq.heapify(self._queue)
+        self._admit()
+
+    def _admit(self):
+        while self._queue:
+            cost = self._queue[0][2]
+            if self.used and self.used + cost > self.budget:
+                break
+            future = heapq.heappop(self._queue)[3]
+            self.used += cost
+            future.set_result(cost)
+
+    def __len__(self):
+        return len(self._queue)
+
+
+_budget = None
+
+
+def get_pixel_budget(config):
+    """
+    Returns the process wide pixel budget, or None if admission control
+    is disabled.
+    :rtype: PixelBudget
+    """
+    global _budget
+    if not getattr(config, 'UNIVERSALIMAGES_PIXEL_BUDGET', 0):
+        return None
+    if _budget is None:
+        _budget = PixelBudget(config.UNIVERSALIMAGES_PIXEL_BUDGET)
+    return _budget
@@ -0,0 +1,26 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from thumbor.app import ThumborServiceApp
+from thumbor.handlers.imaging import ImagingHandler as ThumborImagingHandler
+
+from .handlers.imaging import ImagingHandler
+from .handlers.ladder import LadderHandler, URL_REGEX as LADDER_URL_REGEX
+
+
+class App(ThumborServiceApp):
+    """
+    Thumbor application with the universal images handlers.
+    Start thumbor with `thumbor --app=universalimages.app.App`.
+    """
+
+    def get_handlers(self):
+        handlers = []
+        for handler in super(App, self).get_handlers():
+            if handler[1] is ThumborImagingHandler:
+                # The imaging handler matches every URL. It has to be the last one.
+                handlers.append(
+                    (LADDER_URL_REGEX, LadderHandler, {'context': self.context}))
+                handler = (handler[0], ImagingHandler) + tuple(handler[2:])
+            handlers.append(handler)
+        return handlers
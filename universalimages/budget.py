@@ -0,0 +1,120 @@
+# coding: utf-8
+"""
+Latency budget of the RMD stage. The metadata of a request is read in a
+worker thread while the image is decoded. If it is not available within
+UNIVERSALIMAGES_RMD_BUDGET, the image is rendered without RMD and the crop
+plan is computed in the background for the next request of the url.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import datetime
+import time
+
+import tornado.gen as gen
+from concurrent.futures import ThreadPoolExecutor
+
+from .caches import get_cache
+from .plan import dump_plan, load_plan
+
+_executor = None
+
+
+def get_executor(config):
+    """
+    Returns the process wide executor which reads the metadata, or None
+    if the RMD stage has no budget.
+    :rtype: ThreadPoolExecutor
+    """
+    global _executor
+    if not getattr(config, 'UNIVERSALIMAGES_RMD_BUDGET', 0):
+        return None
+    if _executor is None:
+        _executor = ThreadPoolExecutor(config.UNIVERSALIMAGES_RMD_WORKERS)
+    return _executor
+
+
+class MetadataTask(object):
+    """
+    The metadata of an image, read in a worker thread. The budget covers the
+    wait for the metadata and the planning of the crop: the wait ends early
+    enough to leave room for the average planning time.
+    """
+
+    # Moving average of the planning time in seconds.
+    planning_time = 0.0
+
+    def __init__(self, future, budget):
+        """
+        :param future: Future of the metadata
+        :param budget: Budget in milliseconds, starting now
+        """
+        self.future = future
+        self.deadline = time.time() + budget / 1000.0
+
+    def remaining(self):
+        """
+        :return: The time left to wait for the metadata, in seconds.
+        """
+        return max(self.deadline - time.time() - MetadataTask.planning_time, 0)
+
+    @gen.coroutine
+    def wait(self):
+        """
+        Waits for the metadata on the IOLoop until the budget is exhausted.
+        :raises tornado.gen.TimeoutError: if the budget is exhausted.
+        """
+        metadata = yield gen.with_timeout(
+            datetime.timedelta(seconds=self.remaining()), self.future)
+        raise gen.Return(metadata)
+
+    def planned(self, seconds):
+        """
+        Records the planning time of the request.
+        Must be called from the IOLoop thread.
+        :return: True if the planning exceeded the budget.
+        """
+        MetadataTask.planning_time += (seconds - MetadataTask.planning_time) * 0.2
+        return time.time() > self.deadline
+
+
+@gen.coroutine
+def read_deferred_entry(context):
+    """
+    Reads the deferred plan entry of an rmd() request from the cache before
+    the image is loaded, so the engine does not block the IOLoop on it.
+    The entry is kept in request.rmd_deferred.
+    """
+    request = context.request
+    if get_executor(context.config) is None or 'rmd(' not in (request.filters or ''):
+        return
+    request.rmd_deferred = yield get_cache('deferred', context.config).get_async(request.url)
+
+
+def load_deferred_plan(entry, source_digest):
+    """
+    :return: dict with the crop plan ('plan', None if the image has no valid
+             RMD) and the focal point, or None if the entry is missing or stale.
+    """
+    if entry is None or entry['source'] != source_digest:
+        return None
+    return dict(entry, plan=load_plan(entry['plan']))
+
+
+def get_deferred_plan(config, url, source_digest):
+    """
+    Returns the plan computed in the background for the request url.
+    Blocks on the cache, use read_deferred_entry on the IOLoop.
+    """
+    return load_deferred_plan(get_cache('deferred', config).get(url), source_digest)
+
+
+def set_deferred_plan(config, url, source_digest, rmd_plan, focal_point=None):
+    """
+    Stores the plan computed in the background for the request url.
+    :param focal_point: The pivot point (x, y) if the detectors are bypassed.
+    """
+    get_cache('deferred', config).set_async(url, {
+        'source': source_digest,
+        'plan': dump_plan(rmd_plan),
+        'focal_point': list(focal_point) if focal_point else None,
+    })
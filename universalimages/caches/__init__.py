@@ -0,0 +1,109 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from importlib import import_module
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future, chain_future
+
+
+class BaseCache(object):
+    """
+    Interface of the caches used by the RMD pipeline.
+    Keys are strings, values must be serializable.
+
+    The IOLoop uses get_async and set_async. The operations of backends
+    which do disk or network I/O (blocking = True) then run on the cache
+    executor, the others run inline.
+    """
+
+    blocking = False
+    executor = None
+
+    @classmethod
+    def from_config(cls, name, config):
+        """
+        Creates the cache with the given name from the thumbor config.
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """
+        Returns the values of several keys, None for missing keys.
+        :rtype: list
+        """
+        return [self.get(key) for key in keys]
+
+    def set_many(self, values):
+        """
+        Stores several values at once.
+        :param values: dict of keys and values
+        """
+        for key, value in values.items():
+            self.set(key, value)
+
+    def get_async(self, key):
+        """
+        :return: A future of the value.
+        """
+        return self._run(self.get, key)
+
+    def set_async(self, key, value):
+        """
+        :return: A future which resolves when the value is stored. The backends
+                 log their errors, callers do not need to wait for it.
+        """
+        return self._run(self.set, key, value)
+
+    def _run(self, method, *args):
+        future = Future()
+        if self.executor is not None:
+            chain_future(self.executor.submit(method, *args), future)
+            return future
+        try:
+            future.set_result(method(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+_caches = {}
+_executor = None
+
+
+def get_backend(name, config=None):
+    """
+    Returns the backend module of the cache with the given name: its entry in
+    UNIVERSALIMAGES_CACHE_BACKENDS, else UNIVERSALIMAGES_CACHE_BACKEND.
+    """
+    backends = getattr(config, 'UNIVERSALIMAGES_CACHE_BACKENDS', None) or {}
+    return backends.get(name) or getattr(config, 'UNIVERSALIMAGES_CACHE_BACKEND', None) or \
+        'universalimages.caches.memory'
+
+
+def get_cache(name, config=None):
+    """
+    Returns the process wide cache with the given name.
+    :param name: Name of the cache, e.g. 'aliases'.
+    :param config: The thumbor config.
+    :rtype: BaseCache
+    """
+    global _executor
+    if name not in _caches:
+        cache = import_module(get_backend(name, config)).Cache.from_config(name, config)
+        if cache.blocking:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    getattr(config, 'UNIVERSALIMAGES_CACHE_THREADS', None) or 4)
+            cache.executor = _executor
+        _caches[name] = cache
+    return _caches[name]
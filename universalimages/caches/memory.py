@@ -0,0 +1,45 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from collections import OrderedDict
+from threading import Lock
+
+from . import BaseCache
+
+
+class Cache(BaseCache):
+    """
+    Bounded in-process LRU cache.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(getattr(config, 'UNIVERSALIMAGES_CACHE_SIZE', None) or 10000)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
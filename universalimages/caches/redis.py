@@ -0,0 +1,176 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import json
+import logging
+import socket
+import threading
+
+from . import BaseCache
+
+logger = logging.getLogger('universalimages.caches')
+
+
+class RedisError(Exception):
+    pass
+
+
+class Connection(object):
+    """
+    Minimal client for the Redis protocol (RESP). Sends pipelined commands
+    over a single socket and reads their replies.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=0.1):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._socket = None
+        self._file = None
+
+    def connect(self):
+        self._socket = socket.create_connection((self.host, self.port), self.timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile('rb')
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        if commands:
+            self._execute(commands)
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._file.close()
+                self._socket.close()
+            except socket.error:
+                pass
+        self._socket = self._file = None
+
+    def execute(self, *commands):
+        """
+        Sends the commands in one round trip.
+        :param commands: tuples of command name and arguments
+        :return: The replies in the order of the commands.
+        :rtype: list
+        """
+        if self._socket is None:
+            self.connect()
+        try:
+            return self._execute(commands)
+        except (socket.error, RedisError, ValueError):
+            # The connection is in an unknown state.
+            self.close()
+            raise
+
+    def _execute(self, commands):
+        self._socket.sendall(b''.join(self.encode(command) for command in commands))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    @staticmethod
+    def encode(command):
+        parts = [('*%d\r\n' % len(command)).encode('ascii')]
+        for argument in command:
+            if not isinstance(argument, bytes):
+                argument = ('%s' % argument).encode('utf-8')
+            parts.append(('$%d\r\n' % len(argument)).encode('ascii'))
+            parts.append(argument)
+            parts.append(b'\r\n')
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise socket.error('Connection closed by the Redis server')
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value
+        if kind == b'-':
+            return RedisError(value.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            length = int(value)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(value)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError('Invalid reply: %r' % line)
+
+
+class Cache(BaseCache):
+    """
+    Cache in a Redis server, shared by all thumbor processes of a fleet.
+    Errors are logged and treated as cache misses.
+    """
+
+    blocking = True
+
+    def __init__(self, name, connection, ttl=86400):
+        self.name = name
+        self.connection = connection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(name, Connection(
+            config.UNIVERSALIMAGES_CACHE_REDIS_HOST,
+            config.UNIVERSALIMAGES_CACHE_REDIS_PORT,
+            config.UNIVERSALIMAGES_CACHE_REDIS_DB,
+            config.UNIVERSALIMAGES_CACHE_REDIS_PASSWORD,
+            config.UNIVERSALIMAGES_CACHE_REDIS_TIMEOUT), config.UNIVERSALIMAGES_CACHE_TTL)
+
+    def _key(self, key):
+        return 'universalimages:%s:%s' % (self.name, key)
+
+    def _execute(self, *commands):
+        with self._lock:
+            try:
+                return self.connection.execute(*commands)
+            except (socket.error, RedisError, ValueError) as e:
+                logger.error('Redis cache error: %s' % e)
+                return None
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        replies = self._execute(('MGET',) + tuple(self._key(key) for key in keys))
+        if replies is None:
+            return [None] * len(keys)
+        return [json.loads(value.decode('utf-8')) if value is not None else None
+                for value in replies[0]]
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        if not values:
+            return
+        commands = []
+        for key, value in values.items():
+            command = ('SET', self._key(key), json.dumps(value))
+            if self.ttl:
+                command += ('EX', self.ttl)
+            commands.append(command)
+        self._execute(*commands)
+
+    def delete(self, key):
+        self._execute(('DEL', self._key(key)))
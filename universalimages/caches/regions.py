@@ -0,0 +1,200 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import copy
+import os
+import time
+from collections import OrderedDict
+from os.path import abspath, join
+from threading import Lock
+
+from ..plan import snap_box
+
+# Bytes per pixel of the PIL image modes.
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'RGB': 3, 'YCbCr': 3, 'LAB': 3,
+              'HSV': 3, 'RGBA': 4, 'CMYK': 4, 'I': 4, 'F': 4}
+
+# Attributes of a cached engine which are copied into the engine of a request.
+ENGINE_ATTRIBUTES = ('image', 'extension', 'icc_profile', 'exif', 'subsampling',
+                     'qtables', 'original_mode', 'source_width', 'source_height',
+                     'source_digest')
+
+FILE_LOADERS = ('thumbor.loaders.file_loader', 'thumbor.loaders.file_loader_http_fallback')
+
+
+def pixel_bytes(image):
+    width, height = image.size
+    return width * height * MODE_BYTES.get(image.mode, 4)
+
+
+class RegionCache(object):
+    """
+    Bounded in-process cache of decoded image regions.
+
+    A region is the crop box of a request, extended to a coarse grid, cut out
+    of the decoded source image. Requests whose crop box lies inside a cached
+    region are rendered from it without loading and decoding the source.
+    Entries are evicted in LRU order when the total size of their pixels
+    exceeds max_bytes. An entry is dropped when it is older than ttl or when
+    the validator of its source (see source_validator) changed.
+    """
+
+    def __init__(self, max_bytes, grid=64, min_requests=2, ttl=600, max_sources=10000):
+        self.max_bytes = max_bytes
+        self.grid = grid
+        self.min_requests = min_requests
+        self.ttl = ttl
+        self.max_sources = max_sources
+        self.size = 0
+        self._regions = OrderedDict()  # (source, box) -> (engine, bytes, time, validator)
+        self._sources = {}  # source -> set of boxes
+        self._requests = OrderedDict()  # source -> number of requests
+        self._lock = Lock()
+
+    def admit(self, source):
+        """
+        Counts a request of the source and returns True once the source is
+        requested often enough to be cached.
+        """
+        with self._lock:
+            count = self._requests.pop(source, 0) + 1
+            self._requests[source] = count
+            while len(self._requests) > self.max_sources:
+                self._requests.popitem(last=False)
+            return count >= self.min_requests
+
+    def get(self, source, box, validator=None):
+        """
+        Returns the smallest cached region of source which contains box.
+        :param validator: The current validator of the source.
+        :return: (region box, engine) or None
+        """
+        now = time.time()
+        with self._lock:
+            best = None
+            for region_box in list(self._sources.get(source, ())):
+                key = (source, region_box)
+                if now - self._regions[key][2] > self.ttl or \
+                        self._regions[key][3] != validator:
+                    self._remove(key)
+                    continue
+                if (region_box[0] <= box[0] and region_box[1] <= box[1] and
+                        region_box[2] >= box[2] and region_box[3] >= box[3]):
+                    if best is None or self._regions[key][1] < self._regions[best][1]:
+                        best = key
+            if best is None:
+                return None
+            entry = self._regions.pop(best)
+            self._regions[best] = entry
+            return best[1], entry[0]
+
+    def put(self, source, box, engine, validator=None):
+        """
+        Cuts the region of box, extended to the grid, out of the decoded image
+        of engine and stores it. The pixels are copied once, the other
+        attributes of the engine (format, EXIF, ICC profile) are shared.
+        :param validator: The validator of the source the engine was loaded from.
+        :return: The box of the region or None if it is too large.
+        """
+        region_box = snap_box(box, self.grid, engine.size)
+        template = copy.copy(engine)
+        template.context = None
+        template.metadata = None
+        template.image = engine.image.crop(region_box)
+        size = pixel_bytes(template.image)
+        if size > self.max_bytes:
+            return None
+        with self._lock:
+            key = (source, region_box)
+            self._remove(key)
+            self._regions[key] = (template, size, time.time(), validator)
+            self._sources.setdefault(source, set()).add(region_box)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._regions)))
+        return region_box
+
+    @staticmethod
+    def restore(template, engine):
+        """
+        Copies the decoded region and the attributes needed to encode it from
+        a cached engine into the engine of a request.
+        """
+        for name in ENGINE_ATTRIBUTES:
+            if hasattr(template, name):
+                setattr(engine, name, getattr(template, name))
+
+    def delete(self, source):
+        with self._lock:
+            for region_box in list(self._sources.get(source, ())):
+                self._remove((source, region_box))
+
+    def _remove(self, key):
+        entry = self._regions.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        boxes = self._sources[key[0]]
+        boxes.discard(key[1])
+        if not boxes:
+            del self._sources[key[0]]
+
+    def __len__(self):
+        return len(self._regions)
+
+
+_cache = None
+
+
+def get_region_cache(config):
+    """
+    Returns the process wide region cache, or None if it is disabled.
+    :rtype: RegionCache
+    """
+    global _cache
+    max_bytes = getattr(config, 'UNIVERSALIMAGES_REGION_CACHE_SIZE', 0)
+    if not max_bytes:
+        return None
+    if _cache is None:
+        _cache = RegionCache(
+            max_bytes, config.UNIVERSALIMAGES_REGION_CACHE_GRID,
+            config.UNIVERSALIMAGES_REGION_CACHE_MIN_REQUESTS,
+            config.UNIVERSALIMAGES_REGION_CACHE_TTL,
+            config.UNIVERSALIMAGES_CACHE_SIZE)
+    return _cache
+
+
+def source_validator(context):
+    """
+    Returns the size and modification time of the source file of the request,
+    if it is loaded by thumbor's file loader. Other sources are validated by
+    the digest of the source when it was last loaded.
+    :return: The validator or None.
+    """
+    conf = context.config
+    if getattr(context.modules.loader, '__name__', None) not in FILE_LOADERS:
+        return None
+    path = abspath(join(conf.FILE_LOADER_ROOT_PATH.rstrip('/'),
+                        context.request.image_url.lstrip('/')))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return '%d:%r' % (stat.st_size, stat.st_mtime)
+
+
+def can_use_region(context, engine):
+    """
+    Checks if the request can be rendered from a region of the source image.
+    Smart detection and trimming need the whole image. Debug overlays are
+    neither served from nor stored in the cache.
+    """
+    request = context.request
+    if request.smart or request.trim or request.meta or getattr(request, 'debug', False):
+        return False
+    if engine.extension == '.gif' or engine.is_multiple():
+        return False
+    if context.config.RESPECT_ORIENTATION and engine.get_orientation() not in (None, 1):
+        # The crop boxes refer to the rotated image.
+        return False
+    return True
@@ -0,0 +1,118 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import BaseCache
+
+logger = logging.getLogger('universalimages.caches')
+
+# Number of writes between two purges of the expired entries.
+PURGE_INTERVAL = 1000
+
+
+class Cache(BaseCache):
+    """
+    Cache in a local SQLite database in WAL mode. All thumbor processes of
+    a host which use the same file share the entries.
+    """
+
+    blocking = True
+
+    def __init__(self, name, path, ttl=86400, timeout=5):
+        self.name = name
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS universalimages_cache ('
+            'name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'expires REAL NOT NULL, PRIMARY KEY (name, key))')
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(name, config.UNIVERSALIMAGES_CACHE_SQLITE_PATH,
+                   config.UNIVERSALIMAGES_CACHE_TTL)
+
+    @property
+    def connection(self):
+        # SQLite connections can not be shared between threads.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _expires(self):
+        return time.time() + self.ttl if self.ttl else float('inf')
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        try:
+            rows = self.connection.execute(
+                'SELECT key, value FROM universalimages_cache WHERE name = ? AND '
+                'expires > ? AND key IN (%s)' % ', '.join('?' * len(keys)),
+                [self.name, time.time()] + keys).fetchall()
+        except sqlite3.Error as e:
+            logger.error('Could not read from the cache %s: %s' % (self.path, e))
+            return [None] * len(keys)
+        values = dict((key, json.loads(value)) for key, value in rows)
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        expires = self._expires()
+        rows = [(self.name, key, json.dumps(value), expires)
+                for key, value in values.items()]
+        connection = self.connection
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO universalimages_cache '
+                    '(name, key, value, expires) VALUES (?, ?, ?, ?)', rows)
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.error('Could not write to the cache %s: %s' % (self.path, e))
+            return
+        self._writes += len(rows)
+        if self._writes >= PURGE_INTERVAL:
+            self._writes = 0
+            self.purge()
+
+    def delete(self, key):
+        try:
+            self.connection.execute(
+                'DELETE FROM universalimages_cache WHERE name = ? AND key = ?',
+                (self.name, key))
+        except sqlite3.Error as e:
+            logger.error('Could not write to the cache %s: %s' % (self.path, e))
+
+    def purge(self):
+        """
+        Removes the expired entries.
+        """
+        try:
+            self.connection.execute(
+                'DELETE FROM universalimages_cache WHERE expires <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            logger.error('Could not purge the cache %s: %s' % (self.path, e))
@@ -0,0 +1,85 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import logging
+from datetime import timedelta
+
+import tornado.gen as gen
+from tornado.concurrent import Future
+
+logger = logging.getLogger('universalimages.coalescing')
+
+
+class FlightError(Exception):
+    """
+    Raised in the waiting requests if the leading request failed.
+    """
+
+    def __init__(self, status):
+        super(FlightError, self).__init__('Coalesced request failed with status %s' % status)
+        self.status = status
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical requests. The first request for a key
+    (the leader) does the work, all the other requests wait for its result.
+
+    The instance must only be used from the IOLoop thread.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._waiting = {}
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    def __len__(self):
+        return len(self._flights)
+
+    def lead(self, key):
+        """
+        Registers the caller for the given key.
+        :return: True if the caller is the leader and has to do the work.
+        :rtype: Boolean
+        """
+        if key in self._flights:
+            self._waiting[key] += 1
+            return False
+        self._flights[key] = Future()
+        self._waiting[key] = 0
+        return True
+
+    @gen.coroutine
+    def wait(self, key, timeout=None):
+        """
+        Waits for the result of the leader. Only to be called after lead()
+        returned False for the same key.
+        :param timeout: Maximum time to wait in seconds.
+        :raises: gen.TimeoutError if the leader took too long,
+                 FlightError if the leader failed.
+        """
+        future = self._flights[key]
+        if timeout:
+            result = yield gen.with_timeout(timedelta(seconds=timeout), future)
+        else:
+            result = yield future
+        raise gen.Return(result)
+
+    def resolve(self, key, result):
+        """
+        Passes the result of the leader to all waiting requests.
+        """
+        future = self._flights.pop(key, None)
+        self._waiting.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def reject(self, key, error):
+        """
+        Passes the error of the leader to all waiting requests.
+        """
+        future = self._flights.pop(key, None)
+        if self._waiting.pop(key, 0) and not future.done():
+            future.set_exception(error)
@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger('universalimages.commands')
+
+
+def imap_bounded(pool, func, items, window=1000):
+    """
+    Like Pool.imap, but never has more than `window` items in flight.
+    Pool.imap consumes the whole input iterable up front, which does not
+    work for millions of items.
+    :return: The results in the order of the items.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class Progress(object):
+    """
+    Reports the throughput in regular intervals.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.started = self.reported = time.time()
+        self.processed = 0
+        self.with_rmd = 0
+        self.derivatives = 0
+
+    def update(self, with_rmd, derivatives=0):
+        self.processed += 1
+        self.derivatives += derivatives
+        if with_rmd:
+            self.with_rmd += 1
+        now = time.time()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            logger.info(self.summary())
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        summary = '%d files processed (%d with RMD) in %.1fs, %.1f files/s' % (
+            self.processed, self.with_rmd, elapsed, self.processed / elapsed)
+        if self.derivatives:
+            summary += ', %d derivatives (%.1f/s)' % (
+                self.derivatives, self.derivatives / elapsed)
+        return summary
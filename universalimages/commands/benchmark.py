@@ -0,0 +1,344 @@
+# coding: utf-8
+"""
+Benchmarks of the rmd() pipeline: metadata parsing, crop planning and end
+to end rendering. Results are stored as JSON, keyed by a fingerprint of the
+machine, and compared with noise aware thresholds.
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+from .precompute import walk
+from ..plan import parse_ladder
+
+logger = logging.getLogger('universalimages.commands')
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff')
+
+
+def cpu_model():
+    try:
+        with io.open('/proc/cpuinfo', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except (IOError, OSError):
+        pass
+    return platform.processor()
+
+
+def fingerprint():
+    """
+    Describes the machine and the software the benchmarks ran on. The key
+    only depends on the hardware and the Python version, so the results of
+    different library versions can be compared.
+    :return: (key, description)
+    """
+    machine = {
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu': cpu_model(),
+        'cpus': multiprocessing.cpu_count(),
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+    }
+    key = hashlib.sha1(json.dumps(machine, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    description = dict(machine)
+    for module in ('PIL', 'thumbor', 'pyexiv2'):
+        try:
+            description[module] = getattr(__import__(module), '__version__', 'unknown')
+        except ImportError:
+            description[module] = None
+    return key, description
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def mad(values):
+    """
+    Median absolute deviation, a noise estimate which ignores outliers.
+    """
+    center = median(values)
+    return median([abs(value - center) for value in values])
+
+
+def measure(operation, rounds=7, min_time=0.2):
+    """
+    Runs the operation in rounds of at least min_time seconds.
+    :return: The seconds per operation of each round.
+    """
+    def run(number):
+        start = time.time()
+        for _ in range(number):
+            operation()
+        return time.time() - start
+
+    number = 1
+    elapsed = run(number)
+    while elapsed < min_time:
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-6) * 1.1))
+        elapsed = run(number)
+    samples = [elapsed / number]
+    samples += [run(number) / number for _ in range(rounds - 1)]
+    return samples
+
+
+def load_sources(root, limit=None):
+    sources = []
+    for path in walk(root):
+        if path.lower().endswith(IMAGE_SUFFIXES):
+            with io.open(os.path.join(root, path), 'rb') as f:
+                sources.append((path, f.read()))
+            if limit and len(sources) >= limit:
+                break
+    return sources
+
+
+def metadata_benchmarks(sources, ladder, config):
+    from ..filters.xmp.reader import extract_xmp, read_rmd
+
+    def extract():
+        for path, buffer in sources:
+            extract_xmp(buffer)
+
+    def parse():
+        for path, buffer in sources:
+            read_rmd(buffer)
+
+    return [('metadata.extract', extract), ('metadata.parse', parse)]
+
+
+def planning_benchmarks(sources, ladder, config):
+    from ..admission import image_size
+    from ..filters.xmp.reader import read_rmd
+    from ..planner import compute_plan
+    from ..rmd_index import RmdDocument
+
+    documents = [(path, RmdDocument(read_rmd(buffer)), image_size(buffer))
+                 for path, buffer in sources]
+    documents = [entry for entry in documents if entry[1].xmp_keys and entry[2]]
+
+    def plan():
+        for path, document, size in documents:
+            for width, height in ladder:
+                compute_plan(document, size, width, height, source=path, config=config)
+
+    return [('planning.filter', plan)]
+
+
+def compiled_benchmarks(sources, ladder, config):
+    from ..admission import image_size
+    from ..compiler import compile_rmd
+    from ..filters.xmp.reader import read_rmd
+    from ..filters.xmp.v01 import Xmp_API
+    from ..rmd_index import RmdDocument
+
+    functions = []
+    for path, buffer in sources:
+        document, size = RmdDocument(read_rmd(buffer)), image_size(buffer)
+        if document.xmp_keys and size:
+            function = compile_rmd(Xmp_API(document), size)
+            if function is not None:
+                functions.append(function)
+
+    def compiled():
+        for function in functions:
+            for width, height in ladder:
+                function.evaluate(width)
+
+    return [('planning.compiled', compiled)]
+
+
+def render_benchmarks(sources, ladder, config):
+    from thumbor.importer import Importer
+
+    from ..ladder import create_context, load_master, render
+
+    importer = Importer(config)
+    importer.import_modules()
+
+    def end_to_end():
+        for path, buffer in sources:
+            for width, height in ladder:
+                context = create_context(config, importer, path, width, height)
+                render(load_master(context, buffer), context)
+
+    return [('render.end_to_end', end_to_end)]
+
+
+BENCHMARKS = [metadata_benchmarks, planning_benchmarks, compiled_benchmarks,
+              render_benchmarks]
+
+
+def run_benchmarks(sources, ladder, config, rounds=7, min_time=0.2, selected=None):
+    """
+    :param selected: Prefixes of the benchmarks to run, e.g. ['metadata'].
+    :return: The result document.
+    :rtype: dict
+    """
+    key, description = fingerprint()
+    results = {}
+    for factory in BENCHMARKS:
+        try:
+            benchmarks = factory(sources, ladder, config)
+        except Exception as e:
+            logger.warning('Skipping %s: %s' % (factory.__name__, e))
+            continue
+        for name, operation in benchmarks:
+            if selected and not any(name.startswith(prefix) for prefix in selected):
+                continue
+            samples = measure(operation, rounds, min_time)
+            results[name] = {'median': median(samples), 'mad': mad(samples),
+                             'samples': samples}
+            logger.info('%s: %.3fms' % (name, results[name]['median'] * 1000))
+    return {
+        'fingerprint': key,
+        'machine': description,
+        'time': time.time(),
+        'sources': len(sources),
+        'ladder': [list(size) for size in ladder],
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, threshold=0.05, noise=3.0):
+    """
+    Compares two result documents. A change is significant if it exceeds
+    the relative threshold and noise times the combined MAD of both runs.
+    :return: List of (name, baseline median, current median, relative delta,
+             status), status is 'slower', 'faster', 'same', 'new' or 'missing'.
+    """
+    rows = []
+    names = sorted(set(baseline['benchmarks']) | set(current['benchmarks']))
+    for name in names:
+        old = baseline['benchmarks'].get(name)
+        new = current['benchmarks'].get(name)
+        if old is None or new is None:
+            rows.append((name, old and old['median'], new and new['median'], None,
+                         'new' if old is None else 'missing'))
+            continue
+        delta = new['median'] - old['median']
+        relative = delta / old['median'] if old['median'] else 0.0
+        limit = max(threshold * old['median'], noise * math.sqrt(old['mad'] ** 2 + new['mad'] ** 2))
+        if abs(delta) <= limit:
+            status = 'same'
+        else:
+            status = 'slower' if delta > 0 else 'faster'
+        rows.append((name, old['median'], new['median'], relative, status))
+    return rows
+
+
+def format_comparison(rows):
+    lines = []
+    for name, old, new, relative, status in rows:
+        lines.append('%-24s %10s %10s %8s  %s' % (
+            name,
+            '%.3fms' % (old * 1000) if old is not None else '-',
+            '%.3fms' % (new * 1000) if new is not None else '-',
+            '%+.1f%%' % (relative * 100) if relative is not None else '-',
+            status))
+    return '\n'.join(lines)
+
+
+def read_result(path, key=None):
+    """
+    Reads a result document. If path is a directory, the baseline of the
+    machine with the given fingerprint key is read.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, '%s.json' % key)
+    with io.open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def write_result(path, result):
+    if os.path.isdir(path):
+        path = os.path.join(path, '%s.json' % result['fingerprint'])
+    with io.open(path, 'wb') as f:
+        f.write(json.dumps(result, sort_keys=True, indent=2).encode('utf-8'))
+    return path
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Runs the rmd() benchmarks and compares them with a baseline.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Runs the benchmarks.')
+    run_parser.add_argument('root', help='Directory with the benchmark images.')
+    run_parser.add_argument('-c', '--conf', default=None, help='Path to thumbor.conf.')
+    run_parser.add_argument('-l', '--ladder', default='320,640,1024,400x400',
+                            help='Target sizes [default: %(default)s].')
+    run_parser.add_argument('-n', '--limit', type=int, default=None,
+                            help='Maximum number of images.')
+    run_parser.add_argument('-b', '--benchmark', action='append', default=None,
+                            help='Only run benchmarks with this prefix, e.g. metadata.')
+    run_parser.add_argument('-r', '--rounds', type=int, default=7,
+                            help='Number of rounds [default: %(default)s].')
+    run_parser.add_argument('-t', '--min-time', type=float, default=0.2,
+                            help='Minimum seconds per round [default: %(default)s].')
+    run_parser.add_argument('-o', '--output', default=None,
+                            help='Result file, or a baseline directory in which the result '
+                                 'is stored under the fingerprint of the machine.')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compares a result with a baseline. Exits with status 1 '
+                        'if a benchmark is significantly slower.')
+    compare_parser.add_argument('baseline', help='Baseline file or directory.')
+    compare_parser.add_argument('current', help='Result file.')
+    compare_parser.add_argument('--threshold', type=float, default=0.05,
+                                help='Minimum relative change [default: %(default)s].')
+    compare_parser.add_argument('--noise', type=float, default=3.0,
+                                help='Minimum change in multiples of the combined MAD '
+                                     '[default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if options.command == 'run':
+        from thumbor.config import Config
+        from .. import config  # NOQA
+
+        conf = Config.load(options.conf) if options.conf else Config()
+        sources = load_sources(options.root, options.limit)
+        if not sources:
+            parser.error('No images found in %s.' % options.root)
+        result = run_benchmarks(sources, parse_ladder(options.ladder.split(',')), conf,
+                                options.rounds, options.min_time, options.benchmark)
+        if options.output:
+            logger.info('Results written to %s' % write_result(options.output, result))
+        else:
+            print(json.dumps(result, sort_keys=True, indent=2))
+        return 0
+
+    if options.command == 'compare':
+        current = read_result(options.current)
+        baseline = read_result(options.baseline, current['fingerprint'])
+        if baseline['fingerprint'] != current['fingerprint']:
+            logger.warning('The results are from different machines (%s, %s).' % (
+                baseline['fingerprint'], current['fingerprint']))
+        rows = compare(baseline, current, options.threshold, options.noise)
+        print(format_comparison(rows))
+        return 1 if any(row[4] == 'slower' for row in rows) else 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import io
+import json
+import logging
+import sys
+
+from ..plan import parse_ladder
+from ..rmd_index import write_index
+
+logger = logging.getLogger('universalimages.commands')
+
+
+def read_entries(index_paths):
+    """
+    Reads the entries of universalimages-precompute index files.
+    Later entries of the same source replace earlier ones.
+    :rtype: list
+    """
+    entries = {}
+    for index_path in index_paths:
+        with io.open(index_path, 'rb') as index:
+            for line in index:
+                if line.strip():
+                    entry = json.loads(line.decode('utf-8'))
+                    entries[entry['source']] = entry
+    return list(entries.values())
+
+
+def ladder_of(entries):
+    """
+    Returns all target sizes which have a plan in the entries.
+    """
+    targets = set()
+    for entry in entries:
+        targets.update(entry.get('plans') or ())
+    return sorted(parse_ladder(targets))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Builds the memory mapped RMD index from universalimages-precompute '
+                    'index files. An existing index is replaced atomically.')
+    parser.add_argument('sources', nargs='+', help='universalimages-precompute index files.')
+    parser.add_argument('-o', '--output', default='rmd.index',
+                        help='Index file [default: %(default)s].')
+    parser.add_argument('-l', '--ladder', default=None,
+                        help='Comma separated target sizes of the stored plans, '
+                             'e.g. 320,640,800x600. Defaults to all sizes in the sources.')
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    entries = read_entries(options.sources)
+    if options.ladder:
+        ladder = parse_ladder(options.ladder.split(','))
+    else:
+        ladder = ladder_of(entries)
+    count = write_index(options.output, entries, ladder)
+    print('%d sources, %d sizes written to %s' % (count, len(ladder), options.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+# coding: utf-8
+"""
+Offline load test of the rmd() pipeline. Starts a local thumbor server with
+the universal images app and the file loader, replays a URL log or a Zipf
+distributed workload over the images of a directory, and reports the
+throughput, the latency percentiles, the cache hit ratios and the RSS of
+the server over time.
+"""
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import bisect
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from .precompute import walk
+from ..plan import parse_ladder
+
+logger = logging.getLogger('universalimages.commands')
+
+LOG_LINE_RE = re.compile(r'"(?:GET|HEAD) (\S+)')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff', '.gif')
+
+# Hit ratios reported from the metrics of the server: name -> (hits, misses or total)
+HIT_RATIOS = [
+    ('result_storage', 'result_storage.hit', 'result_storage.miss'),
+    ('storage', 'storage.hit', 'storage.miss'),
+    ('coalescing', 'universalimages.coalescing.hit', 'universalimages.coalescing.wait'),
+]
+# Counters reported per request
+REQUEST_RATIOS = [
+    ('region', 'universalimages.region.hit'),
+    ('not_modified', 'universalimages.etag.not_modified'),
+    ('detectors_bypassed', 'universalimages.detectors.bypassed'),
+    ('rmd_budget_exceeded', 'universalimages.rmd.budget_exceeded'),
+]
+
+
+def read_log(lines):
+    """
+    Yields the URL paths of an access log. Lines are either paths or
+    contain a quoted request line ('"GET /path HTTP/1.1"').
+    """
+    for line in lines:
+        line = line.strip()
+        match = LOG_LINE_RE.search(line)
+        if match:
+            yield match.group(1)
+        elif line.startswith('/'):
+            yield line.split()[0]
+
+
+def zipf_workload(sources, ladder, count, exponent=1.1, seed=0):
+    """
+    Yields count rmd() URL paths. The popularity of the sources follows a
+    Zipf distribution, the sizes are uniformly distributed over the ladder.
+    """
+    rng = random.Random(seed)
+    sources = list(sources)
+    rng.shuffle(sources)
+    cumulative = []
+    total = 0.0
+    for rank in range(1, len(sources) + 1):
+        total += 1.0 / rank ** exponent
+        cumulative.append(total)
+    for _ in range(count):
+        source = sources[bisect.bisect_left(cumulative, rng.random() * total)]
+        width, height = rng.choice(ladder)
+        yield '/unsafe/%sx%s/filters:rmd()/%s' % (width, height, source)
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    index = max(int(math.ceil(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def hit_ratios(counters, requests):
+    """
+    Computes the cache hit ratios from the metric counters of the server.
+    :return: dict of name -> ratio, or None without lookups.
+    """
+    ratios = {}
+    for name, hits, misses in HIT_RATIOS:
+        if name == 'coalescing':
+            lookups = requests
+        else:
+            lookups = counters.get(hits, 0) + counters.get(misses, 0)
+        ratios[name] = float(counters.get(hits, 0)) / lookups if lookups else None
+    for name, hits in REQUEST_RATIOS:
+        ratios[name] = float(counters.get(hits, 0)) / requests if requests else None
+    return ratios
+
+
+def read_rss(pid):
+    """
+    Returns the resident set size of a process in bytes (Linux only).
+    """
+    try:
+        with io.open('/proc/%d/status' % pid, encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def write_config(path, root, metrics_path, config_path=None):
+    """
+    Writes the thumbor.conf of the server: the given config with the file
+    loader, the universal images engine and the in-process metrics.
+    """
+    lines = []
+    if config_path:
+        with io.open(config_path, encoding='utf-8') as f:
+            lines.append(f.read())
+    lines += [
+        '',
+        'LOADER = %r' % str('thumbor.loaders.file_loader'),
+        'FILE_LOADER_ROOT_PATH = %r' % str(root),
+        'ENGINE = %r' % str('universalimages.engines.pil'),
+        'METRICS = %r' % str('universalimages.metrics'),
+        'UNIVERSALIMAGES_METRICS_PATH = %r' % str(metrics_path),
+        'ALLOW_UNSAFE_URL = True',
+        '',
+    ]
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+
+class Server(object):
+    """
+    A thumbor server with the universal images app in a child process.
+    """
+
+    def __init__(self, root, config_path=None, log_level='error'):
+        self.directory = tempfile.mkdtemp(prefix='universalimages-loadtest-')
+        self.metrics_path = os.path.join(self.directory, 'metrics.json')
+        self.config_path = os.path.join(self.directory, 'thumbor.conf')
+        write_config(self.config_path, os.path.abspath(root), self.metrics_path, config_path)
+        self.port = free_port()
+        self.process = subprocess.Popen([
+            sys.executable, '-c', 'from thumbor.server import main; main()',
+            '-p', str(self.port), '-i', '127.0.0.1', '-c', self.config_path,
+            '-l', log_level, '-a', 'universalimages.app.App'])
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def wait(self, timeout=30):
+        """
+        Waits until the server accepts connections.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('thumbor exited with status %d' % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError('thumbor did not start within %d seconds' % timeout)
+
+    def rss(self):
+        return read_rss(self.process.pid)
+
+    def stop(self):
+        """
+        Stops the server and returns its metrics.
+        """
+        if self.process.poll() is None:
+            # thumbor exits cleanly on SIGINT, the metrics are written at exit.
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait()
+            except KeyboardInterrupt:
+                self.process.kill()
+        try:
+            with io.open(self.metrics_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'counters': {}, 'timings': {}}
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def replay(base_url, urls, concurrency=8, interval=1.0, rss=None):
+    """
+    Requests the URLs with the given number of concurrent clients.
+    :param rss: Function which returns the RSS of the server.
+    :return: dict with the latencies in seconds, the status counts, the
+             elapsed time and the RSS samples (seconds, bytes).
+    """
+    from tornado import gen
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.ioloop import IOLoop, PeriodicCallback
+
+    client = AsyncHTTPClient(max_clients=concurrency)
+    urls = iter(urls)
+    latencies = []
+    statuses = {}
+    samples = []
+    started = time.time()
+
+    def sample():
+        if rss is not None:
+            samples.append((round(time.time() - started, 3), rss()))
+
+    @gen.coroutine
+    def worker():
+        for url in urls:
+            start = time.time()
+            try:
+                response = yield client.fetch(base_url + url, raise_error=False)
+                code = response.code
+            except Exception as e:
+                logger.warning('Request of %s failed: %s' % (url, e))
+                code = 599
+            latencies.append(time.time() - start)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    @gen.coroutine
+    def run():
+        yield [worker() for _ in range(concurrency)]
+
+    sample()
+    sampler = PeriodicCallback(sample, interval * 1000)
+    sampler.start()
+    try:
+        IOLoop.current().run_sync(run)
+    finally:
+        sampler.stop()
+    elapsed = time.time() - started
+    sample()
+    return {'latencies': latencies, 'statuses': statuses, 'elapsed': elapsed,
+            'rss': samples}
+
+
+def report(result, metrics):
+    """
+    Summarizes a replay and the metrics of the server.
+    :rtype: dict
+    """
+    latencies = sorted(result['latencies'])
+    requests = len(latencies)
+    rss = [value for _, value in result['rss'] if value]
+    return {
+        'requests': requests,
+        'elapsed': result['elapsed'],
+        'throughput': requests / result['elapsed'] if result['elapsed'] else None,
+        'statuses': dict((str(code), count) for code, count in result['statuses'].items()),
+        'latency': dict(('p%d' % (fraction * 100), percentile(latencies, fraction))
+                        for fraction in (0.5, 0.95, 0.99)),
+        'hit_ratios': hit_ratios(metrics.get('counters', {}), requests),
+        'rss': result['rss'],
+        'max_rss': max(rss) if rss else None,
+        'counters': metrics.get('counters', {}),
+    }
+
+
+def format_report(summary):
+    lines = ['%d requests in %.1fs, %.1f requests/s' % (
+        summary['requests'], summary['elapsed'], summary['throughput'] or 0)]
+    lines.append('status: %s' % ', '.join(
+        '%s: %d' % item for item in sorted(summary['statuses'].items())))
+    lines.append('latency: %s' % ', '.join(
+        '%s %.1fms' % (name, value * 1000)
+        for name, value in sorted(summary['latency'].items()) if value is not None))
+    lines.append('hit ratios: %s' % ', '.join(
+        '%s %.1f%%' % (name, ratio * 100)
+        for name, ratio in sorted(summary['hit_ratios'].items()) if ratio is not None))
+    if summary['max_rss']:
+        lines.append('rss: max %.1f MB, %s' % (summary['max_rss'] / 1048576.0, ' '.join(
+            '%gs:%.0fMB' % (seconds, value / 1048576.0)
+            for seconds, value in summary['rss'] if value)))
+    return '\n'.join(lines)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Replays rmd() requests against a local thumbor server and reports '
+                    'throughput, latency percentiles, cache hit ratios and RSS.')
+    parser.add_argument('root', help='Directory of the source images (FILE_LOADER_ROOT_PATH).')
+    parser.add_argument('-c', '--conf', default=None,
+                        help='Path to a thumbor.conf with the options under test.')
+    parser.add_argument('--log', default=None,
+                        help="Access log or list of URL paths to replay. '-' reads stdin. "
+                             'Without a log, a Zipf distributed workload is generated.')
+    parser.add_argument('-n', '--requests', type=int, default=1000,
+                        help='Number of requests [default: %(default)s].')
+    parser.add_argument('-l', '--ladder', default='320,480,640,800,1024,1280',
+                        help='Target sizes of the generated workload [default: %(default)s].')
+    parser.add_argument('-s', '--exponent', type=float, default=1.1,
+                        help='Zipf exponent of the generated workload [default: %(default)s].')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated workload [default: %(default)s].')
+    parser.add_argument('-k', '--concurrency', type=int, default=8,
+                        help='Number of concurrent clients [default: %(default)s].')
+    parser.add_argument('-i', '--interval', type=float, default=1,
+                        help='Seconds between RSS samples [default: %(default)s].')
+    parser.add_argument('--json', default=None, help='Write the report as JSON to this file.')
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if options.log:
+        source = sys.stdin if options.log == '-' else io.open(options.log, encoding='utf-8')
+        urls = list(read_log(source))[:options.requests]
+    else:
+        sources = [path for path in walk(options.root) if path.lower().endswith(IMAGE_SUFFIXES)]
+        if not sources:
+            parser.error('No images found in %s.' % options.root)
+        urls = list(zipf_workload(sources, parse_ladder(options.ladder.split(',')),
+                                  options.requests, options.exponent, options.seed))
+
+    server = Server(options.root, options.conf)
+    try:
+        server.wait()
+        logger.info('Replaying %d requests against %s' % (len(urls), server.url))
+        result = replay(server.url, urls, options.concurrency, options.interval, server.rss)
+    finally:
+        metrics = server.stop()
+
+    summary = report(result, metrics)
+    print(format_report(summary))
+    if options.json:
+        with io.open(options.json, 'wb') as f:
+            f.write(json.dumps(summary, sort_keys=True, indent=2).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+from multiprocessing import Pool
+from os.path import join, isdir
+
+from . import imap_bounded, Progress
+from ..plan import parse_ladder, dump_plan
+
+logger = logging.getLogger('universalimages.commands')
+
+# Files thumbor's file storage keeps next to the images.
+SKIPPED_SUFFIXES = ('.crypto', '.detectors.txt')
+
+
+def walk(root, start_after=None):
+    """
+    Yields the relative paths of all files below root in lexicographic
+    order of their path components. The order is stable, so an interrupted
+    run can be resumed after the last processed path.
+    :param start_after: Skip all paths up to and including this one.
+    """
+    start_after = start_after.split('/') if start_after else None
+
+    def _walk(parts):
+        directory = join(root, *parts)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith('.') or name.endswith(SKIPPED_SUFFIXES):
+                continue
+            path = parts + [name]
+            if isdir(join(directory, name)):
+                # Skip directories which were processed completely.
+                if start_after is None or path >= start_after[:len(path)]:
+                    for child in _walk(path):
+                        yield child
+            elif start_after is None or path > start_after:
+                yield path
+
+    for parts in _walk([]):
+        yield '/'.join(parts)
+
+
+def recover(index_path):
+    """
+    Prepares an index file for appending. A line which was only partially
+    written when the previous run was interrupted is removed.
+    :return: The source of the last complete entry or None.
+    """
+    if not os.path.exists(index_path):
+        return None
+
+    with io.open(index_path, 'rb+') as index:
+        index.seek(0, os.SEEK_END)
+        end = index.tell()
+        block = 65536
+        while True:
+            start = max(0, end - block)
+            index.seek(start)
+            lines = index.read(end - start).split(b'\n')
+            # The first line may be cut off unless we read from the beginning.
+            candidates = lines if start == 0 else lines[1:]
+            # offset is the position of the newline in front of a line.
+            offset = end
+            for line in reversed(candidates):
+                offset -= len(line) + 1
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                index.truncate(offset + len(line) + 1)
+                index.seek(0, os.SEEK_END)
+                index.write(b'\n')
+                return entry['source']
+            if start == 0:
+                index.truncate(0)
+                return None
+            block *= 2
+
+
+# Worker process state, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(root, config_path, ladder):
+    from thumbor.config import Config
+    from thumbor.context import Context
+
+    from .. import config  # NOQA  Defines the configuration options.
+    from ..engines.pil import Engine
+
+    _worker['root'] = root
+    _worker['ladder'] = ladder
+    _worker['config'] = Config.load(config_path) if config_path else Config()
+    # Reads the metadata like the engine of the server, with the builtin
+    # XMP reader if UNIVERSALIMAGES_BUILTIN_XMP_READER is set.
+    _worker['engine'] = Engine(Context(config=_worker['config']))
+
+
+def _raw_values(metadata):
+    # The RMD values of a pyexiv2 ImageMetadata or an RmdDocument.
+    values = {}
+    for key in metadata.xmp_keys:
+        if key.startswith('Xmp.rmd.'):
+            value = metadata[key]
+            values[key] = value.raw_value if hasattr(value, 'raw_value') else value.value
+    return values
+
+
+def _precompute(path):
+    from thumbor.engines import BaseEngine
+    from thumbor.utils import EXTENSION
+
+    from ..admission import image_size
+    from ..compiler import compile_rmd
+    from ..filters.xmp.v01 import Xmp_API
+    from ..planner import compute_plans
+
+    try:
+        with io.open(join(_worker['root'], path), 'rb') as image:
+            buffer = image.read()
+        size = image_size(buffer)
+        if size is None:
+            raise ValueError('Unknown image format')
+        extension = EXTENSION.get(BaseEngine.get_mimetype(buffer), '.jpg')
+        metadata = _worker['engine'].read_metadata(buffer, extension)
+    except Exception as e:
+        logger.debug('Could not read %s: %s' % (path, e))
+        return {'source': path, 'size': None, 'plans': None}
+
+    entry = {
+        'source': path,
+        'size': list(size),
+        'digest': hashlib.sha1(buffer).hexdigest(),
+        'plans': None,
+    }
+    try:
+        plans = compute_plans(metadata, size, _worker['ladder'], source=path,
+                              config=_worker['config'])
+        if not any(plans):
+            return entry
+        dumped = dict(('%dx%d' % target, dump_plan(plan))
+                      for target, plan in zip(_worker['ladder'], plans))
+        rmd = _raw_values(metadata)
+        function = compile_rmd(Xmp_API(metadata), size)
+        function = function.dump() if function is not None else None
+    except Exception as e:
+        # Malformed RMD must not abort the run.
+        logger.error('Could not compute the crop plans of %s: %s' % (path, e))
+        return entry
+
+    entry.update({'plans': dumped, 'rmd': rmd, 'function': function})
+    return entry
+
+
+def precompute(root, index_path, ladder, config_path=None, processes=None,
+               window=1000, interval=10):
+    """
+    Computes the crop plans of all images below root and appends them to
+    the index file. One JSON object per line:
+    {"source": path, "size": [w, h], "digest": sha1, "plans": {"320x0":
+    [left, top, right, bottom, should_crop, fit_in, width, height], ...},
+    "rmd": {XMP key: value}}
+    :param window: Maximum number of files in flight. Bounds the memory usage.
+    :rtype: Progress
+    """
+    last = recover(index_path)
+    if last is not None:
+        logger.info('Resuming after %s' % last)
+
+    progress = Progress(interval)
+    pool = Pool(processes, initializer=_init_worker,
+                initargs=(root, config_path, ladder), maxtasksperchild=10000)
+    try:
+        with io.open(index_path, 'ab') as index:
+            for entry in imap_bounded(pool, _precompute, walk(root, last), window):
+                index.write(json.dumps(entry, separators=(',', ':')).encode('utf-8') + b'\n')
+                progress.update(bool(entry['plans']))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    logger.info(progress.summary())
+    return progress
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Precomputes the RMD crop plans of all images in a directory.')
+    parser.add_argument('root', help='Image directory or thumbor file storage root.')
+    parser.add_argument('-o', '--index', default='rmd-plans.jsonl',
+                        help='Index file [default: %(default)s].')
+    parser.add_argument('-c', '--conf', default=None, help='Path to thumbor.conf.')
+    parser.add_argument('-l', '--ladder', default=None,
+                        help='Comma separated target sizes, e.g. 320,640,800x600. '
+                             'Defaults to UNIVERSALIMAGES_LADDER.')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Number of worker processes [default: number of CPUs].')
+    parser.add_argument('-w', '--window', type=int, default=1000,
+                        help='Maximum number of files in flight [default: %(default)s].')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='Seconds between progress reports [default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if options.ladder:
+        ladder = parse_ladder(options.ladder.split(','))
+    else:
+        from thumbor.config import Config
+        from .. import config  # NOQA
+
+        conf = Config.load(options.conf) if options.conf else Config()
+        ladder = parse_ladder(conf.UNIVERSALIMAGES_LADDER)
+
+    progress = precompute(options.root, options.index, ladder, options.conf,
+                          options.processes, options.window, options.interval)
+    print(progress.summary())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
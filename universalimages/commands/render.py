@@ -0,0 +1,181 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import, print_function
+
+import argparse
+import io
+import json
+import logging
+import sys
+from multiprocessing import Pool
+
+from . import imap_bounded, Progress
+from ..plan import parse_ladder
+
+logger = logging.getLogger('universalimages.commands')
+
+
+def read_sources(sources, index_path=None):
+    """
+    Yields the sources to render: the given paths, the lines of stdin for '-'
+    and the sources with RMD of a precompute index.
+    """
+    for source in sources:
+        if source == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        else:
+            yield source
+    if index_path:
+        with io.open(index_path, 'rb') as index:
+            for line in index:
+                entry = json.loads(line.decode('utf-8'))
+                if entry['plans']:
+                    yield entry['source']
+
+
+def render_source(config, importer, source, ladder, unsafe=True):
+    """
+    Loads and decodes the source once and stores the rmd() derivatives
+    of all ladder sizes in the result storage.
+    :return: The number of stored derivatives.
+    """
+    import tornado.gen as gen
+    from tornado.ioloop import IOLoop
+    from thumbor.context import Context, RequestParameters
+    from thumbor.loaders import LoaderResult
+
+    from ..ladder import create_context, load_master, render_many
+
+    io_loop = IOLoop.current()
+    context = Context(config=config, importer=importer)
+    context.request = RequestParameters(image=source, url=source)
+    result = io_loop.run_sync(lambda: importer.loader.load(context, source))
+    if isinstance(result, LoaderResult):
+        if not result.successful:
+            logger.warning('Could not load %s: %s' % (source, result.error))
+            return 0
+        result = result.buffer
+    if result is None:
+        return 0
+
+    master = load_master(context, result)
+    contexts = [create_context(config, importer, source, width, height, unsafe=unsafe)
+                for width, height in ladder]
+    # Not chained, the output has to match the live rmd() path.
+    buffers = render_many(master, contexts, chain=False)
+    for derivative_context, buffer in zip(contexts, buffers):
+        storage = derivative_context.modules.result_storage
+        io_loop.run_sync(lambda: gen.maybe_future(storage.put(buffer)))
+    return len(ladder)
+
+
+# Worker process state, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(config_path, ladder, memory_limit, unsafe):
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    from thumbor.config import Config
+    from thumbor.importer import Importer
+
+    from .. import config  # NOQA  Defines the configuration options.
+
+    conf = Config.load(config_path) if config_path else Config()
+    importer = Importer(conf)
+    importer.import_modules()
+    _worker.update(config=conf, importer=importer, ladder=ladder, unsafe=unsafe)
+
+
+def _render(source):
+    try:
+        return render_source(_worker['config'], _worker['importer'], source,
+                             _worker['ladder'], _worker['unsafe'])
+    except MemoryError:
+        logger.error('Memory limit exceeded while rendering %s' % source)
+    except Exception:
+        logger.exception('Could not render %s' % source)
+    return 0
+
+
+def render_all(sources, ladder, config_path=None, processes=None,
+               memory_limit=None, unsafe=True, window=100, interval=10,
+               max_tasks=100):
+    """
+    Renders the ladder derivatives of all sources in a pool of worker
+    processes and writes them to the configured result storage.
+    :param memory_limit: Maximum address space of a worker in bytes.
+    :param max_tasks: Number of sources after which a worker is replaced.
+    :rtype: Progress
+    """
+    progress = Progress(interval)
+    pool = Pool(processes, initializer=_init_worker,
+                initargs=(config_path, ladder, memory_limit, unsafe),
+                maxtasksperchild=max_tasks)
+    try:
+        for count in imap_bounded(pool, _render, sources, window):
+            progress.update(count > 0, count)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    logger.info(progress.summary())
+    return progress
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Renders the rmd() derivatives of a breakpoint ladder '
+                    'into the result storage.')
+    parser.add_argument('sources', nargs='*',
+                        help="Source images as passed to the loader. '-' reads them from stdin.")
+    parser.add_argument('-c', '--conf', default=None, help='Path to thumbor.conf.')
+    parser.add_argument('--index', default=None,
+                        help='Render all sources with RMD of a universalimages-precompute index.')
+    parser.add_argument('-l', '--ladder', default=None,
+                        help='Comma separated target sizes, e.g. 320,640,800x600. '
+                             'Defaults to UNIVERSALIMAGES_LADDER.')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Number of worker processes [default: number of CPUs].')
+    parser.add_argument('-m', '--memory-limit', type=int, default=None,
+                        help='Maximum memory of a worker process in MB.')
+    parser.add_argument('--signed', action='store_true',
+                        help='Store the derivatives under signed URLs instead of unsafe ones.')
+    parser.add_argument('-w', '--window', type=int, default=100,
+                        help='Maximum number of sources in flight [default: %(default)s].')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='Seconds between progress reports [default: %(default)s].')
+    options = parser.parse_args(arguments)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    from thumbor.config import Config
+    from .. import config  # NOQA
+
+    conf = Config.load(options.conf) if options.conf else Config()
+    if not conf.RESULT_STORAGE:
+        parser.error('RESULT_STORAGE is not configured.')
+    if not options.signed and not conf.RESULT_STORAGE_STORES_UNSAFE:
+        parser.error('RESULT_STORAGE_STORES_UNSAFE is disabled, use --signed.')
+
+    if options.ladder:
+        ladder = parse_ladder(options.ladder.split(','))
+    else:
+        ladder = parse_ladder(conf.UNIVERSALIMAGES_LADDER)
+    memory_limit = options.memory_limit * 1024 * 1024 if options.memory_limit else None
+
+    progress = render_all(
+        read_sources(options.sources, options.index), ladder, options.conf,
+        options.processes, memory_limit, not options.signed, options.window,
+        options.interval)
+    print(progress.summary())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
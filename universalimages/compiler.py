@@ -0,0 +1,290 @@
+# coding: utf-8
+"""
+Compiles the RMD of an image into a piecewise crop function over the target
+width. For requests with only a width, the rmd filter branches on fixed
+thresholds (CropArea MinWidth, SafeArea MaxWidth, the width bounds of the
+RecommendedFrames). Between them, the crop box is constant or linear in the
+target width and the proportional target height.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import bisect
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger('universalimages.filters')
+
+Point = namedtuple('Point', ['x', 'y'])
+
+# coefficients: The crop box (left, top, right, bottom), or for LINEAR
+# segments (pivot x, pivot y, x divisor, y divisor, a, b, c). The crop box
+# has the width a * w + b * w / h and the height c or width * h / w, where w
+# is the target width and h the proportional target height. The pivot point
+# divides it in the ratio of the divisors.
+# candidates: Recommended frames (min aspect, max aspect, box) which are
+# used instead if the target aspect matches.
+Segment = namedtuple('Segment', ['coefficients', 'flags', 'candidates'])
+
+# The result for one target width. snap: The crop is snapped to the grid.
+CropResult = namedtuple('CropResult', ['crop', 'should_crop', 'fit_in', 'snap'])
+
+SHOULD_CROP = 1
+FIT_IN = 2
+SNAP = 4
+# Keep the safe area inside the crop box.
+CLAMP = 8
+LINEAR = 16
+
+AREA_KEYS = ('x', 'y', 'w', 'h')
+
+
+def pivot_point(xmp, size):
+    """
+    Returns the pivot point in source pixels. Falls back to the center
+    of the safe area and then to the center of the image.
+    :type xmp: Xmp_API
+    :rtype: Point
+    """
+    point = xmp.get_absolute_area_for(b'Xmp.rmd.PivotPoint', size)
+    if point:
+        return point
+    try:
+        x0, y0, x1, y1 = xmp.get_absolute_area_for(b'Xmp.rmd.SafeArea', size)
+        return Point(x0 + (x1 - x0) / 2.0, y0 + (y1 - y0) / 2.0)
+    except TypeError:
+        return Point(size[0] / 2.0, size[1] / 2.0)
+
+
+def _segment(box, flags=0, candidates=()):
+    return Segment(tuple(float(edge) for edge in box), flags, tuple(candidates))
+
+
+class CropFunction(object):
+    """
+    Crop boxes of an image for requests with a target width only.
+    """
+
+    def __init__(self, size, breakpoints, segments, safe_area=None):
+        """
+        :param size: Size of the source image (width, height)
+        :param breakpoints: Sorted list of the first width of each segment
+        :param segments: List of Segments
+        :param safe_area: The absolute safe area box (x0, y0, x1, y1)
+        """
+        self.size = tuple(size)
+        self.breakpoints = list(breakpoints)
+        self.segments = list(segments)
+        self.safe_area = tuple(safe_area) if safe_area else None
+
+    def __len__(self):
+        return len(self.segments)
+
+    def evaluate(self, width):
+        """
+        Returns the crop for the given target width.
+        :type width: int
+        :rtype: CropResult or None
+        """
+        height = round(float(width) * self.size[1] / self.size[0], 0)
+        if width < 1 or not height:
+            return None
+        index = max(bisect.bisect_right(self.breakpoints, width) - 1, 0)
+        segment = self.segments[index]
+
+        if segment.candidates:
+            aspect = float(width) / height
+            for min_aspect, max_aspect, box in segment.candidates:
+                if (min_aspect is None or min_aspect >= aspect) and \
+                        (max_aspect is None or max_aspect <= aspect):
+                    return CropResult(tuple(box), True, False, False)
+
+        if not segment.flags & LINEAR:
+            return CropResult(segment.coefficients, bool(segment.flags & SHOULD_CROP),
+                              bool(segment.flags & FIT_IN), bool(segment.flags & SNAP))
+
+        # Same operations as the linear interpolation of the filter.
+        px, py, x_divisor, y_divisor, a, b, c = segment.coefficients
+        aspect = float(width) / height
+        crop_width = a * width + b * aspect
+        crop_height = c or crop_width / aspect
+        right = px + crop_width / x_divisor
+        left = right - crop_width
+        bottom = py + crop_height / y_divisor
+        top = bottom - crop_height
+
+        if segment.flags & CLAMP:
+            x0, y0, x1, y1 = self.safe_area
+            if x0 < left:
+                left, right = x0, x0 + crop_width
+            elif x1 > right:
+                left, right = x1 - crop_width, x1
+            if y0 < top:
+                top, bottom = y0, y0 + crop_height
+            elif y1 > bottom:
+                top, bottom = y1 - crop_height, y1
+
+        return CropResult((left, top, right, bottom), bool(segment.flags & SHOULD_CROP),
+                          bool(segment.flags & FIT_IN), bool(segment.flags & SNAP))
+
+    def dump(self):
+        """
+        Serializes the function to a JSON compatible list.
+        """
+        return [list(self.size), self.breakpoints,
+                [[list(s.coefficients), s.flags,
+                  [[min_aspect, max_aspect, list(box)]
+                   for min_aspect, max_aspect, box in s.candidates]]
+                 for s in self.segments],
+                list(self.safe_area) if self.safe_area else None]
+
+    @classmethod
+    def load(cls, values):
+        """
+        Restores a function serialized with dump.
+        """
+        if values is None:
+            return None
+        size, breakpoints, segments, safe_area = values
+        return cls(size, breakpoints, [
+            Segment(tuple(coefficients), flags,
+                    tuple((min_aspect, max_aspect, tuple(box))
+                          for min_aspect, max_aspect, box in candidates))
+            for coefficients, flags, candidates in segments], safe_area)
+
+
+class Compiler(object):
+    """
+    Follows the branches of the rmd filter for a target width and
+    returns the segment which is valid until the next threshold.
+    """
+
+    def __init__(self, xmp, size):
+        self.xmp = xmp
+        self.size = tuple(size)
+        self.full = (0, 0) + self.size
+        self.interpolation = xmp.get_value_for(b'Xmp.rmd.Interpolation') or 'step'
+        self.allowed = xmp.check_allowed()
+        self.crop_all = xmp.get_value_for(b'Xmp.rmd.AllowedDerivates/rmd:Crop') == 'all'
+
+        self.crop_area = xmp.get_area_values_for(b'Xmp.rmd.CropArea')
+        self.crop_box = None
+        self.crop_aspect = None
+        if self.crop_area:
+            if any(key not in self.crop_area for key in AREA_KEYS):
+                raise ValueError('Incomplete CropArea')
+            self.crop_box = tuple(xmp.stArea_to_absolute(self.crop_area, self.size))
+            x0, y0, x1, y1 = self.crop_box
+            self.crop_aspect = float(x1 - x0) / float(y1 - y0)
+        self.crop_min_width = int(self.crop_area['MinWidth']) \
+            if self.crop_area and 'MinWidth' in self.crop_area else None
+
+        self.safe_area = xmp.get_area_values_for(b'Xmp.rmd.SafeArea')
+        self.safe_box = None
+        if self.safe_area and all(key in self.safe_area for key in AREA_KEYS + ('MaxWidth',)):
+            self.safe_box = tuple(xmp.stArea_to_absolute(self.safe_area, self.size))
+        self.safe_max_width = int(self.safe_area['MaxWidth']) \
+            if self.safe_area and 'MaxWidth' in self.safe_area else None
+
+        self.frames = []
+        if self.interpolation != 'linear':
+            for frame in xmp.get_area_values_for_array(b'Xmp.rmd.RecommendedFrames'):
+                if any(key not in frame for key in AREA_KEYS):
+                    raise ValueError('Incomplete RecommendedFrame')
+                self.frames.append(frame)
+
+        self.pivot = pivot_point(xmp, self.size)
+        self.constant_height_from = None
+        if self.interpolation == 'linear' and self.crop_min_width and self.safe_max_width:
+            self.constant_height_from = self._constant_height_from()
+
+    def breakpoints(self):
+        points = set([1])
+        if self.crop_min_width is not None:
+            points.add(self.crop_min_width)
+        if self.safe_box is not None:
+            points.add(self.safe_max_width + 1)
+        if self.constant_height_from is not None:
+            points.add(self.constant_height_from)
+        for frame in self.frames:
+            if 'MinWidth' in frame:
+                points.add(int(frame['MinWidth']))
+            if 'MaxWidth' in frame:
+                points.add(int(frame['MaxWidth']) + 1)
+        return sorted(point for point in points if point >= 1)
+
+    def _constant_height_from(self):
+        # Below the CropArea MinWidth, the linear interpolation keeps the
+        # height of the crop area once the target height exceeds its minimum.
+        crop_min_height = self.crop_min_width / self.crop_aspect
+        width = self.crop_min_width
+        while width > 1 and int(round(float(width - 1) / self.crop_aspect)) > crop_min_height:
+            width -= 1
+        return width if width < self.crop_min_width else None
+
+    def segment(self, width):
+        crop = self.crop_box or self.full
+        should_crop = self.crop_box is not None
+
+        if self.crop_min_width is not None and self.crop_min_width <= width:
+            return _segment(crop, SHOULD_CROP if self.crop_all else SHOULD_CROP | FIT_IN)
+        if not self.allowed:
+            return _segment(crop, FIT_IN)
+        if self.safe_box is not None and width <= self.safe_max_width:
+            return _segment(self.safe_box, SHOULD_CROP)
+
+        if self.interpolation == 'linear':
+            return self._linear_segment(width, crop)
+
+        candidates = []
+        for frame in self.frames:
+            if 'MinWidth' in frame and int(frame['MinWidth']) > width or \
+                    'MaxWidth' in frame and int(frame['MaxWidth']) < width:
+                continue
+            candidates.append((
+                float(frame['MinAspectRatio']) if 'MinAspectRatio' in frame else None,
+                float(frame['MaxAspectRatio']) if 'MaxAspectRatio' in frame else None,
+                tuple(self.xmp.stArea_to_absolute(frame, self.size))))
+        return _segment(crop, SHOULD_CROP if should_crop else 0, candidates)
+
+    def _linear_segment(self, width, crop):
+        if not (self.crop_min_width and self.safe_max_width):
+            return _segment(crop, 0)
+        x0, y0, x1, y1 = crop
+        px, py = self.pivot
+        x_divisor = 1.0 + float(px - x0) / (x1 - px)
+        y_divisor = 1.0 + float(py - y0) / (y1 - py)
+
+        if self.constant_height_from is not None and width >= self.constant_height_from:
+            # The crop area height, with the target aspect ratio.
+            coefficients = (px, py, x_divisor, y_divisor, 0.0, y1 - y0, y1 - y0)
+        else:
+            # Scaled down from the crop area at its MinWidth.
+            coefficients = (px, py, x_divisor, y_divisor,
+                            float(x1 - x0) / self.crop_min_width, 0.0, 0.0)
+        flags = LINEAR | SHOULD_CROP | SNAP | (CLAMP if self.safe_box else 0)
+        return Segment(coefficients, flags, ())
+
+
+def compile_rmd(xmp, size):
+    """
+    Compiles the RMD into a crop function for requests with a target width
+    and no target height.
+    :param xmp: Xmp_API with valid RMD for the image
+    :param size: Size of the source image (width, height)
+    :return: The crop function or None if the RMD can not be compiled.
+    :rtype: CropFunction or None
+    """
+    try:
+        compiler = Compiler(xmp, size)
+        breakpoints = []
+        segments = []
+        for width in compiler.breakpoints():
+            segment = compiler.segment(width)
+            if segments and segments[-1] == segment:
+                continue
+            breakpoints.append(width)
+            segments.append(segment)
+    except (ValueError, KeyError, IndexError, ZeroDivisionError) as e:
+        logger.debug('RMD can not be compiled: %s' % e)
+        return None
+    return CropFunction(size, breakpoints, segments, compiler.safe_box)
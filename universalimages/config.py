@@ -0,0 +1,225 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from thumbor.config import Config
+
+# Configuration options of the universal images extension. They can be
+# overridden in thumbor.conf like any other thumbor setting.
+
+Config.define(
+    'UNIVERSALIMAGES_RESULT_STORAGE', 'thumbor.result_storages.file_storage',
+    'Result storage module that holds the derivatives stored under their '
+    'canonical key by universalimages.result_storages.canonical_storage',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_SIZE', 10000,
+    'Maximum number of entries per in-process cache (aliases, plans, documents) '
+    'of the memory cache backend',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_COALESCING', True,
+    'Coalesce concurrent identical requests, so only one of them renders the image',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_COALESCING_TIMEOUT', 10,
+    'Seconds a coalesced request waits for the leading request before it '
+    'renders the image itself',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_COALESCING_ERRORS', 'fallback',
+    "What coalesced requests do if the leading request fails: 'fallback' "
+    "renders the image again, 'propagate' responds with the same status",
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_ETAGS', True,
+    'Send strong ETags for rmd() requests and answer matching If-None-Match '
+    'headers from the caches, without loading the image',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_ETAG_CACHE_TTL', 3600,
+    'Seconds the cached source and RMD digests may be used to answer '
+    'conditional requests without loading the image',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_LADDER', [320, 480, 640, 800, 1024, 1280, 1600, 1920],
+    'Breakpoint ladder used to precompute crop plans and derivatives. '
+    "Entries are widths or 'WIDTHxHEIGHT' strings",
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_LADDER_MAX_SIZES', 16,
+    'Maximum number of sizes a client may request from the ladder handler at once',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_REGION_CACHE_SIZE', 0,
+    'Maximum size in bytes of the decoded image regions kept in memory, so '
+    'rmd() requests of hot images skip loading and decoding. 0 disables the cache',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_REGION_CACHE_GRID', 64,
+    'Cached regions are extended to multiples of this number of pixels, so '
+    'neighboring crop boxes share a region',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_REGION_CACHE_MIN_REQUESTS', 2,
+    'Number of requests of a source image before its regions are cached',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_REGION_CACHE_TTL', 600,
+    'Seconds a cached region is used before the source is loaded again',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CROP_GRID', 0,
+    'Round the computed crop boxes to multiples of this number of pixels '
+    '(e.g. 16 for JPEG MCUs), so neighboring sizes share the same crop box. '
+    'Boxes are only rounded if the safe area stays inside. 0 disables rounding',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CROP_FUNCTIONS', False,
+    'Compile the RMD of an image into a piecewise crop function over the target '
+    "width, kept in the 'functions' cache. Requests with only a width look up "
+    'their crop box in it instead of running the filter rules',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_RMD_INDEX', None,
+    'Path of a memory mapped RMD index built with universalimages-index. The RMD '
+    'and the precomputed crop plans of indexed images are read from it instead '
+    'of the XMP metadata',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_RMD_INDEX_CHECK_INTERVAL', 60,
+    'Seconds between checks whether the RMD index file has been replaced',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_BACKEND', 'universalimages.caches.memory',
+    'Backend of the alias, plan and document caches: universalimages.caches.memory '
+    '(per process), universalimages.caches.sqlite (per host) or '
+    'universalimages.caches.redis (shared by all hosts)',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_BACKENDS', {},
+    'Backends of single caches, by cache name, e.g. {\'plans\': '
+    '\'universalimages.caches.redis\'}. The other caches use '
+    'UNIVERSALIMAGES_CACHE_BACKEND',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_THREADS', 4,
+    'Number of threads which access the SQLite and Redis cache backends for '
+    'the IOLoop', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_TTL', 86400,
+    'Seconds the SQLite and Redis cache backends keep an entry. 0 keeps them forever',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_SQLITE_PATH', '/tmp/universalimages-cache.sqlite',
+    'Database file of the SQLite cache backend',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_REDIS_HOST', 'localhost',
+    'Host of the Redis cache backend', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_REDIS_PORT', 6379,
+    'Port of the Redis cache backend', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_REDIS_DB', 0,
+    'Database number of the Redis cache backend', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_REDIS_PASSWORD', None,
+    'Password of the Redis cache backend', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_CACHE_REDIS_TIMEOUT', 0.1,
+    'Socket timeout in seconds of the Redis cache backend. Requests treat '
+    'a timeout as a cache miss', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PIXEL_BUDGET', 0,
+    'Maximum number of source and output pixels a process decodes and renders at '
+    'the same time. Further requests wait, the ones with small outputs first. '
+    '0 disables admission control',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_ADMISSION_TIMEOUT', 30,
+    'Seconds a request waits for admission before it fails with a 504 status',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_SYNTHESIZE_RMD', False,
+    'Store the result of the smart detectors for images without RMD as RMD '
+    '(safe area around the features, pivot point at their centroid) in the '
+    "'synthesized' cache, so other sizes of the image skip the detectors",
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_BUILTIN_XMP_READER', False,
+    'Read the RMD of JPEG images with the builtin XMP reader instead of pyexiv2. '
+    'PNG, WebP and TIFF images are always read with the builtin reader',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_XMP_MAX_BYTES', 2 * 1024 * 1024,
+    'Images with a larger XMP packet (after decompression) are treated as images '
+    'without RMD. 0 disables the limit', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_XMP_MAX_DEPTH', 64,
+    'Maximum nesting depth of the XMP elements read by the builtin XMP reader. '
+    '0 disables the limit', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_XMP_MAX_NODES', 50000,
+    'Maximum number of XMP elements and attributes read by the builtin XMP reader. '
+    '0 disables the limit', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_XMP_TIMEOUT', 0.1,
+    'Seconds the builtin XMP reader may spend on one packet. 0 disables the limit',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_RMD_BUDGET', 0,
+    'Milliseconds the rmd filter waits for the metadata of an image, which is read '
+    'while the image is decoded. Slower requests are rendered without RMD, are not '
+    'stored in the result storage, and the crop plan is computed in the background '
+    "for the next request of the url ('deferred' cache). 0 disables the budget",
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_RMD_WORKERS', 2,
+    'Number of threads which read the metadata if UNIVERSALIMAGES_RMD_BUDGET is set',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROFILE_RATE', 0.0,
+    'Fraction of the rmd() requests which are sampled by the CPU profiler, '
+    'e.g. 0.01. 0 disables the profiler', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROFILE_PATH', '/tmp/universalimages-profiles',
+    'Directory of the collapsed stack files written by the profiler', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROFILE_INTERVAL', 60,
+    'Seconds after which the profiler writes the sampled stacks to a new file',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROFILE_SAMPLE_INTERVAL', 0.005,
+    'Seconds between two samples of the stacks of the profiled requests',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_METRICS_PATH', None,
+    "JSON file to which METRICS = 'universalimages.metrics' writes the metric counters "
+    'of the process', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_METRICS_INTERVAL', 1,
+    "Minimum seconds between two writes of UNIVERSALIMAGES_METRICS_PATH", 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROBE_BYTES', 64 * 1024,
+    "Bytes of the first Range request of LOADER = 'universalimages.loaders.http_probe' "
+    'for rmd() requests. 0 loads the images without probing', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PROBE_MAX_BYTES', 1024 * 1024,
+    'Maximum size of the image header the probe fetches. The crop plan of images with '
+    'larger headers is computed once the image is loaded', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PREFETCH', False,
+    'Render the other UNIVERSALIMAGES_LADDER sizes of a source in the background after '
+    'the first rmd() request which loaded it, and store them in the result storage',
+    'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PREFETCH_WORKERS', 1,
+    'Number of threads which render the prefetched derivatives', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PREFETCH_QUEUE', 8,
+    'Maximum number of sources queued for prefetching. Each one keeps its decoded image '
+    'in memory. 0 disables the limit', 'Universal Images')
+Config.define(
+    'UNIVERSALIMAGES_PREFETCH_RATE', 1.0,
+    'Maximum number of sources prefetched per second. 0 disables the limit',
+    'Universal Images')
@@ -0,0 +1,186 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import hashlib
+import logging
+
+from thumbor.engines import MultipleEngine, METADATA_AVAILABLE
+from thumbor.engines.pil import Engine as PILEngine
+from thumbor.utils import EXTENSION
+
+from .. import config  # NOQA  Defines the configuration options.
+from ..budget import MetadataTask, get_executor, get_deferred_plan, load_deferred_plan
+from ..filters.xmp.reader import (
+    read_rmd, extract_xmp, limits_from_config, XmpLimitError)
+from ..profiling import profiled
+from ..rmd_index import get_rmd_index, RmdDocument
+
+if METADATA_AVAILABLE:
+    from pyexiv2 import ImageMetadata
+
+logger = logging.getLogger('universalimages.engines')
+
+# Formats whose XMP pyexiv2 reads slowly or not at all.
+BUILTIN_XMP_FORMATS = ('.png', '.webp', '.tif', '.tiff')
+
+
+class Engine(PILEngine):
+    """
+    PIL engine which keeps the digest of the source image.
+    Set ENGINE = 'universalimages.engines.pil' in thumbor.conf.
+
+    If the source is in the RMD index, the RMD and the precomputed crop plans
+    are read from the index instead of parsing the XMP metadata.
+    PNG, WebP and TIFF images (and JPEG images with
+    UNIVERSALIMAGES_BUILTIN_XMP_READER) are read with the builtin XMP reader.
+    XMP packets which exceed the UNIVERSALIMAGES_XMP_* limits are ignored.
+    With UNIVERSALIMAGES_RMD_BUDGET, the metadata of rmd() requests is read
+    in a worker thread while the image is decoded. The metadata probed by
+    the http_probe loader is not read again.
+    """
+
+    def __init__(self, context):
+        super(Engine, self).__init__(context)
+        self.source_digest = None
+        self.rmd_record = None
+        self.metadata_task = None
+        self.deferred_plan = None
+
+    def load(self, buffer, extension):
+        self.source_digest = hashlib.sha1(buffer).hexdigest()
+        self.rmd_record = self.get_rmd_record()
+        self.metadata_task = self.deferred_plan = None
+        if extension is None:
+            extension = EXTENSION.get(self.get_mimetype(buffer), '.jpg')
+
+        probe = getattr(getattr(self.context, 'request', None), 'rmd_probe', None)
+        if self.rmd_record is not None:
+            document = self.rmd_record.document
+        elif probe is not None:
+            # Read from the image header by the http_probe loader.
+            document = probe['document']
+        elif self.start_metadata_task(buffer, extension):
+            # The rmd filter waits for the task.
+            document = None
+        elif self.use_builtin_reader(extension):
+            document = RmdDocument(self.read_rmd(buffer))
+        elif self.check_xmp(buffer):
+            super(Engine, self).load(buffer, extension)
+            return
+        else:
+            document = RmdDocument({})
+
+        # Same as BaseEngine.load, without reading the metadata with pyexiv2.
+        self.extension = extension
+        if self.extension == '.svg':
+            buffer = self.convert_svg_to_png(buffer)
+
+        image_or_frames = self.create_image(buffer)
+        self.metadata = document
+
+        if self.context.config.ALLOW_ANIMATED_GIFS and isinstance(
+                image_or_frames, (list, tuple)):
+            self.image = image_or_frames[0]
+            if len(image_or_frames) > 1:
+                self.multiple_engine = MultipleEngine(self)
+                for frame in image_or_frames:
+                    self.multiple_engine.add_frame(frame)
+                self.wrap(self.multiple_engine)
+        else:
+            self.image = image_or_frames
+
+        if self.source_width is None:
+            self.source_width = self.size[0]
+        if self.source_height is None:
+            self.source_height = self.size[1]
+
+    def use_builtin_reader(self, extension):
+        return extension in BUILTIN_XMP_FORMATS or (
+            extension == '.jpg' and self.context.config.UNIVERSALIMAGES_BUILTIN_XMP_READER)
+
+    def start_metadata_task(self, buffer, extension):
+        """
+        Starts to read the metadata in a worker thread if the RMD stage
+        has a budget. Nothing is read if a plan was computed in the
+        background for the request.
+        :return: True if the metadata is not read here.
+        """
+        conf = self.context.config
+        request = getattr(self.context, 'request', None)
+        executor = get_executor(conf)
+        if executor is None or request is None or 'rmd(' not in (request.filters or ''):
+            return False
+        if hasattr(request, 'rmd_deferred'):
+            # Read by the imaging handler before the image was loaded.
+            self.deferred_plan = load_deferred_plan(request.rmd_deferred, self.source_digest)
+        else:
+            self.deferred_plan = get_deferred_plan(conf, request.url, self.source_digest)
+        if self.deferred_plan is None:
+            self.metadata_task = MetadataTask(
+                executor.submit(profiled(self.context, self.read_metadata), buffer, extension),
+                conf.UNIVERSALIMAGES_RMD_BUDGET)
+        return True
+
+    def read_metadata(self, buffer, extension):
+        """
+        Reads the metadata like load does.
+        :rtype: RmdDocument or pyexiv2.ImageMetadata
+        """
+        if self.use_builtin_reader(extension):
+            return RmdDocument(self.read_rmd(buffer))
+        if not METADATA_AVAILABLE or not self.check_xmp(buffer):
+            return RmdDocument({})
+        metadata = ImageMetadata.from_buffer(buffer)
+        metadata.read()
+        return metadata
+
+    def read_rmd(self, buffer):
+        """
+        Reads the RMD with the builtin reader. Returns no RMD if the
+        XMP packet exceeds the limits.
+        """
+        try:
+            return read_rmd(buffer, limits_from_config(self.context.config))
+        except XmpLimitError as e:
+            self.reject_xmp(e)
+            return {}
+
+    def check_xmp(self, buffer):
+        """
+        Checks the size of the XMP packet and refuses DTDs before
+        pyexiv2 parses the metadata.
+        :return: False if the metadata must not be read.
+        """
+        limits = limits_from_config(self.context.config)
+        try:
+            packet = extract_xmp(buffer, limits.max_bytes)
+            if packet is None:
+                return True
+            if limits.max_bytes and len(packet) > limits.max_bytes:
+                raise XmpLimitError('Packet larger than %d bytes' % limits.max_bytes)
+            if b'<!DOCTYPE' in packet or b'<!ENTITY' in packet:
+                raise XmpLimitError('DTDs and entities are not allowed')
+        except XmpLimitError as e:
+            self.reject_xmp(e)
+            return False
+        return True
+
+    def reject_xmp(self, error):
+        request = getattr(self.context, 'request', None)
+        logger.warning('Ignoring the XMP metadata of %s: %s' % (
+            getattr(request, 'image_url', None), error))
+        self.context.metrics.incr('universalimages.xmp.rejected')
+
+    def get_rmd_record(self):
+        """
+        Returns the RMD index record of the source, or None if the source
+        is not indexed or has changed since the index was built.
+        """
+        index = get_rmd_index(self.context.config)
+        request = getattr(self.context, 'request', None)
+        if index is None or request is None or not request.image_url:
+            return None
+        record = index.lookup(request.image_url)
+        if record is None or (record.digest and record.digest != self.source_digest):
+            return None
+        return record
@@ -1,17 +1,26 @@
 # coding: utf-8
 from __future__ import unicode_literals, absolute_import
 
+import copy
 import logging
-from collections import namedtuple
+import time
 
+import tornado.gen as gen
 from thumbor.filters import BaseFilter, filter_method, PHASE_AFTER_LOAD
-
-from .xmp.v01 import Xmp_API  # Support multiple versions in the future.
+from thumbor.point import FocalPoint
+from tornado.ioloop import IOLoop
+
+from .xmp.v01 import Xmp_API, synthesize_rmd  # Support multiple versions in the future.
+from .. import config  # NOQA  Defines the configuration options.
+from .. import plan
+from ..budget import set_deferred_plan
+from ..caches import get_cache
+from ..caches.regions import get_region_cache, can_use_region, source_validator
+from ..compiler import CropFunction, compile_rmd, pivot_point
+from ..rmd_index import RmdDocument
 
 logger = logging.getLogger('universalimages.filters')
 
-Point = namedtuple('Point', ['x', 'y'])
-
 
 class Filter(BaseFilter):
     """
@@ -19,7 +28,15 @@ class Filter(BaseFilter):
     https://github.com/universalimages/rmd
 
     It sets the request.crop, request.should_crop and smart properties
-    in the context.
+    in the context. If the image has valid RMD, smart detection is turned off
+    and the pivot point is used as the focal point. The detectors only run
+    for images without RMD.
+
+    With UNIVERSALIMAGES_RMD_BUDGET, the filter waits for the metadata at most
+    for the budget. Slower requests are rendered without RMD and the plan is
+    computed in the background for the next request of the url.
+    With the http_probe loader, the plan is computed from the image header
+    while the image is loaded.
 
     Once the crop values are set, the image is then cropped and resized by Thumbor.
     """
@@ -30,27 +47,146 @@ class Filter(BaseFilter):
         super(Filter, self).__init__(params, context)
         # TODO: Extract RMD version and import the correct API.
         self.xmp = Xmp_API()
-
-    @filter_method()
-    def rmd(self):
+        self.synchronous = True
+        self.cache_entries = None
+        # The planner computes plans without reading or writing the
+        # shared caches.
+        self.use_caches = True
+
+    @filter_method(**{'async': True})
+    def rmd(self, callback):
         """
         Main filter method. Sets the crop values in the request.
+        On the IOLoop, the filter waits asynchronously for the metadata read
+        in a worker thread and for the cache entries it needs.
         :param initial_dpr: display resolution of the target device,
                     relative to the CSS pixel.
         :type initial_dpr: float
         """
         logger.debug('RMD Filter called')
-        if not self.engine.metadata:
-            logger.debug('No metadata found. Skipping RMD filter.')
-            return False
+        if self._apply_known_plan():
+            callback()
+            return
+        if self.synchronous:
+            task = getattr(self.engine, 'metadata_task', None)
+            if task is not None:
+                self.engine.metadata_task = None
+                self.engine.metadata = task.future.result()
+            self._plan()
+            callback()
+            return
+        IOLoop.current().add_future(
+            self._plan_async(), lambda future: self._planned(future, callback))
+
+    def run(self, callback=None):
+        # The ladder and the planner run the filter without a callback,
+        # outside of the IOLoop. It then completes synchronously and reads
+        # the caches with blocking calls.
+        self.synchronous = callback is None
+        return super(Filter, self).run(callback or (lambda: None))
+
+    # Private methods
 
-        self.xmp.metadata = self.engine.metadata
+    def _apply_known_plan(self):
+        # Plans known before the metadata is read.
+        if getattr(self.context.request, 'rmd_region', None):
+            logger.debug('Crop plan applied to a cached region.')
+            return True
+        deferred = getattr(self.engine, 'deferred_plan', None)
+        if deferred is not None and deferred['plan'] is not None:
+            logger.debug('Using the crop plan computed in the background.')
+            return self._apply_plan(deferred)
+        probe = getattr(self.context.request, 'rmd_probe', None)
+        if probe is not None and probe['plan'] is not None and \
+                tuple(probe['size']) == tuple(self.engine.size):
+            logger.debug('Using the crop plan computed from the image header.')
+            return self._apply_plan(probe)
+        return False
+
+    @gen.coroutine
+    def _plan_async(self):
+        # Waits for the metadata and the cache entries, then plans.
+        entries = self._read_cache_entries()
+        task = getattr(self.engine, 'metadata_task', None)
+        if task is not None:
+            self.engine.metadata_task = None
+            try:
+                self.engine.metadata = yield task.wait()
+            except gen.TimeoutError:
+                logger.debug('RMD budget exceeded. Skipping RMD filter.')
+                self._defer(task)
+                return
+            except Exception as e:
+                logger.error('Error reading image metadata: %s' % e)
+        self.cache_entries = yield entries
+        start = time.time()
+        self._plan()
+        if task is not None:
+            duration = time.time() - start
+            self.context.metrics.timing('universalimages.rmd.planning', duration * 1000)
+            if task.planned(duration):
+                self.context.metrics.incr('universalimages.rmd.budget_overrun')
+
+    def _planned(self, future, callback):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error('Error in the rmd filter of %s: %s' % (self.context.request.url, e))
+        finally:
+            callback()
+
+    @gen.coroutine
+    def _read_cache_entries(self):
+        # The entries of the source which the planning may need.
+        conf = self.context.config
+        names = []
+        if conf.UNIVERSALIMAGES_SYNTHESIZE_RMD:
+            names.append('synthesized')
+        if getattr(conf, 'UNIVERSALIMAGES_CROP_FUNCTIONS', False):
+            names.append('functions')
+        entries = yield [get_cache(name, conf).get_async(self.context.request.image_url)
+                         for name in names]
+        raise gen.Return(dict(zip(names, entries)))
+
+    def _get_cache_entry(self, name):
+        # Read asynchronously before the planning, or with a blocking
+        # call outside of the IOLoop.
+        if not self.use_caches:
+            return None
+        if self.cache_entries is not None:
+            return self.cache_entries.get(name)
+        return get_cache(name, self.context.config).get(self.context.request.image_url)
+
+    def _plan(self):
+        # Computes the crop plan from the metadata of the engine.
+        if not self.engine.metadata:
+            logger.debug('No metadata found.')
+        else:
+            self.xmp.metadata = self.engine.metadata
 
         # check for rmd namespace
 
-        if not self.xmp.check_valid(self.engine.size):
-            logger.debug('XMP Data is invalid')
-            return
+        if not self.engine.metadata or not self.xmp.check_valid(self.engine.size):
+            self.xmp.metadata = self._get_synthesized_rmd()
+            if self.xmp.metadata is None or not self.xmp.check_valid(self.engine.size):
+                logger.debug('No valid RMD found. Skipping RMD filter.')
+                self._synthesize_from_detectors()
+                return False
+            logger.debug('Using the RMD synthesized from the smart detectors.')
+
+        self._store_document()
+        self._bypass_detectors()
+
+        precomputed = self._get_precomputed_plan()
+        if precomputed is not None:
+            logger.debug('Using the crop plan of the RMD index.')
+            self.context.request.fit_in = precomputed.fit_in
+            return self._commit(precomputed.crop, precomputed.should_crop)
+
+        compiled = self._evaluate_crop_function()
+        if compiled is not None:
+            logger.debug('Using the compiled crop function.')
+            return self._commit(*compiled)
 
         # initialize values
         min_area = None  #  x0, y0, x1, y1
@@ -140,8 +276,6 @@ class Filter(BaseFilter):
 
         return self._commit(crop, should_crop)
 
-    # Private methods
-
     def _commit(self, crop, should_crop):
         # Set the values and exit.
         self.context.request.crop = {
@@ -151,23 +285,200 @@ class Filter(BaseFilter):
             'bottom': int(round(crop[3]))
         }
         self.context.request.should_crop = should_crop
+        self.context.request.rmd_plan = rmd_plan = plan.build_plan(
+            self.context.request, self.context.request.crop, should_crop,
+            self.engine.size)
+        self._set_cache_entry(
+            'aliases', plan.request_key(self.context), plan.canonical_key_for(self.context))
+        self._set_cache_entry('plans', self.context.request.url, plan.dump_plan(rmd_plan))
+        self._store_region(rmd_plan)
         return True
 
-    def _get_pivot_point(self):
-        # Get the pivot point from the XML
-        pivot_point = self.xmp.get_absolute_area_for(b'Xmp.rmd.PivotPoint',
-                                                     self.engine.size)
-        if not pivot_point:
-            # Use the center of the safe area
-            x0, y0, x1, y1 = self.xmp.get_absolute_area_for(
-                b'Xmp.rmd.SafeArea', self.engine.size)
+    def _set_cache_entry(self, name, key, value):
+        if self.use_caches:
+            get_cache(name, self.context.config).set_async(key, value)
+
+    def _store_region(self, rmd_plan):
+        # Keep the decoded crop region of hot images in memory.
+        regions = get_region_cache(self.context.config) if self.use_caches else None
+        if regions is None or getattr(self.engine, 'image', None) is None:
+            return
+        if not can_use_region(self.context, self.engine):
+            return
+        source = self.context.request.image_url
+        validator = source_validator(self.context) or getattr(self.engine, 'source_digest', None)
+        if regions.admit(source) and regions.get(source, rmd_plan.crop, validator) is None:
+            regions.put(source, rmd_plan.crop, self.engine, validator)
+
+    def _store_document(self):
+        # Remember the digests of the source, so later requests can
+        # be revalidated without loading the image.
+        source_digest = getattr(self.engine, 'source_digest', None)
+        if source_digest is None:
+            return
+        document = self.context.request.rmd_document = {
+            'source': source_digest,
+            'rmd': self.xmp.digest(),
+            'time': time.time(),
+        }
+        self._set_cache_entry('documents', self.context.request.image_url, document)
+
+    def _defer(self, task):
+        # Render the image like an image without RMD. The plan of the request
+        # is computed once the metadata is read, for the next request.
+        # The fallback is not stored and expires after MAX_AGE_TEMP_IMAGE.
+        from ..planner import plan_request
+
+        request = self.context.request
+        deferred = copy.copy(request)
+        deferred.focal_points = list(request.focal_points)
+        conf = self.context.config
+        metrics = self.context.metrics
+        size = self.engine.size
+        source_digest = getattr(self.engine, 'source_digest', None)
+        io_loop = IOLoop.current()
+        request.prevent_result_storage = True
+        metrics.incr('universalimages.rmd.budget_exceeded')
+
+        def compute(future):
             try:
-                pivot_point = Point(x0 + (x1 - x0) / 2.0, y0 + (y1 - y0) / 2.0)
-            except TypeError:
-                # Use the image center
-                pivot_point = Point(self.engine.size[0] / 2.0, self.engine.size[1] / 2.0)
+                rmd_plan = plan_request(deferred, future.result(), size, conf,
+                                        source_digest, metrics)
+            except Exception as e:
+                logger.error('Could not compute the deferred plan of %s: %s' % (
+                    deferred.url, e))
+                return
+            focal_point = None
+            if getattr(deferred, 'rmd_detection_bypassed', False):
+                focal_point = (deferred.focal_points[0].x, deferred.focal_points[0].y)
+            set_deferred_plan(conf, deferred.url, source_digest, rmd_plan, focal_point)
+            metrics.incr('universalimages.rmd.deferred')
+
+        task.future.add_done_callback(
+            lambda future: io_loop.add_callback(compute, future))
+
+    def _apply_plan(self, entry):
+        # Applies a plan computed before the image was decoded, in the
+        # background or from the header probed by the http_probe loader.
+        request = self.context.request
+        rmd_plan = entry['plan']
+        if entry['focal_point'] and request.smart:
+            x, y = entry['focal_point']
+            request.smart = False
+            request.rmd_detection_bypassed = True
+            request.focal_points = [FocalPoint(x, y, origin='RMD')]
+            self.context.metrics.incr('universalimages.detectors.bypassed')
+        request.fit_in = rmd_plan.fit_in
+        return self._commit(rmd_plan.crop, rmd_plan.should_crop)
+
+    def _get_synthesized_rmd(self):
+        # RMD created from the smart detectors for an earlier size.
+        if not self.context.config.UNIVERSALIMAGES_SYNTHESIZE_RMD:
+            return None
+        entry = self._get_cache_entry('synthesized')
+        if entry is None:
+            return None
+        source_digest = getattr(self.engine, 'source_digest', None)
+        if entry['source'] and source_digest and entry['source'] != source_digest:
+            return None
+        return RmdDocument(entry['rmd'])
+
+    def _synthesize_from_detectors(self):
+        # Store the result of the smart detectors as RMD, so the next
+        # sizes of the image take the RMD path instead of the detectors.
+        conf = self.context.config
+        request = self.context.request
+        if not (conf.UNIVERSALIMAGES_SYNTHESIZE_RMD and request.smart) or request.trim:
+            return
+        if conf.RESPECT_ORIENTATION and self.engine.get_orientation() not in (None, 1):
+            # The detectors run on the rotated image.
+            return
+
+        transformer = self.context.transformer
+        after_smart_detect = transformer.after_smart_detect
+        size = self.engine.size
+        source_digest = getattr(self.engine, 'source_digest', None)
+        image_url = request.image_url
+
+        def synthesize(focal_points=None, points_from_storage=False):
+            # The detectors add their points to the request, stored
+            # points are passed in.
+            points = list(focal_points or []) + [
+                point.to_dict() for point in request.focal_points]
+            values = synthesize_rmd(points, size)
+            if values is not None:
+                self._set_cache_entry(
+                    'synthesized', image_url, {'source': source_digest, 'rmd': values})
+                self.context.metrics.incr('universalimages.rmd.synthesized')
+            after_smart_detect(focal_points or [], points_from_storage)
+
+        transformer.after_smart_detect = synthesize
+
+    def _bypass_detectors(self):
+        # The editor already marked the important area, the smart
+        # detectors are not needed.
+        request = self.context.request
+        if not request.smart:
+            return
+        if not (self.xmp.get_area_values_for(b'Xmp.rmd.PivotPoint') or
+                self.xmp.get_area_values_for(b'Xmp.rmd.SafeArea')):
+            return
+        pivot_point = self._get_pivot_point()
+        request.smart = False
+        request.rmd_detection_bypassed = True
+        request.focal_points = [FocalPoint(pivot_point.x, pivot_point.y, origin='RMD')]
+        self.context.metrics.incr('universalimages.detectors.bypassed')
+
+    def _get_precomputed_plan(self):
+        # Plans of the ladder sizes are stored in the RMD index.
+        record = getattr(self.engine, 'rmd_record', None)
+        request = self.context.request
+        if record is None or request.fit_in:
+            return None
+        try:
+            return record.plans.get((int(request.width or 0), int(request.height or 0)))
+        except ValueError:
+            # 'orig'
+            return None
+
+    def _get_crop_function(self):
+        # The compiled RMD of the image, cached by the source url.
+        rmd_digest = self.xmp.digest()
+        entry = self._get_cache_entry('functions')
+        if entry is not None and entry['rmd'] == rmd_digest and \
+                tuple(entry['size']) == tuple(self.engine.size):
+            return CropFunction.load(entry['function'])
+
+        function = compile_rmd(self.xmp, self.engine.size)
+        self._set_cache_entry('functions', self.context.request.image_url, {
+            'rmd': rmd_digest,
+            'size': list(self.engine.size),
+            'function': function.dump() if function is not None else None,
+        })
+        return function
+
+    def _evaluate_crop_function(self):
+        # Requests with only a target width are looked up in the
+        # compiled crop function. Returns the crop and should_crop.
+        request = self.context.request
+        if not getattr(self.context.config, 'UNIVERSALIMAGES_CROP_FUNCTIONS', False):
+            return None
+        if request.height or not request.width or request.width == 'orig':
+            return None
+        function = self._get_crop_function()
+        result = function.evaluate(int(request.width)) if function is not None else None
+        if result is None:
+            return None
+        self.context.metrics.incr('universalimages.rmd.compiled')
+        request.fit_in = request.fit_in or result.fit_in
+        crop = result.crop
+        if result.snap:
+            crop = self._snap_to_grid(crop, function.safe_area)
+        return crop, result.should_crop
 
-        return pivot_point
+    def _get_pivot_point(self):
+        # Get the pivot point from the XML
+        return pivot_point(self.xmp, self.engine.size)
 
     def _process_crop_area(self, crop_area, context, target_width, target_height):
         for key in ['x', 'y', 'w', 'h']:
@@ -289,7 +600,7 @@ class Filter(BaseFilter):
                     crop = crop.x0, y0, crop.x1, y1
                     self.context.request.fit_in = True
 
-            return crop, should_crop, True, None
+            return self._snap_to_grid(crop, safe_area_absolute), should_crop, True, None
 
         return crop, should_crop, False, safe_area_absolute
 
@@ -346,7 +657,26 @@ class Filter(BaseFilter):
                 top = bottom - crop_height
 
         crop = left, top, right, bottom
-        return crop, True
+        return self._snap_to_grid(crop, safe_area_absolute), True
+
+    def _snap_to_grid(self, crop, safe_area_absolute):
+        # Round the crop edges to UNIVERSALIMAGES_CROP_GRID, so neighboring
+        # target sizes get the same crop box. The safe area must stay inside.
+        grid = getattr(self.context.config, 'UNIVERSALIMAGES_CROP_GRID', 0)
+        if not grid:
+            return crop
+        width, height = self.engine.size
+        left, top, right, bottom = [
+            min(max(int(round(float(value) / grid)) * grid, 0), limit)
+            for value, limit in zip(crop, (width, height, width, height))]
+        if left >= right or top >= bottom:
+            return crop
+        if safe_area_absolute:
+            x0, y0, x1, y1 = safe_area_absolute
+            if left > x0 or top > y0 or right < x1 or bottom < y1:
+                logger.debug('Snapped crop would cut the safe area.')
+                return crop
+        return left, top, right, bottom
 
     def _get_area_sort_key(self, target_aspect):
         # find the best aspect ratio
@@ -0,0 +1,394 @@
+# coding: utf-8
+"""
+Fast XMP extraction for JPEG, PNG, WebP and TIFF images.
+
+The extractors only walk the segment, chunk or IFD index of the container
+and slice the XMP packet out of the buffer. Pixel data is never read.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import struct
+import time
+import zlib
+from collections import namedtuple
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+logger = logging.getLogger('universalimages.filters')
+
+JPEG_XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+JPEG_EXTENDED_XMP_HEADER = b'http://ns.adobe.com/xmp/extension/\x00'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_XMP_KEYWORD = b'XML:com.adobe.xmp'
+TIFF_XMP_TAG = 700
+
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XML = '{http://www.w3.org/XML/1998/namespace}'
+XMP_NOTE = '{http://ns.adobe.com/xmp/note/}'
+RMD_NAMESPACE = 'http://universalimages.github.io/rmd/0.1/'
+
+# Caps on the work spent on one packet. 0 disables a cap.
+# max_bytes: Size of the packet, max_depth: Nesting of the elements,
+# max_nodes: Number of elements and attributes, timeout: Parse time in seconds.
+XmpLimits = namedtuple('XmpLimits', ['max_bytes', 'max_depth', 'max_nodes', 'timeout'])
+
+DEFAULT_LIMITS = XmpLimits(2 * 1024 * 1024, 64, 50000, 0.1)
+
+# The packet is fed to the parser in chunks, the parse time is checked in between.
+CHUNK_SIZE = 64 * 1024
+
+
+class XmpLimitError(ValueError):
+    """
+    The XMP packet exceeds a limit or has a DTD.
+    """
+
+
+def limits_from_config(config):
+    """
+    Returns the XmpLimits of the UNIVERSALIMAGES_XMP_* settings.
+    """
+    return XmpLimits(config.UNIVERSALIMAGES_XMP_MAX_BYTES,
+                     config.UNIVERSALIMAGES_XMP_MAX_DEPTH,
+                     config.UNIVERSALIMAGES_XMP_MAX_NODES,
+                     config.UNIVERSALIMAGES_XMP_TIMEOUT)
+
+
+# Prefixes exiv2 uses for the namespaces of the RMD properties.
+PREFIXES = {
+    RMD_NAMESPACE: 'rmd',
+    'http://ns.adobe.com/xmp/sType/Area#': 'stArea',
+    'http://ns.adobe.com/xap/1.0/sType/Dimensions#': 'stDim',
+}
+
+
+if bytes is str:
+    # Python 2: expat and zlib only accept the old buffer protocol.
+    def _readable(view):
+        return view.tobytes()
+else:
+    def _readable(view):
+        return view
+
+
+def _find_null(view, start, end):
+    # Offset of the first null byte, for the short text fields of PNG chunks.
+    for offset in range(start, end):
+        if view[offset:offset + 1] == b'\x00':
+            return offset
+    raise IndexError('Missing null separator')
+
+
+def jpeg_segments(view):
+    """
+    Yields the marker, start and end offset of the payload of the JPEG
+    segments before the compressed data.
+    :type view: memoryview
+    """
+    offset = 2
+    length = len(view)
+    while offset + 4 <= length:
+        if view[offset:offset + 1] != b'\xff':
+            return
+        marker = struct.unpack_from('B', view, offset + 1)[0]
+        if marker == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0xd9, 0xda):
+            # End of image or start of the compressed data.
+            return
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            offset += 2
+            continue
+        size = struct.unpack_from('>H', view, offset + 2)[0]
+        yield marker, offset + 4, min(offset + 2 + size, length)
+        offset += 2 + size
+
+
+def extract_jpeg_xmp(view):
+    for marker, start, end in jpeg_segments(view):
+        if marker == 0xe1 and \
+                view[start:start + len(JPEG_XMP_HEADER)] == JPEG_XMP_HEADER:
+            return view[start + len(JPEG_XMP_HEADER):end].tobytes()
+    return None
+
+
+def extract_extended_xmp(buffer, guid, max_bytes=0):
+    """
+    Reassembles the Extended XMP packet with the given GUID from its APP1
+    segments. The segments are copied into a buffer of the full length
+    given in their header.
+    :return: The extended packet or None if it is missing or incomplete.
+    :rtype: bytearray
+    """
+    view = memoryview(buffer)
+    header = JPEG_EXTENDED_XMP_HEADER + guid
+    packet = None
+    received = 0
+    for marker, start, end in jpeg_segments(view):
+        if marker != 0xe1 or view[start:start + len(header)] != header:
+            continue
+        length, offset = struct.unpack_from('>II', view, start + len(header))
+        data = view[start + len(header) + 8:end]
+        if packet is None:
+            if max_bytes and length > max_bytes:
+                raise XmpLimitError('Extended XMP larger than %d bytes' % max_bytes)
+            packet = bytearray(length)
+        if offset + len(data) > len(packet):
+            logger.debug('Invalid Extended XMP segment at offset %d' % offset)
+            return None
+        packet[offset:offset + len(data)] = data
+        received += len(data)
+    if packet is None or received < len(packet):
+        return None
+    return packet
+
+
+def extract_png_xmp(view, max_bytes=0):
+    offset = len(PNG_SIGNATURE)
+    length = len(view)
+    while offset + 8 <= length:
+        size, kind = struct.unpack_from('>I4s', view, offset)
+        start = offset + 8
+        if kind == b'iTXt' and view[start:start + len(PNG_XMP_KEYWORD) + 1] == \
+                PNG_XMP_KEYWORD + b'\x00':
+            end = min(start + size, length)
+            flag = start + len(PNG_XMP_KEYWORD) + 1
+            compressed = view[flag:flag + 1] == b'\x01'
+            # Skip the compression flag and method, the language tag
+            # and the translated keyword.
+            text = _find_null(view, _find_null(view, flag + 2, end) + 1, end) + 1
+            if not compressed:
+                return view[text:end].tobytes()
+            decompressor = zlib.decompressobj()
+            packet = decompressor.decompress(
+                _readable(view[text:end]), max_bytes + 1 if max_bytes else 0)
+            if max_bytes and len(packet) > max_bytes:
+                raise XmpLimitError('Packet larger than %d bytes' % max_bytes)
+            return packet
+        if kind == b'IEND':
+            return None
+        offset = start + size + 4
+    return None
+
+
+def extract_webp_xmp(view):
+    offset = 12
+    length = len(view)
+    while offset + 8 <= length:
+        kind, size = struct.unpack_from('<4sI', view, offset)
+        start = offset + 8
+        if kind == b'XMP ':
+            return view[start:start + size].tobytes()
+        offset = start + size + (size & 1)
+    return None
+
+
+def extract_tiff_xmp(view):
+    order = '<' if view[:2] == b'II' else '>'
+    ifd = struct.unpack_from(order + 'I', view, 4)[0]
+    if ifd + 2 > len(view):
+        return None
+    count = struct.unpack_from(order + 'H', view, ifd)[0]
+    for entry in range(ifd + 2, ifd + 2 + 12 * count, 12):
+        tag, kind, size, value = struct.unpack_from(order + 'HHII', view, entry)
+        if tag == TIFF_XMP_TAG:
+            if size <= 4:
+                return view[entry + 8:entry + 8 + size].tobytes()
+            return view[value:value + size].tobytes()
+    return None
+
+
+def extract_xmp(buffer, max_bytes=0):
+    """
+    Returns the XMP packet of an image. The container is read through a
+    memoryview, only the packet is copied.
+    :param buffer: The image file (bytes or memoryview)
+    :param max_bytes: Maximum size of compressed packets after decompression.
+    :return: The XMP packet or None if the image has none.
+    :rtype: bytes
+    """
+    view = memoryview(buffer)
+    head = view[:12].tobytes()
+    try:
+        if head.startswith(b'\xff\xd8'):
+            return extract_jpeg_xmp(view)
+        if head.startswith(PNG_SIGNATURE):
+            return extract_png_xmp(view, max_bytes)
+        if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+            return extract_webp_xmp(view)
+        if head[:4] in (b'II*\x00', b'MM\x00*'):
+            return extract_tiff_xmp(view)
+    except (struct.error, IndexError, TypeError, zlib.error) as e:
+        logger.debug('Invalid image container: %s' % e)
+    return None
+
+
+def _key(tag):
+    if not tag.startswith('{'):
+        return tag
+    namespace, name = tag[1:].split('}')
+    return '%s:%s' % (PREFIXES.get(namespace, namespace), name)
+
+
+def _fields(element):
+    return [(name, value) for name, value in element.attrib.items()
+            if not name.startswith(RDF) and not name.startswith(XML)]
+
+
+def _parse_value(element, path, values):
+    # Stores the value of a property element in the exiv2 key format.
+    resource = element.get(RDF + 'parseType') == 'Resource'
+    fields = _fields(element)
+    children = list(element)
+
+    if children and children[0].tag in (RDF + 'Bag', RDF + 'Seq', RDF + 'Alt'):
+        container = children[0]
+        values[path] = 'type="%s"' % container.tag[len(RDF):]
+        for index, item in enumerate(container.findall(RDF + 'li'), 1):
+            _parse_value(item, '%s[%d]' % (path, index), values)
+        return
+
+    if children and children[0].tag == RDF + 'Description':
+        fields += _fields(children[0])
+        children = list(children[0])
+        resource = True
+
+    if resource or fields or children:
+        values[path] = 'type="Struct"'
+        for name, value in fields:
+            values['%s/%s' % (path, _key(name))] = value
+        for child in children:
+            _parse_value(child, '%s/%s' % (path, _key(child.tag)), values)
+        return
+
+    values[path] = (element.text or '').strip()
+
+
+class _Done(Exception):
+    # Raised by the handlers to stop parsing.
+    pass
+
+
+def _name(name):
+    # expat separates the namespace with '}', ElementTree uses '{ns}name'.
+    return '{%s' % name if '}' in name else name
+
+
+class _Parser(object):
+    """
+    Builds the XMP tree with expat until the end of the description which
+    holds the RMD properties. Enforces the limits and refuses DTDs.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.builder = ElementTree.TreeBuilder()
+        self.parents = []
+        self.nodes = 0
+        self.deadline = time.time() + limits.timeout if limits.timeout else None
+        self.values = {}
+        self.guid = None
+
+        self.parser = expat.ParserCreate(namespace_separator='}')
+        self.parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+        self.parser.StartDoctypeDeclHandler = self.refuse
+        self.parser.EntityDeclHandler = self.refuse
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.builder.data
+
+    def refuse(self, *args):
+        raise XmpLimitError('DTDs and entities are not allowed')
+
+    def check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise XmpLimitError('Parse time exceeds %ss' % self.limits.timeout)
+
+    def start(self, tag, attrib):
+        self.nodes += 1 + len(attrib)
+        if self.limits.max_nodes and self.nodes > self.limits.max_nodes:
+            raise XmpLimitError('More than %d nodes' % self.limits.max_nodes)
+        if self.limits.max_depth and len(self.parents) >= self.limits.max_depth:
+            raise XmpLimitError('Elements nested deeper than %d' % self.limits.max_depth)
+        self.check_time()
+        tag = _name(tag)
+        self.parents.append(tag)
+        self.builder.start(tag, dict((_name(name), value) for name, value in attrib.items()))
+
+    def end(self, tag):
+        element = self.builder.end(_name(tag))
+        self.parents.pop()
+        if element.tag != RDF + 'Description' or not self.parents or \
+                self.parents[-1] != RDF + 'RDF':
+            return
+        for name, value in element.attrib.items():
+            if name.startswith('{%s}' % RMD_NAMESPACE):
+                self.values['Xmp.rmd.%s' % name.split('}')[1]] = value
+        self.guid = element.get(XMP_NOTE + 'HasExtendedXMP') or self.guid
+        for child in element:
+            if child.tag.startswith('{%s}' % RMD_NAMESPACE):
+                _parse_value(child, 'Xmp.rmd.%s' % child.tag.split('}')[1], self.values)
+            elif child.tag == XMP_NOTE + 'HasExtendedXMP':
+                self.guid = (child.text or '').strip()
+        if self.values:
+            raise _Done()
+
+    def parse(self, packet):
+        if self.limits.max_bytes and len(packet) > self.limits.max_bytes:
+            raise XmpLimitError('Packet larger than %d bytes' % self.limits.max_bytes)
+        view = memoryview(packet)
+        try:
+            for offset in range(0, len(packet), CHUNK_SIZE):
+                self.parser.Parse(_readable(view[offset:offset + CHUNK_SIZE]), False)
+                self.check_time()
+            self.parser.Parse(b'', True)
+        except _Done:
+            pass
+        return self.values, self.guid
+
+
+def _parse_packet(packet, limits=DEFAULT_LIMITS):
+    # Returns the RMD values and the GUID of the Extended XMP.
+    return _Parser(limits).parse(packet)
+
+
+def parse_rmd(packet, limits=DEFAULT_LIMITS):
+    """
+    Parses the RMD properties of an XMP packet.
+    :type limits: XmpLimits
+    :return: dictionary of exiv2 style keys (e.g. Xmp.rmd.SafeArea/stArea:x)
+             and their text values.
+    :rtype: dict
+    :raises XmpLimitError: if the packet exceeds the limits or has a DTD.
+    """
+    return _parse_packet(packet, limits)[0]
+
+
+def read_rmd(buffer, limits=DEFAULT_LIMITS):
+    """
+    Extracts the XMP packet of an image and parses its RMD properties.
+    The Extended XMP of JPEG images is only read if the standard packet
+    has no RMD.
+    :type limits: XmpLimits
+    :return: dictionary of keys and values, empty if the image has no RMD.
+    :rtype: dict
+    :raises XmpLimitError: if the packet exceeds the limits or has a DTD.
+    """
+    packet = extract_xmp(buffer, limits.max_bytes)
+    if not packet:
+        return {}
+    try:
+        values, guid = _parse_packet(packet, limits)
+        if values or not guid or memoryview(buffer)[:2] != b'\xff\xd8':
+            return values
+        extended = extract_extended_xmp(buffer, guid.encode('ascii'), limits.max_bytes)
+        if extended is None:
+            logger.debug('Extended XMP %s not found' % guid)
+            return values
+        return _parse_packet(extended, limits)[0]
+    except (expat.ExpatError, struct.error, UnicodeError) as e:
+        logger.debug('Invalid XMP packet: %s' % e)
+        return {}
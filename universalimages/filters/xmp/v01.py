@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import hashlib
 import logging
 from collections import namedtuple
 
@@ -111,6 +112,17 @@ class Xmp_API(object):
                 return False
         return True
 
+    def digest(self):
+        """
+        Returns a digest of the RMD metadata.
+        :rtype: str
+        """
+        sha = hashlib.sha1()
+        for node in sorted(self.metadata.xmp_keys):
+            if node.startswith('Xmp.rmd.'):
+                sha.update((u'%s=%s\n' % (node, self.get_value_for(node))).encode('utf-8'))
+        return sha.hexdigest()
+
     def stArea_to_absolute(self, stArea_values, image_size):
         """
         Converts the relative stArea values to absolute coordinates.
@@ -156,3 +168,48 @@ class Xmp_API(object):
         """
         return self.stArea_to_absolute(
                 self.get_area_values_for(node), image_size)
+
+
+def synthesize_rmd(focal_points, image_size):
+    """
+    Creates RMD values from the focal points found by the smart detectors.
+    The SafeArea encloses all features, the PivotPoint is their weighted
+    centroid. Below the width of the SafeArea, the image is cropped to it.
+
+    :param focal_points: Focal points as dictionaries (x, y, z, width, height)
+    :param image_size: Size of the image the points were detected in.
+    :return: dictionary of XMP keys and values, or None without points.
+    :rtype: dict or None
+    """
+    if not focal_points:
+        return None
+    width, height = image_size
+    weights = [float(p.get('z', 1)) for p in focal_points]
+    if not sum(weights):
+        weights = [1.0] * len(focal_points)
+    pivot_x = sum(float(p['x']) * w for p, w in zip(focal_points, weights)) / sum(weights)
+    pivot_y = sum(float(p['y']) * w for p, w in zip(focal_points, weights)) / sum(weights)
+
+    values = {
+        u'Xmp.rmd.AppliedToDimensions': u'type="Struct"',
+        u'Xmp.rmd.AppliedToDimensions/stDim:w': u'%d' % width,
+        u'Xmp.rmd.AppliedToDimensions/stDim:h': u'%d' % height,
+        u'Xmp.rmd.PivotPoint': u'type="Struct"',
+        u'Xmp.rmd.PivotPoint/stArea:x': u'%r' % (pivot_x / width),
+        u'Xmp.rmd.PivotPoint/stArea:y': u'%r' % (pivot_y / height),
+    }
+
+    x0 = max(min(float(p['x']) - float(p.get('width', 1)) / 2.0 for p in focal_points), 0)
+    y0 = max(min(float(p['y']) - float(p.get('height', 1)) / 2.0 for p in focal_points), 0)
+    x1 = min(max(float(p['x']) + float(p.get('width', 1)) / 2.0 for p in focal_points), width)
+    y1 = min(max(float(p['y']) + float(p.get('height', 1)) / 2.0 for p in focal_points), height)
+    if x1 - x0 > 1 and y1 - y0 > 1:
+        values.update({
+            u'Xmp.rmd.SafeArea': u'type="Struct"',
+            u'Xmp.rmd.SafeArea/stArea:x': u'%r' % ((x0 + x1) / 2.0 / width),
+            u'Xmp.rmd.SafeArea/stArea:y': u'%r' % ((y0 + y1) / 2.0 / height),
+            u'Xmp.rmd.SafeArea/stArea:w': u'%r' % ((x1 - x0) / width),
+            u'Xmp.rmd.SafeArea/stArea:h': u'%r' % ((y1 - y0) / height),
+            u'Xmp.rmd.SafeArea/rmd:MaxWidth': u'%d' % int(round(x1 - x0)),
+        })
+    return values
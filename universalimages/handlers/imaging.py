@@ -0,0 +1,391 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import datetime
+import functools
+import logging
+import time
+
+import tornado.gen as gen
+from thumbor.filters import PHASE_AFTER_LOAD
+from thumbor.handlers import imaging, FetchResult
+from thumbor.loaders import LoaderResult
+from thumbor.result_storages import ResultStorageResult
+from thumbor.transformer import Transformer
+
+from .. import config  # NOQA  Defines the configuration options.
+from ..admission import get_pixel_budget, image_size, estimate_cost
+from ..budget import read_deferred_entry
+from ..caches import get_cache
+from ..caches.regions import get_region_cache, can_use_region, source_validator
+from ..coalescing import SingleFlight, FlightError
+from ..ladder import clone_engine
+from ..plan import (
+    etag, etag_matches, request_key, load_plan, final_dimensions, canonical_key_for)
+from ..prefetch import can_prefetch, prefetch
+from ..profiling import start_profile, stop_profile
+
+logger = logging.getLogger('universalimages.handlers')
+
+# Headers which are set by tornado for each response.
+SKIPPED_HEADERS = ('Content-Length', 'Date', 'Transfer-Encoding')
+
+
+class AdmissionLoader(object):
+    """
+    Wraps the loader of a request. The loaded image is only returned
+    to the handler, which decodes it, once the request is admitted.
+    """
+
+    def __init__(self, loader, admit):
+        self.loader = loader
+        self.admit = admit
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def load(self, context, url, callback=None):
+        if callback is not None:
+            # Images loaded by filters, e.g. watermarks.
+            return self.loader.load(context, url, callback)
+        return self._load(context, url)
+
+    @gen.coroutine
+    def _load(self, context, url):
+        result = yield gen.maybe_future(self.loader.load(context, url))
+        buffer = result.buffer if isinstance(result, LoaderResult) else result
+        if buffer is not None:
+            admitted = yield self.admit(buffer)
+            if not admitted:
+                result = LoaderResult(successful=False, error=LoaderResult.ERROR_TIMEOUT)
+        raise gen.Return(result)
+
+
+class AdmissionMixin(object):
+    """
+    Decodes the images of a handler only once the request is admitted by
+    the pixel budget. The handler returns the sizes it renders from the
+    source with get_output_sizes (a list or a future of it) and calls
+    release_admission when it is finished.
+    """
+
+    admitted_cost = None
+
+    def get_output_sizes(self, source_size):
+        raise NotImplementedError()
+
+    @gen.coroutine
+    def admit(self, buffer):
+        """
+        Waits until the pixel budget admits the decoding of the image.
+        :return: False if the request timed out in the queue.
+        """
+        budget = get_pixel_budget(self.context.config)
+        source_size = image_size(buffer)
+        if budget is None or source_size is None or self.admitted_cost is not None:
+            raise gen.Return(True)
+
+        output_sizes = yield gen.maybe_future(self.get_output_sizes(source_size))
+        metrics = self.context.metrics
+        start = time.time()
+        future = budget.acquire(estimate_cost(source_size, *output_sizes),
+                                sum(width * height for width, height in output_sizes))
+        if not future.done():
+            metrics.incr('universalimages.admission.queued')
+        # The metrics of thumbor have no gauges, custom ones may.
+        gauge = getattr(metrics, 'gauge', None)
+        if gauge is not None:
+            gauge('universalimages.admission.queue_depth', len(budget))
+        try:
+            self.admitted_cost = yield gen.with_timeout(
+                datetime.timedelta(seconds=self.context.config.UNIVERSALIMAGES_ADMISSION_TIMEOUT),
+                future)
+        except gen.TimeoutError:
+            budget.cancel(future)
+            metrics.incr('universalimages.admission.timeout')
+            raise gen.Return(False)
+        finally:
+            metrics.timing('universalimages.admission.wait', (time.time() - start) * 1000)
+        if self._finished:
+            # on_finish has been called while the request was waiting.
+            budget.release(self.admitted_cost)
+            self.admitted_cost = None
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _fetch_admitted(self, url):
+        if get_pixel_budget(self.context.config) is None:
+            result = yield super(AdmissionMixin, self)._fetch(url)
+            raise gen.Return(result)
+
+        loader = self.context.modules.loader
+        self.context.modules.loader = AdmissionLoader(loader, self.admit)
+        try:
+            result = yield super(AdmissionMixin, self)._fetch(url)
+        finally:
+            self.context.modules.loader = loader
+
+        if result.successful and result.engine is None and result.buffer is not None:
+            # From the storage. The handler decodes the image after _fetch.
+            admitted = yield self.admit(result.buffer)
+            if not admitted:
+                result = FetchResult(successful=False, loader_error=LoaderResult.ERROR_TIMEOUT)
+        raise gen.Return(result)
+
+    def release_admission(self):
+        if self.admitted_cost is not None:
+            get_pixel_budget(self.context.config).release(self.admitted_cost)
+            self.admitted_cost = None
+
+
+class ImagingHandler(AdmissionMixin, imaging.ImagingHandler):
+    """
+    Imaging handler which coalesces concurrent identical requests.
+    The first request renders the image, the other ones wait for its result.
+
+    Responses of rmd() requests carry a strong ETag derived from the source,
+    the RMD metadata and the crop plan. Conditional requests are answered
+    from the caches without loading the image.
+
+    If the region cache is enabled, requests with a known crop plan are
+    rendered from a cached region of the decoded source image.
+
+    With a pixel budget, the images are only decoded once the request
+    is admitted by the scheduler.
+
+    A fraction of the rmd() requests (UNIVERSALIMAGES_PROFILE_RATE) is
+    sampled by the profiler until the response is finished.
+
+    With UNIVERSALIMAGES_PREFETCH, the other ladder sizes of a source which
+    was loaded and decoded for an rmd() request are rendered in the
+    background once the response is finished.
+    """
+
+    flights = SingleFlight()
+
+    def initialize(self, context):
+        super(ImagingHandler, self).initialize(context)
+        self.flight_key = None
+        self.flight_buffer = None
+        self.admitted_cost = None
+        self.profile = None
+        self.prefetch_master = None
+        self.rmd_etag = None
+
+    @gen.coroutine
+    def get_flight_key(self):
+        """
+        Requests which resolve to the same crop plan share the key once
+        the canonical key of their URL is known.
+        """
+        key = request_key(self.context)
+        alias = yield get_cache('aliases', self.context.config).get_async(key)
+        raise gen.Return(alias or key)
+
+    @gen.coroutine
+    def get_rmd_etag(self):
+        """
+        Returns the ETag of the derivative if the crop plan and the
+        source digests of this request are cached.
+        :return: (ETag, time the source digests were cached) or (None, None)
+        """
+        conf = self.context.config
+        if not conf.UNIVERSALIMAGES_ETAGS:
+            raise gen.Return((None, None))
+        key, document = yield [
+            get_cache('aliases', conf).get_async(request_key(self.context)),
+            get_cache('documents', conf).get_async(self.context.request.image_url)]
+        if key is None or document is None:
+            raise gen.Return((None, None))
+        raise gen.Return((etag(document['source'], document['rmd'], key), document['time']))
+
+    def compute_etag(self):
+        # A rendered image has the ETag of its own crop plan and source.
+        request = self.context.request
+        document = getattr(request, 'rmd_document', None)
+        key = canonical_key_for(self.context)
+        if self.context.config.UNIVERSALIMAGES_ETAGS and document is not None and key is not None:
+            return etag(document['source'], document['rmd'], key)
+        return self.rmd_etag or super(ImagingHandler, self).compute_etag()
+
+    @gen.coroutine
+    def execute_image_operations(self):
+        conf = self.context.config
+        self.rmd_etag, cached = yield self.get_rmd_etag()
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match and self.rmd_etag is not None and \
+                time.time() - cached <= conf.UNIVERSALIMAGES_ETAG_CACHE_TTL and \
+                etag_matches(self.rmd_etag, if_none_match):
+            self.context.metrics.incr('universalimages.etag.not_modified')
+            self.set_header('Etag', self.rmd_etag)
+            self.set_status(304)
+            self.finish()
+            return
+
+        self.profile = start_profile(self.context)
+        if not conf.UNIVERSALIMAGES_COALESCING:
+            yield super(ImagingHandler, self).execute_image_operations()
+            return
+
+        key = yield self.get_flight_key()
+        if self.flights.lead(key):
+            self.flight_key = key
+            yield super(ImagingHandler, self).execute_image_operations()
+            return
+
+        self.context.metrics.incr('universalimages.coalescing.wait')
+        try:
+            buffer, headers = yield self.flights.wait(
+                key, conf.UNIVERSALIMAGES_COALESCING_TIMEOUT)
+        except gen.TimeoutError:
+            logger.warning('Timeout while waiting for the coalesced request %s' % key)
+            self.context.metrics.incr('universalimages.coalescing.timeout')
+        except FlightError as e:
+            self.context.metrics.incr('universalimages.coalescing.error')
+            if conf.UNIVERSALIMAGES_COALESCING_ERRORS == 'propagate' and e.status >= 400:
+                self._error(e.status)
+                return
+        else:
+            self.context.metrics.incr('universalimages.coalescing.hit')
+            for name, value in headers:
+                self.set_header(name, value)
+            self.write(buffer)
+            self.finish()
+            return
+
+        # Render the image on our own.
+        yield super(ImagingHandler, self).execute_image_operations()
+
+    @gen.coroutine
+    def get_region_engine(self):
+        """
+        Returns the engine of the request with the cached region which
+        contains the crop box of the request, or None.
+        The region is not copied, engine operations create new images.
+        """
+        request = self.context.request
+        conf = self.context.config
+        regions = get_region_cache(conf)
+        if regions is None or not request.filters or 'rmd(' not in request.filters:
+            raise gen.Return(None)
+        dumped = yield get_cache('plans', conf).get_async(request.url)
+        rmd_plan = load_plan(dumped)
+        if rmd_plan is None:
+            raise gen.Return(None)
+        validator = source_validator(self.context)
+        if validator is None:
+            document = yield get_cache('documents', conf).get_async(request.image_url)
+            validator = document['source'] if document is not None else None
+        region = regions.get(request.image_url, rmd_plan.crop, validator)
+        if region is None:
+            raise gen.Return(None)
+        region_box, template = region
+        if not can_use_region(self.context, template):
+            raise gen.Return(None)
+
+        engine = self.context.modules.engine
+        regions.restore(template, engine)
+        request.engine = engine
+        request.extension = engine.extension
+
+        left, top, right, bottom = rmd_plan.crop
+        request.crop = {
+            'left': left - region_box[0],
+            'top': top - region_box[1],
+            'right': right - region_box[0],
+            'bottom': bottom - region_box[1],
+        }
+        request.should_crop = True
+        request.fit_in = rmd_plan.fit_in
+        request.rmd_plan = rmd_plan
+        request.rmd_region = region_box
+        raise gen.Return(engine)
+
+    @gen.coroutine
+    def get_image(self):
+        engine = yield self.get_region_engine()
+        if engine is None:
+            yield super(ImagingHandler, self).get_image()
+            return
+
+        self.context.metrics.incr('universalimages.region.hit')
+        self.context.transformer = Transformer(self.context)
+
+        def transform():
+            self.context.transformer.transform(
+                functools.partial(self.after_transform, self.context))
+
+        self.filters_runner.apply_filters(PHASE_AFTER_LOAD, transform)
+
+    @gen.coroutine
+    def get_output_sizes(self, source_size):
+        """
+        Returns the expected size of the derivative, from the crop plan if it
+        is known or else from the requested dimensions.
+        """
+        request = self.context.request
+        dumped = yield get_cache('plans', self.context.config).get_async(request.url)
+        rmd_plan = load_plan(dumped)
+        if rmd_plan is not None:
+            raise gen.Return([(rmd_plan.width, rmd_plan.height)])
+        raise gen.Return([final_dimensions((0, 0) + tuple(source_size), request.width,
+                                           request.height, request.fit_in)])
+
+    @gen.coroutine
+    def _fetch(self, url):
+        yield read_deferred_entry(self.context)
+        result = yield self._fetch_admitted(url)
+        if result.successful and result.engine is None and result.buffer is not None and \
+                (yield can_prefetch(self.context)):
+            self.load_stored_source(result)
+        if result.successful and result.engine is not None and \
+                (yield can_prefetch(self.context, result.engine)):
+            # Decoded from the loaded source. The copy keeps the decoded
+            # image, the request creates new images when it is transformed.
+            self.prefetch_master = clone_engine(result.engine, self.context)
+        raise gen.Return(result)
+
+    def load_stored_source(self, result):
+        """
+        Decodes a source served from the storage, which thumbor decodes in
+        get_image, so its ladder can be prefetched. If it fails, get_image
+        decodes it again and handles the error.
+        """
+        engine = self.context.request.engine
+        try:
+            engine.load(result.buffer, self.context.request.extension)
+        except Exception as e:
+            logger.warning('Could not decode the stored source %s: %s' % (
+                self.context.request.image_url, e))
+            return
+        if engine.image is not None:
+            result.engine = engine
+
+    def _write_results_to_client(self, context, results, content_type):
+        # finish() calls on_finish, which hands the result to the waiting requests.
+        if self.flight_key is not None:
+            self.flight_buffer = results.buffer if isinstance(results, ResultStorageResult) \
+                else results
+        super(ImagingHandler, self)._write_results_to_client(
+            context, results, content_type)
+
+    def on_finish(self):
+        if self.flight_key is not None:
+            if self.flight_buffer is not None and self.get_status() == 200:
+                headers = [(name, value) for name, value in self._headers.get_all()
+                           if name not in SKIPPED_HEADERS]
+                self.flights.resolve(self.flight_key, (self.flight_buffer, headers))
+            else:
+                # The leader finished without a result. Release the waiting requests.
+                self.flights.reject(self.flight_key, FlightError(self.get_status()))
+            self.flight_key = self.flight_buffer = None
+        self.release_admission()
+        if self.profile is not None:
+            stop_profile(self.context, self.profile)
+            self.profile = None
+        if self.prefetch_master is not None:
+            if self.get_status() == 200:
+                prefetch(self.context, self.prefetch_master)
+            self.prefetch_master = None
+        super(ImagingHandler, self).on_finish()
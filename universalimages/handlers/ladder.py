@@ -0,0 +1,200 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import functools
+import io
+import logging
+import uuid
+import zipfile
+
+import tornado.gen as gen
+import tornado.web
+from thumbor.context import RequestParameters
+from thumbor.engines import BaseEngine
+from thumbor.handlers import ContextHandler
+from thumbor.loaders import LoaderResult
+from thumbor.utils import EXTENSION
+
+from .. import config  # NOQA  Defines the configuration options.
+from ..ladder import create_context, load_master, wait_for_metadata, render_many
+from ..plan import parse_ladder, final_dimensions
+from .imaging import AdmissionMixin
+
+logger = logging.getLogger('universalimages.handlers')
+
+URL_REGEX = r'/ladder/(?P<hash>[^/]+)/(?P<sizes>[\dx,]+)/(?P<image>.+)'
+
+LOADER_ERRORS = {
+    LoaderResult.ERROR_NOT_FOUND: 404,
+    LoaderResult.ERROR_UPSTREAM: 502,
+    LoaderResult.ERROR_TIMEOUT: 504,
+}
+
+
+def multipart(parts, boundary):
+    """
+    Encodes the derivatives as a multipart/mixed body.
+    :param parts: List of (url, content type, buffer)
+    """
+    body = []
+    for url, content_type, buffer in parts:
+        body.append(('--%s\r\nContent-Type: %s\r\nContent-Location: %s\r\n'
+                     'Content-Length: %d\r\n\r\n' % (
+                         boundary, content_type, url, len(buffer))).encode('utf-8'))
+        body.append(buffer)
+        body.append(b'\r\n')
+    body.append(('--%s--\r\n' % boundary).encode('utf-8'))
+    return b''.join(body)
+
+
+def clamp_ladder(ladder, max_width=0, max_height=0):
+    """
+    Limits the sizes to MAX_WIDTH and MAX_HEIGHT, like thumbor does for
+    the size of a request. Sizes which become equal are only rendered once.
+    """
+    clamped = []
+    for width, height in ladder:
+        if max_width and width > max_width:
+            width = max_width
+        if max_height and height > max_height:
+            height = max_height
+        if (width, height) not in clamped:
+            clamped.append((width, height))
+    return clamped
+
+
+def zip_archive(parts):
+    """
+    Stores the derivatives in an uncompressed zip file.
+    :param parts: List of (name, content type, buffer)
+    """
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        for name, content_type, buffer in parts:
+            zip_file.writestr(name, buffer)
+    return archive.getvalue()
+
+
+class LadderHandler(AdmissionMixin, ContextHandler):
+    """
+    Renders several rmd() derivatives of the same image from a single decode:
+    /ladder/unsafe/320,640,800x600/path/to/image.jpg
+
+    The response is a multipart/mixed document with one part per size.
+    Each part has the URL of the equivalent rmd() request as Content-Location.
+    With ?format=zip, the derivatives are returned as a zip file.
+
+    The sizes are limited to MAX_WIDTH and MAX_HEIGHT. With a pixel budget,
+    the image is decoded once the cost of all derivatives is admitted.
+    With UNIVERSALIMAGES_RMD_BUDGET, the metadata is read in a worker thread
+    while the image is decoded.
+    """
+
+    ladder = ()
+
+    @tornado.web.asynchronous
+    def get(self, **kw):
+        self.render_ladder(**kw)
+
+    @gen.coroutine
+    def render_ladder(self, hash, sizes, image):
+        conf = self.context.config
+        unsafe = hash == 'unsafe'
+        if unsafe and not conf.ALLOW_UNSAFE_URL:
+            self._error(400, 'URL has unsafe but unsafe is not allowed by the config: %s' % self.request.path)
+            return
+        if not unsafe:
+            signer = self.context.modules.url_signer(self.context.server.security_key)
+            if not signer.validate(hash, '%s/%s' % (sizes, image)):
+                self._error(400, 'Malformed URL: %s' % self.request.path)
+                return
+
+        try:
+            ladder = parse_ladder(size for size in sizes.split(',') if size)
+        except ValueError:
+            ladder = []
+        if not ladder or len(ladder) > conf.UNIVERSALIMAGES_LADDER_MAX_SIZES:
+            self._error(400, 'Invalid number of sizes: %s' % sizes)
+            return
+        self.ladder = clamp_ladder(ladder, conf.MAX_WIDTH, conf.MAX_HEIGHT)
+
+        # With an RMD budget, the engine reads the metadata while it decodes.
+        self.context.request = RequestParameters(
+            image=image, url=self.request.path, unsafe=unsafe, hash=hash, filters='rmd()')
+        # The ladder has no plans deferred by the rmd filter.
+        self.context.request.rmd_deferred = None
+        if not self.validate(image):
+            self._error(400, 'No original image was specified in the given URL')
+            return
+
+        try:
+            result = yield self._fetch(image)
+        except Exception as e:
+            logger.error('[LadderHandler] could not load %s: %s' % (image, e))
+            self._error(400)
+            return
+        if not result.successful:
+            self._error(LOADER_ERRORS.get(result.loader_error, 500))
+            return
+
+        try:
+            importer = self.context.modules.importer
+            accepts_webp = 'image/webp' in self.request.headers.get('Accept', '')
+            contexts = [create_context(conf, importer, image, width, height, unsafe=unsafe,
+                                       accepts_webp=accepts_webp)
+                        for width, height in self.ladder]
+            self.context.thread_pool.queue(
+                operation=functools.partial(self.render_master, result, contexts),
+                callback=functools.partial(self.write_ladder, contexts))
+        except Exception as e:
+            logger.exception('[LadderHandler] could not render %s: %s' % (image, e))
+            self._error(500)
+
+    def _fetch(self, url):
+        return self._fetch_admitted(url)
+
+    def render_master(self, result, contexts):
+        # Runs in the thread pool. A source from the storage is not decoded yet.
+        if result.engine is None:
+            master = load_master(self.context, result.buffer, self.context.request.extension)
+        else:
+            master = wait_for_metadata(result.engine, result.buffer)
+        return render_many(master, contexts)
+
+    def get_output_sizes(self, source_size):
+        return [final_dimensions((0, 0) + tuple(source_size), width, height, False)
+                for width, height in self.ladder]
+
+    def write_ladder(self, contexts, future):
+        try:
+            buffers = future.result()
+        except Exception as e:
+            logger.exception('[LadderHandler] could not render %s: %s' % (
+                self.context.request.image_url, e))
+            self._error(500)
+            return
+
+        parts = []
+        for context, buffer in zip(contexts, buffers):
+            content_type = BaseEngine.get_mimetype(buffer)
+            if self.get_argument('format', None) == 'zip':
+                name = '%sx%s%s' % (context.request.width, context.request.height,
+                                    EXTENSION.get(content_type, '.jpg'))
+            else:
+                name = context.request.url
+            parts.append((name, content_type, buffer))
+
+        if self.context.config.AUTO_WEBP:
+            self.set_header('Vary', 'Accept')
+        if self.get_argument('format', None) == 'zip':
+            self.set_header('Content-Type', 'application/zip')
+            self.write(zip_archive(parts))
+        else:
+            boundary = uuid.uuid4().hex
+            self.set_header('Content-Type', 'multipart/mixed; boundary=%s' % boundary)
+            self.write(multipart(parts, boundary))
+        self.finish()
+
+    def on_finish(self):
+        self.release_admission()
+        super(LadderHandler, self).on_finish()
@@ -0,0 +1,223 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import copy
+
+from thumbor.context import Context, RequestParameters
+from thumbor.handlers import BaseHandler
+from thumbor.transformer import Transformer
+from thumbor.url import Url
+from thumbor.url_signers.base64_hmac_sha1 import UrlSigner
+
+from .filters.rmd import Filter
+
+
+def derivative_url(config, source, width, height, filters='rmd()', unsafe=True):
+    """
+    Returns the thumbor URL path of a derivative, as used by the result storage.
+    :param unsafe: Create an unsafe URL instead of a signed one.
+    """
+    options = Url.generate_options(width=width, height=height, filters=filters)
+    path = '%s/%s' % (options, source.lstrip('/'))
+    if unsafe:
+        return '/unsafe/%s' % path
+    signature = UrlSigner(config.SECURITY_KEY).signature(path)
+    return '/%s/%s' % (signature, path)
+
+
+def create_context(config, importer, source, width, height, unsafe=True, accepts_webp=False):
+    """
+    Creates the thumbor context for the rmd() derivative of source with the
+    given size, the same way the imaging handler does for a request.
+    :param accepts_webp: The client accepts WebP images (for AUTO_WEBP).
+    """
+    context = Context(config=config, importer=importer)
+    url = derivative_url(config, source, width, height, unsafe=unsafe)
+    context.request = RequestParameters(
+        width=width, height=height, filters='rmd()', image=source, url=url,
+        unsafe=unsafe, hash=None if unsafe else url.split('/')[1])
+    context.request.accepts_webp = accepts_webp
+    return context
+
+
+def clone_engine(master, context):
+    """
+    Returns a copy of a loaded engine for another request. The decoded image
+    is shared: the engine operations do not modify it but create new images.
+    """
+    engine = copy.copy(master)
+    engine.context = context
+    return engine
+
+
+def load_master(context, buffer, extension=None):
+    """
+    Decodes the source image once. The returned engine can be passed
+    to render() for any number of derivatives.
+    """
+    master = context.modules.engine
+    master.load(buffer, extension)
+    wait_for_metadata(master, buffer)
+    master.normalize()
+    return master
+
+
+def wait_for_metadata(master, buffer):
+    """
+    Makes the metadata of a decoded master available to the derivatives,
+    whatever the RMD budget. Blocks on the metadata task of the engine.
+    """
+    if getattr(master, 'deferred_plan', None) is not None:
+        master.metadata = master.read_metadata(buffer, master.extension)
+    elif getattr(master, 'metadata_task', None) is not None:
+        master.metadata = master.metadata_task.future.result()
+    master.metadata_task = master.deferred_plan = None
+    return master
+
+
+def plan(master, context):
+    """
+    Runs the rmd filter for the derivative on a copy of the master engine.
+    No pixels are touched.
+    :return: The crop plan or None if the image has no valid RMD.
+    """
+    engine = context.request.engine = clone_engine(master, context)
+    context.transformer = Transformer(context)
+
+    Filter.pre_compile()
+    fltr = Filter('rmd()', context)
+    fltr.engine = engine
+    fltr.run()
+    return getattr(context.request, 'rmd_plan', None)
+
+
+def _handler_function(name):
+    # A method of thumbor's BaseHandler which does not use the handler.
+    return BaseHandler.__dict__[name]
+
+
+def encode(context):
+    """
+    Encodes the transformed image of the derivative like the imaging handler
+    (BaseHandler._load_results): in the requested format, as WebP with
+    AUTO_WEBP or in the format of the source, reduced to max_bytes and
+    passed through the optimizers.
+    """
+    request = context.request
+    engine = request.engine
+    if request.format:
+        extension = '.%s' % request.format
+    elif _handler_function('is_webp')(None, context):
+        extension = '.webp'
+    else:
+        extension = engine.extension
+
+    quality = request.quality
+    if quality is None:
+        if extension == '.webp' and context.config.WEBP_QUALITY is not None:
+            quality = context.config.WEBP_QUALITY
+        else:
+            quality = context.config.QUALITY
+
+    results = engine.read(extension, quality)
+    if request.max_bytes is not None:
+        results = _handler_function('reload_to_fit_in_kb')(
+            None, engine, results, extension, quality, request.max_bytes)
+    return _handler_function('optimize')(None, context, extension, results)
+
+
+def render(master, context):
+    """
+    Renders one derivative from the decoded master image. Runs the rmd filter,
+    the thumbor transformer and the encoder like the live rmd() path.
+    :return: The encoded image
+    :rtype: bytes
+    """
+    plan(master, context)
+    engine = context.request.engine
+    if context.config.RESPECT_ORIENTATION:
+        engine.reorientate()
+    context.transformer.img_operation_worker()
+    return encode(context)
+
+
+def _crop_box(context):
+    request = context.request
+    if request.should_crop:
+        crop = request.crop
+        return crop['left'], crop['top'], crop['right'], crop['bottom']
+    return (0, 0) + tuple(request.engine.size)
+
+
+def _find_intermediate(rendered, box, scale):
+    # The smallest rendered image which contains the box in a high enough
+    # resolution.
+    best = None
+    for candidate in rendered:
+        c_box, c_scale, c_image = candidate
+        if (c_box[0] <= box[0] and c_box[1] <= box[1] and
+                c_box[2] >= box[2] and c_box[3] >= box[3] and
+                c_scale[0] >= scale[0] and c_scale[1] >= scale[1]):
+            if best is None or c_scale[0] < best[1][0]:
+                best = candidate
+    return best
+
+
+def render_many(master, contexts, chain=True):
+    """
+    Renders several derivatives of the same decoded master image.
+    The crop plans of all derivatives are computed first. Then the derivatives
+    are rendered largest first. With chain=True, each derivative is resized
+    from the smallest already rendered derivative which contains its crop box
+    in a high enough resolution, instead of from the master.
+    The chained results are not byte identical to the live rmd() path, because
+    they are resampled more than once.
+    :return: The encoded images in the order of the contexts.
+    :rtype: list
+    """
+    plans = [plan(master, context) for context in contexts]
+    if chain and master.context.config.RESPECT_ORIENTATION and \
+            master.get_orientation() not in (None, 1):
+        # The rendered derivatives are rotated, the crop boxes are not.
+        chain = False
+
+    order = sorted(range(len(contexts)),
+                   key=lambda i: plans[i] and plans[i].width * plans[i].height or 0,
+                   reverse=True)
+    rendered = []
+    results = [None] * len(contexts)
+    for i in order:
+        context = contexts[i]
+        engine = context.request.engine
+        box = _crop_box(context)
+        if context.config.RESPECT_ORIENTATION:
+            engine.reorientate()
+
+        source = None
+        if chain and plans[i] is not None:
+            scale = (float(plans[i].width) / (box[2] - box[0]),
+                     float(plans[i].height) / (box[3] - box[1]))
+            source = _find_intermediate(rendered, box, scale)
+        if source is not None:
+            # Express the crop in the coordinates of the intermediate image.
+            s_box, s_scale, engine.image = source
+            context.request.should_crop = True
+            context.request.crop = {
+                'left': int(round((box[0] - s_box[0]) * s_scale[0])),
+                'top': int(round((box[1] - s_box[1]) * s_scale[1])),
+                'right': int(round((box[2] - s_box[0]) * s_scale[0])),
+                'bottom': int(round((box[3] - s_box[1]) * s_scale[1])),
+            }
+
+        context.transformer.img_operation_worker()
+
+        width, height = engine.size
+        box_aspect = round(float(box[2] - box[0]) / (box[3] - box[1]), 2)
+        if chain and plans[i] is not None and \
+                box_aspect == round(float(width) / height, 2):
+            # The derivative shows the whole crop box and can be reused.
+            rendered.append((box, (float(width) / (box[2] - box[0]),
+                                   float(height) / (box[3] - box[1])),
+                             engine.image))
+        results[i] = encode(context)
+    return results
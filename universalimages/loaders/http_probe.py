@@ -0,0 +1,166 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import copy
+import logging
+
+import tornado.gen as gen
+import tornado.httpclient
+from thumbor.loaders import LoaderResult, http_loader
+from tornado.concurrent import return_future
+
+from .. import config  # NOQA  Defines the configuration options.
+from ..admission import image_size
+from ..filters.xmp.reader import read_rmd, limits_from_config, XmpLimitError
+from ..probe import fetch_with_probe
+from ..rmd_index import RmdDocument
+
+logger = logging.getLogger('universalimages.loaders')
+
+
+def validate(context, url):
+    return http_loader.validate(context, url)
+
+
+def use_probe(context):
+    request = getattr(context, 'request', None)
+    return bool(context.config.UNIVERSALIMAGES_PROBE_BYTES) and request is not None and \
+        'rmd(' in (request.filters or '')
+
+
+@return_future
+def load(context, url, callback):
+    """
+    HTTP loader which probes the metadata of rmd() requests.
+    Set LOADER = 'universalimages.loaders.http_probe' in thumbor.conf.
+
+    The first UNIVERSALIMAGES_PROBE_BYTES of the image are fetched with a
+    Range request. The dimensions and the RMD are read from this prefix and
+    the crop plan is computed while the rest of the image is fetched. The
+    rmd filter uses the plan once the image is decoded. Other requests and
+    servers without Range support load the image like thumbor's http_loader.
+    """
+    if not use_probe(context):
+        http_loader.load_sync(context, url, callback, http_loader._normalize_url)
+        return
+
+    def done(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error('Error probing %s: %s' % (url, e))
+            result = None
+        if result is None:
+            context.metrics.incr('universalimages.probe.fallback')
+            http_loader.load_sync(context, url, callback, http_loader._normalize_url)
+        else:
+            callback(result)
+
+    load_with_probe(context, url).add_done_callback(done)
+
+
+def create_request(context, url, headers, header_callback=None):
+    # Same options as thumbor's http_loader.
+    conf = context.config
+    user_agent = None
+    if conf.HTTP_LOADER_FORWARD_USER_AGENT:
+        user_agent = context.request_handler.request.headers.get('User-Agent')
+    return tornado.httpclient.HTTPRequest(
+        url=http_loader.encode(url),
+        headers=headers,
+        header_callback=header_callback,
+        connect_timeout=conf.HTTP_LOADER_CONNECT_TIMEOUT,
+        request_timeout=conf.HTTP_LOADER_REQUEST_TIMEOUT,
+        follow_redirects=conf.HTTP_LOADER_FOLLOW_REDIRECTS,
+        max_redirects=conf.HTTP_LOADER_MAX_REDIRECTS,
+        user_agent=user_agent or conf.HTTP_LOADER_DEFAULT_USER_AGENT,
+        proxy_host=http_loader.encode(conf.HTTP_LOADER_PROXY_HOST),
+        proxy_port=conf.HTTP_LOADER_PROXY_PORT,
+        proxy_username=http_loader.encode(conf.HTTP_LOADER_PROXY_USERNAME),
+        proxy_password=http_loader.encode(conf.HTTP_LOADER_PROXY_PASSWORD),
+        ca_certs=http_loader.encode(conf.HTTP_LOADER_CA_CERTS),
+        client_key=http_loader.encode(conf.HTTP_LOADER_CLIENT_KEY),
+        client_cert=http_loader.encode(conf.HTTP_LOADER_CLIENT_CERT)
+    )
+
+
+def probe_header(context, header):
+    """
+    Reads the dimensions and the RMD of the image header and computes the
+    crop plan of the request.
+    :return: The probe with the size, the RMD document, the crop plan
+             (None without valid RMD) and the focal point.
+    :rtype: dict
+    """
+    from ..planner import plan_request
+
+    size = image_size(header)
+    if size is None:
+        return None
+    conf = context.config
+    try:
+        document = RmdDocument(read_rmd(header, limits_from_config(conf)))
+    except XmpLimitError as e:
+        logger.warning('Ignoring the XMP metadata of %s: %s' % (context.request.url, e))
+        document = RmdDocument({})
+
+    request = copy.copy(context.request)
+    request.focal_points = list(context.request.focal_points)
+    rmd_plan = plan_request(request, document, size, conf, metrics=context.metrics) \
+        if document.xmp_keys else None
+    focal_point = None
+    if getattr(request, 'rmd_detection_bypassed', False):
+        focal_point = (request.focal_points[0].x, request.focal_points[0].y)
+    return {'size': size, 'document': document, 'plan': rmd_plan, 'focal_point': focal_point}
+
+
+@gen.coroutine
+def load_with_probe(context, url):
+    """
+    :return: The LoaderResult or None if the image has to be loaded
+             without the probe.
+    """
+    conf = context.config
+    url = http_loader._normalize_url(url)
+    if (conf.HTTP_LOADER_PROXY_HOST and conf.HTTP_LOADER_PROXY_PORT) or \
+            conf.HTTP_LOADER_CURL_ASYNC_HTTP_CLIENT:
+        tornado.httpclient.AsyncHTTPClient.configure(
+            'tornado.curl_httpclient.CurlAsyncHTTPClient')
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=conf.HTTP_LOADER_MAX_CLIENTS)
+    probes = []
+    responses = []
+
+    @gen.coroutine
+    def fetch(headers, header_callback):
+        try:
+            response = yield client.fetch(create_request(context, url, headers, header_callback))
+        except tornado.httpclient.HTTPError as e:
+            response = e.response
+        except Exception as e:
+            logger.warning('Error probing %s: %s' % (url, e))
+            response = None
+        if response is not None:
+            context.metrics.incr('original_image.status.%s' % response.code)
+        responses.append(response)
+        raise gen.Return(response)
+
+    def on_header(header):
+        probes.append(probe_header(context, header))
+        context.metrics.incr('universalimages.probe.header')
+        context.metrics.timing('universalimages.probe.header_bytes', len(header))
+
+    body, probed = yield fetch_with_probe(
+        fetch, on_header, conf.UNIVERSALIMAGES_PROBE_BYTES, conf.UNIVERSALIMAGES_PROBE_MAX_BYTES)
+    if not body:
+        response = responses[-1] if responses else None
+        if response is not None and response.code >= 400 and response.code != 416:
+            # Same errors as thumbor's http_loader.
+            logger.warning('ERROR retrieving image %s: %s' % (url, response.error))
+            raise gen.Return(LoaderResult(successful=False, error=(
+                LoaderResult.ERROR_TIMEOUT if response.code == 599
+                else LoaderResult.ERROR_NOT_FOUND)))
+        raise gen.Return(None)
+    if probed and probes[0] is not None:
+        context.request.rmd_probe = probes[0]
+        context.metrics.incr('universalimages.probe.hit')
+    raise gen.Return(LoaderResult(buffer=body))
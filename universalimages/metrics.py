@@ -0,0 +1,72 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import atexit
+import io
+import json
+import os
+import time
+from threading import Lock
+
+from thumbor.metrics import BaseMetrics
+
+_lock = Lock()
+_counters = {}
+_timings = {}  # name -> [count, total, max]
+_state = {'written': 0, 'atexit': False}
+
+
+def snapshot():
+    """
+    Returns the metrics of the process.
+    :rtype: dict
+    """
+    with _lock:
+        return {
+            'time': time.time(),
+            'pid': os.getpid(),
+            'counters': dict(_counters),
+            'timings': dict((name, {'count': count, 'total': total, 'max': maximum})
+                            for name, (count, total, maximum) in _timings.items()),
+        }
+
+
+def write(path):
+    data = json.dumps(snapshot(), sort_keys=True).encode('utf-8')
+    with io.open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+
+class Metrics(BaseMetrics):
+    """
+    Counts the metrics of the process in memory and writes them as JSON to
+    UNIVERSALIMAGES_METRICS_PATH, at most every UNIVERSALIMAGES_METRICS_INTERVAL
+    seconds and when the process exits. Used by universalimages-loadtest.
+    Set METRICS = 'universalimages.metrics' in thumbor.conf.
+    """
+
+    def __init__(self, config):
+        super(Metrics, self).__init__(config)
+        self.path = getattr(config, 'UNIVERSALIMAGES_METRICS_PATH', None)
+        self.interval = getattr(config, 'UNIVERSALIMAGES_METRICS_INTERVAL', 1)
+        if self.path and not _state['atexit']:
+            _state['atexit'] = True
+            atexit.register(write, self.path)
+
+    def incr(self, metricname, value=1):
+        with _lock:
+            _counters[metricname] = _counters.get(metricname, 0) + value
+        self._write()
+
+    def timing(self, metricname, value):
+        with _lock:
+            count, total, maximum = _timings.get(metricname, (0, 0, 0))
+            _timings[metricname] = [count + 1, total + value, max(maximum, value)]
+        self._write()
+
+    def _write(self):
+        if not self.path or time.time() - _state['written'] < self.interval:
+            return
+        _state['written'] = time.time()
+        write(self.path)
@@ -0,0 +1,222 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import hashlib
+import json
+import math
+import re
+from collections import namedtuple
+
+# The resolved result of the rmd filter for one request.
+# crop: (left, top, right, bottom) in source pixels,
+# width, height: dimensions of the final derivative.
+CropPlan = namedtuple('CropPlan', ['crop', 'should_crop', 'fit_in', 'width', 'height'])
+
+RMD_FILTER_RE = re.compile(r'(?:^|:)rmd\([^)]*\)')
+
+
+def final_dimensions(crop, width, height, fit_in=False):
+    """
+    Calculates the size of the derivative the same way the thumbor transformer
+    does after the crop has been applied.
+    :param crop: The crop box (left, top, right, bottom).
+    :param width: Requested width (int, 0 or 'orig').
+    :param height: Requested height (int, 0 or 'orig').
+    :param fit_in: True if the image is fitted into the requested box.
+    :return: (width, height)
+    :rtype: tuple (int, int)
+    """
+    box_width = float(crop[2] - crop[0])
+    box_height = float(crop[3] - crop[1])
+    if box_width <= 0 or box_height <= 0:
+        return 0, 0
+
+    if not width and not height:
+        return int(box_width), int(box_height)
+
+    if width == 'orig':
+        width = box_width
+    if height == 'orig':
+        height = box_height
+
+    if fit_in:
+        width = float(width or box_width)
+        height = float(height or box_height)
+        if width >= box_width and height >= box_height:
+            return int(box_width), int(box_height)
+        if box_width / width >= box_height / height:
+            return int(width), int(round(box_height * width / box_width))
+        return int(round(box_width * height / box_height)), int(height)
+
+    if not width:
+        width = round(float(height) * box_width / box_height)
+    if not height:
+        height = round(float(width) * box_height / box_width)
+    return int(width), int(height)
+
+
+def build_plan(request, crop, should_crop, source_size):
+    """
+    Creates the crop plan for the given thumbor request.
+    :param request: The thumbor RequestParameters
+    :param crop: dict with the keys left, top, right, bottom
+    :param should_crop: True if the image is cropped
+    :param source_size: Size of the source image (width, height)
+    :rtype: CropPlan
+    """
+    if should_crop:
+        box = (crop['left'], crop['top'], crop['right'], crop['bottom'])
+    else:
+        box = (0, 0) + tuple(source_size)
+    width, height = final_dimensions(box, request.width, request.height,
+                                     request.fit_in)
+    return CropPlan(box, bool(should_crop), bool(request.fit_in), width, height)
+
+
+def output_options(request, auto_webp=False):
+    """
+    Collects the request options which change the encoded output
+    but are not part of the crop plan.
+    :rtype: dict
+    """
+    filters = RMD_FILTER_RE.sub('', request.filters or '').strip(':')
+    return {
+        'filters': filters,
+        'format': request.format,
+        'quality': request.quality,
+        'flip': [bool(request.horizontal_flip), bool(request.vertical_flip)],
+        'align': [request.halign, request.valign],
+        # Smart requests of images with RMD focus on the pivot point.
+        'smart': bool(request.smart or getattr(request, 'rmd_detection_bypassed', False)),
+        'trim': request.trim,
+        'full': bool(request.full),
+        'adaptive': bool(request.adaptive),
+        'meta': bool(request.meta),
+        'debug': bool(request.debug),
+        'webp': bool(auto_webp and request.accepts_webp),
+    }
+
+
+def canonical_key(source, plan, options):
+    """
+    Returns the result storage key for a derivative. Requests with a different
+    URL which resolve to the same crop plan share the same key.
+    :param source: The source image url
+    :param plan: The resolved crop plan
+    :type plan: CropPlan
+    :param options: The output options
+    :type options: dict
+    :rtype: str
+    """
+    payload = json.dumps(
+        [source, list(plan.crop), plan.should_crop, plan.fit_in,
+         plan.width, plan.height, options],
+        sort_keys=True, separators=(',', ':'))
+    return 'rmd/%s' % hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def canonical_key_for(context):
+    """
+    Shorthand for the canonical key of the current request.
+    Returns None if the rmd filter did not commit a crop plan.
+    """
+    request = context.request
+    plan = getattr(request, 'rmd_plan', None)
+    if plan is None:
+        return None
+    return canonical_key(
+        request.image_url, plan,
+        output_options(request, context.config.AUTO_WEBP))
+
+
+def request_key(context):
+    """
+    Returns the key of the request URL in the alias cache.
+    WebP and non WebP responses for the same URL are different derivatives.
+    """
+    request = context.request
+    if context.config.AUTO_WEBP and request.accepts_webp:
+        return '%s|webp' % request.url
+    return request.url
+
+
+def etag(source_digest, rmd_digest, key):
+    """
+    Returns a strong ETag for the derivative.
+    :param source_digest: Digest of the source image
+    :param rmd_digest: Digest of the RMD metadata
+    :param key: The canonical key of the derivative
+    :rtype: str
+    """
+    payload = '%s:%s:%s' % (source_digest, rmd_digest, key)
+    return '"%s"' % hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Checks if the etag matches the value of an If-None-Match header.
+    """
+    if not etag or not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+def parse_ladder(values):
+    """
+    Parses a breakpoint ladder. Entries are widths or 'WIDTHxHEIGHT' strings.
+    :rtype: list of (int, int)
+    """
+    ladder = []
+    for value in values:
+        if isinstance(value, (tuple, list)):
+            width, height = value
+        elif 'x' in '%s' % value:
+            width, height = ('%s' % value).split('x')
+        else:
+            width, height = value, 0
+        ladder.append((int(width or 0), int(height or 0)))
+    return ladder
+
+
+def dump_plan(plan):
+    """
+    Serializes a crop plan to a compact list.
+    """
+    if plan is None:
+        return None
+    return list(plan.crop) + [int(plan.should_crop), int(plan.fit_in),
+                              plan.width, plan.height]
+
+
+def load_plan(values):
+    """
+    Restores a crop plan serialized with dump_plan.
+    """
+    if values is None:
+        return None
+    return CropPlan(tuple(values[:4]), bool(values[4]), bool(values[5]),
+                    values[6], values[7])
+
+
+def snap_box(box, grid, size):
+    """
+    Extends a box outwards to the next multiples of grid,
+    without exceeding the image size.
+    :param box: (left, top, right, bottom)
+    :param grid: Grid size in pixels
+    :param size: Size of the image (width, height)
+    :rtype: tuple
+    """
+    left, top, right, bottom = box
+    return (int(left) // grid * grid,
+            int(top) // grid * grid,
+            min(-(-int(math.ceil(right)) // grid) * grid, size[0]),
+            min(-(-int(math.ceil(bottom)) // grid) * grid, size[1]))
@@ -0,0 +1,83 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+from thumbor.config import Config
+from thumbor.context import Context, RequestParameters
+from thumbor.engines import BaseEngine
+from thumbor.transformer import Transformer
+
+from .filters.rmd import Filter
+
+
+class MetadataEngine(BaseEngine):
+    """
+    Engine which only knows the size and the metadata of an image.
+    It allows to compute crop plans without decoding the image.
+    """
+
+    def __init__(self, context, size, metadata):
+        super(MetadataEngine, self).__init__(context)
+        self._size = tuple(size)
+        self.metadata = metadata
+        self.source_width, self.source_height = self._size
+
+    @property
+    def size(self):
+        return self._size
+
+
+def compute_plan(metadata, size, width=0, height=0, fit_in=False,
+                 source='', config=None):
+    """
+    Runs the rmd filter for the given target size. The shared caches
+    of the server are neither read nor written.
+    :param metadata: The image metadata (pyexiv2 compatible)
+    :param size: The size of the source image (width, height)
+    :param width: Requested width (int, 0 or 'orig')
+    :param height: Requested height (int, 0 or 'orig')
+    :param source: The source image url
+    :return: The crop plan or None if the image has no valid RMD.
+    :rtype: CropPlan or None
+    """
+    request = RequestParameters(
+        width=width, height=height, fit_in=fit_in, filters='rmd()',
+        image=source, url='/unsafe/%sx%s/filters:rmd()/%s' % (width, height, source))
+    return plan_request(request, metadata, size, config, use_caches=False)
+
+
+def plan_request(request, metadata, size, config=None, source_digest=None, metrics=None,
+                 use_caches=True):
+    """
+    Runs the rmd filter for a thumbor request. The request is modified
+    the same way as by the filter of a rendered request.
+    :param request: The thumbor RequestParameters
+    :param source_digest: The digest of the source image, stored with its RMD.
+    :param metrics: The metrics of the server.
+    :param use_caches: False plans without side effects on the shared caches.
+    :return: The crop plan or None if the image has no valid RMD.
+    :rtype: CropPlan or None
+    """
+    context = Context(config=config or Config())
+    if metrics is not None:
+        context.metrics = metrics
+    context.request = request
+    engine = request.engine = MetadataEngine(context, size, metadata)
+    engine.source_digest = source_digest
+    context.transformer = Transformer(context)
+
+    Filter.pre_compile()
+    fltr = Filter('rmd()', context)
+    fltr.engine = engine
+    fltr.use_caches = use_caches
+    fltr.run()
+    return getattr(request, 'rmd_plan', None)
+
+
+def compute_plans(metadata, size, ladder, source='', config=None):
+    """
+    Computes the crop plans for a list of target sizes.
+    :param ladder: List of target sizes (width, height)
+    :return: List of crop plans in the same order as the ladder.
+    """
+    return [compute_plan(metadata, size, width, height, source=source, config=config)
+            for width, height in ladder]
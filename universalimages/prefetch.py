@@ -0,0 +1,181 @@
+# coding: utf-8
+"""
+Background prefetching of the ladder of a source. The first rmd() request
+for a source is usually followed by the requests for the other widths of
+its srcset. After a cold request, the other UNIVERSALIMAGES_LADDER sizes
+are rendered from the decoded image of the request in a worker thread and
+stored in the result storage.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import time
+
+import tornado.gen as gen
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+from .caches import get_cache
+from .plan import parse_ladder
+
+logger = logging.getLogger('universalimages.prefetch')
+
+
+class Prefetcher(object):
+    """
+    Runs prefetch jobs on a bounded pool of worker threads. A job is refused
+    if queue_size jobs are pending, or if more than rate jobs per second are
+    submitted (with bursts of up to one second). 0 disables a limit.
+    Must be used from the IOLoop thread.
+    """
+
+    def __init__(self, workers=1, queue_size=8, rate=0):
+        self.executor = ThreadPoolExecutor(workers)
+        self.queue_size = queue_size
+        self.rate = rate
+        self.pending = 0
+        self._tokens = float(max(rate, 1))
+        self._updated = time.time()
+
+    def __len__(self):
+        return self.pending
+
+    def _take_token(self):
+        if not self.rate:
+            return True
+        now = time.time()
+        self._tokens = min(max(self.rate, 1), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def submit(self, job, callback):
+        """
+        Runs job() in a worker thread, then callback(future) on the IOLoop.
+        :return: None if the job was queued, or the reason why it was
+                 refused: 'queue_full' or 'rate_limited'.
+        """
+        if self.queue_size and self.pending >= self.queue_size:
+            return 'queue_full'
+        if not self._take_token():
+            return 'rate_limited'
+        self.pending += 1
+        io_loop = IOLoop.current()
+        future = self.executor.submit(job)
+        future.add_done_callback(
+            lambda result: io_loop.add_callback(self._done, result, callback))
+        return None
+
+    def _done(self, future, callback):
+        self.pending -= 1
+        callback(future)
+
+
+_prefetcher = None
+
+
+def get_prefetcher(config):
+    """
+    Returns the process wide prefetcher, or None if prefetching is disabled.
+    :rtype: Prefetcher
+    """
+    global _prefetcher
+    if not getattr(config, 'UNIVERSALIMAGES_PREFETCH', False):
+        return None
+    if _prefetcher is None:
+        _prefetcher = Prefetcher(config.UNIVERSALIMAGES_PREFETCH_WORKERS,
+                                 config.UNIVERSALIMAGES_PREFETCH_QUEUE,
+                                 config.UNIVERSALIMAGES_PREFETCH_RATE)
+    return _prefetcher
+
+
+@gen.coroutine
+def can_prefetch(context, engine=None):
+    """
+    Returns True if the ladder of the request's source can be prefetched
+    from the engine: the request is an rmd() request, the source has not
+    been prefetched yet and the metadata of the engine is or will be read.
+    Without an engine, only the request and the source are checked.
+    """
+    request = context.request
+    if get_prefetcher(context.config) is None or not context.modules.result_storage:
+        raise gen.Return(False)
+    if 'rmd(' not in (request.filters or ''):
+        raise gen.Return(False)
+    if getattr(engine, 'deferred_plan', None) is not None:
+        # The metadata is not read for requests with a deferred plan.
+        raise gen.Return(False)
+    prefetched = yield get_cache('prefetched', context.config).get_async(request.image_url)
+    raise gen.Return(prefetched is None)
+
+
+def prefetch(context, master):
+    """
+    Queues the rendering of the other ladder sizes of the request's source.
+    :param master: A copy of the engine of the request, taken when the
+                   image was decoded (see ladder.clone_engine).
+    :return: True if the ladder was queued.
+    """
+    from .ladder import create_context, render_many
+
+    conf = context.config
+    request = context.request
+    metrics = context.metrics
+    try:
+        requested = (int(request.width or 0), int(request.height or 0))
+    except ValueError:
+        # 'orig'
+        requested = None
+    ladder = [size for size in parse_ladder(conf.UNIVERSALIMAGES_LADDER) if size != requested]
+    if not ladder:
+        return False
+
+    source = request.image_url
+    importer = context.modules.importer
+    contexts = [create_context(conf, importer, source, width, height, unsafe=request.unsafe)
+                for width, height in ladder]
+
+    def render():
+        # The rmd filter of the request may not have waited for the metadata.
+        task = getattr(master, 'metadata_task', None)
+        if master.metadata is None and task is not None:
+            master.metadata = task.future.result()
+        master.metadata_task = None
+        start = time.time()
+        buffers = render_many(master, contexts, chain=False)
+        metrics.timing('universalimages.prefetch.render', (time.time() - start) * 1000)
+        return buffers
+
+    def rendered(future):
+        try:
+            buffers = future.result()
+        except Exception as e:
+            logger.error('Could not prefetch the ladder of %s: %s' % (source, e))
+            metrics.incr('universalimages.prefetch.error')
+            return
+        store(contexts, buffers, metrics)
+
+    refused = get_prefetcher(conf).submit(render, rendered)
+    if refused is not None:
+        metrics.incr('universalimages.prefetch.%s' % refused)
+        return False
+    get_cache('prefetched', conf).set_async(source, time.time())
+    metrics.incr('universalimages.prefetch.queued')
+    return True
+
+
+@gen.coroutine
+def store(contexts, buffers, metrics):
+    """
+    Stores the prefetched derivatives in the result storage.
+    """
+    for context, buffer in zip(contexts, buffers):
+        try:
+            yield gen.maybe_future(context.modules.result_storage.put(buffer))
+        except Exception as e:
+            logger.error('Could not store the prefetched %s: %s' % (context.request.url, e))
+            metrics.incr('universalimages.prefetch.error')
+            continue
+        metrics.incr('universalimages.prefetch.stored')
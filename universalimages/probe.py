@@ -0,0 +1,169 @@
+# coding: utf-8
+"""
+Metadata probe for sources loaded over HTTP. The first request only fetches
+the leading bytes of the image with a Range request. Once the header with
+the dimensions and the XMP packet is complete, the rest of the body is
+requested and the header is handed to a callback which computes the crop
+plan while the body is still streaming.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import re
+import struct
+
+import tornado.gen as gen
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger('universalimages.loaders')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def header_length(buffer):
+    """
+    Returns the number of leading bytes which hold the dimensions and the
+    metadata of a JPEG or PNG image: the segments before the compressed
+    data of a JPEG, the chunks before the first IDAT chunk of a PNG.
+    If the buffer ends within the header, the returned length is larger
+    than the buffer and at least covers the segment or chunk which crosses
+    its end.
+    :return: The length or None if the header of the format cannot be
+             probed (e.g. WebP stores the XMP after the image data).
+    """
+    view = memoryview(buffer)
+    if view[:2] == b'\xff\xd8':
+        offset = 2
+        while True:
+            if offset + 2 > len(view):
+                return offset + 2
+            if view[offset:offset + 1] != b'\xff':
+                return None
+            marker = struct.unpack_from('B', view, offset + 1)[0]
+            if marker == 0xff:
+                # Fill byte
+                offset += 1
+            elif marker in (0xd9, 0xda):
+                # End of image or start of the compressed data.
+                return offset
+            elif marker == 0x01 or 0xd0 <= marker <= 0xd7:
+                offset += 2
+            elif offset + 4 > len(view):
+                return offset + 4
+            else:
+                offset += 2 + struct.unpack_from('>H', view, offset + 2)[0]
+    if view[:8] == PNG_SIGNATURE:
+        offset = len(PNG_SIGNATURE)
+        while True:
+            if offset + 8 > len(view):
+                return offset + 8
+            size, kind = struct.unpack_from('>I4s', view, offset)
+            if kind in (b'IDAT', b'IEND'):
+                return offset
+            offset += 12 + size
+    return None
+
+
+def content_range(response):
+    """
+    :return: (start, end, total) of a 206 response, total is None if unknown.
+    """
+    match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+    if match is None:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), int(total) if total != '*' else None
+
+
+@gen.coroutine
+def fetch_with_probe(fetch, on_header, probe_bytes=64 * 1024, max_bytes=1024 * 1024):
+    """
+    Fetches an image with Range requests. The first request fetches
+    probe_bytes. It is only extended if the header of the image crosses
+    the end of the prefix. Then the rest of the body is requested and
+    on_header is called with the header as soon as the response starts,
+    while the body is streaming.
+    The later requests carry an If-Range header, so the body is fetched
+    completely if the source changed in between.
+    :param fetch: Function which is called with the request headers and a
+                  header_callback for the tornado HTTPRequest, and returns
+                  a future of the HTTPResponse (or None).
+    :param on_header: Called with the bytes which hold the header.
+    :param max_bytes: Maximum size of the header. The rest of the body is
+                      fetched without calling on_header for larger headers.
+    :return: (body, probed) where probed is True if on_header was called
+             with a prefix of the body. The body is None if the server
+             does not answer the Range requests as expected and the image
+             has to be loaded without the probe.
+    """
+    response = yield fetch({'Range': 'bytes=0-%d' % (probe_bytes - 1)}, None)
+    if response is None:
+        raise gen.Return((None, False))
+    if response.code == 200:
+        # The server ignores Range requests.
+        raise gen.Return((response.body, False))
+    bytes_range = content_range(response) if response.code == 206 else None
+    if bytes_range is None or bytes_range[0] != 0:
+        raise gen.Return((None, False))
+    total = bytes_range[2]
+    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+    prefix = response.body
+
+    def extend(start, end=None, header_callback=None):
+        headers = {'Range': 'bytes=%d-%s' % (start, end if end is not None else '')}
+        if validator:
+            headers['If-Range'] = validator
+        return fetch(headers, header_callback)
+
+    length = header_length(prefix)
+    while length is not None and len(prefix) < length <= max_bytes and \
+            (total is None or len(prefix) < total):
+        end = max(length, len(prefix) + probe_bytes)
+        response = yield extend(len(prefix), end - 1)
+        if response is None:
+            raise gen.Return((None, False))
+        if response.code == 200:
+            # The source changed.
+            raise gen.Return((response.body, False))
+        bytes_range = content_range(response) if response.code == 206 else None
+        if bytes_range is None or bytes_range[0] != len(prefix):
+            raise gen.Return((None, False))
+        prefix += response.body
+        length = header_length(prefix)
+
+    probed = []
+
+    def probe():
+        # Called once the response of the rest of the body starts.
+        if probed:
+            return
+        probed.append(False)
+        if length is None or length > len(prefix):
+            return
+        try:
+            on_header(prefix)
+        except Exception as e:
+            logger.error('Error while probing the image header: %s' % e)
+            return
+        probed[0] = True
+
+    if total is not None and len(prefix) >= total:
+        probe()
+        raise gen.Return((prefix, probed[0]))
+
+    response = yield extend(
+        len(prefix), header_callback=lambda line: IOLoop.current().add_callback(probe))
+    probe()
+    if response is None:
+        raise gen.Return((None, False))
+    if response.code == 200:
+        raise gen.Return((response.body, False))
+    bytes_range = content_range(response) if response.code == 206 else None
+    if bytes_range is None or bytes_range[0] != len(prefix):
+        raise gen.Return((None, False))
+    body = prefix + response.body
+    if total is not None and len(body) != total:
+        raise gen.Return((None, False))
+    raise gen.Return((body, probed[0]))
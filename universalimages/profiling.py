@@ -0,0 +1,214 @@
+# coding: utf-8
+"""
+Sampling CPU profiler for rmd() requests. While a sampled request is in
+flight, a background thread records the stack of the thread which handles
+it, and of the worker threads while they run operations of the request
+(the engine thread pool and the metadata task). The stacks are aggregated
+and written in the collapsed format of flamegraph.pl (one
+'frame;frame;frame count' line per stack) to one file per interval.
+"""
+from __future__ import unicode_literals, absolute_import
+
+import io
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger('universalimages.handlers')
+
+
+def frame_label(code, prefixes=()):
+    filename = code.co_filename
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):].lstrip(os.sep)
+            break
+    return '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+
+
+def collapse(frame, prefixes=()):
+    """
+    Returns the stack of a frame as a collapsed stack, outermost frame first.
+    """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code, prefixes))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Profiler(object):
+    """
+    Samples the threads of the profiled requests every sample_interval
+    seconds and writes the aggregated stacks to path every interval seconds.
+    """
+
+    def __init__(self, path, interval=60, sample_interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self.counts = Counter()
+        self.last_flush = time.time()
+        self._files = itertools.count()
+        self._threads = {}  # thread ident -> number of profiled requests
+        self._active = threading.Event()
+        self._lock = threading.Lock()
+        self._sampler = None
+        # Longest prefixes first, so file names are relative to the package root.
+        self._prefixes = sorted((p for p in sys.path if p), key=len, reverse=True)
+
+    def start(self):
+        """
+        Profiles the current thread until stop is called.
+        :return: The token to pass to stop.
+        """
+        ident = threading.current_thread().ident
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._run, name='universalimages-profiler')
+                self._sampler.daemon = True
+                self._sampler.start()
+        self._active.set()
+        return ident
+
+    def stop(self, ident):
+        with self._lock:
+            count = self._threads.pop(ident, 0) - 1
+            if count > 0:
+                self._threads[ident] = count
+            if not self._threads:
+                self._active.clear()
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def profiled(self, fn):
+        """
+        Returns a function which runs fn and profiles the thread it runs in.
+        """
+        def run(*args, **kwargs):
+            ident = self.start()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.stop(ident)
+        return run
+
+    def sample(self):
+        """
+        Records the current stacks of the profiled threads.
+        """
+        frames = sys._current_frames()
+        with self._lock:
+            for ident in self._threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.counts[collapse(frame, self._prefixes)] += 1
+
+    def flush(self):
+        """
+        Writes the stacks sampled since the last flush.
+        :return: The path of the file or None if nothing was sampled.
+        """
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+            self.last_flush = time.time()
+        if not counts:
+            return None
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+        filename = os.path.join(self.path, 'rmd-%s-%d-%d.collapsed' % (
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(self._files)))
+        with io.open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('%s %d\n' % (stack, count))
+        os.rename(filename + '.tmp', filename)
+        return filename
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.sample_interval)
+            try:
+                self.sample()
+                if time.time() - self.last_flush >= self.interval:
+                    self.flush()
+            except Exception as e:
+                logger.error('Profiler error: %s' % e)
+
+
+class ProfiledThreadPool(object):
+    """
+    Wraps the thumbor thread pool of a profiled request. The worker threads
+    are profiled while they run the operations of the request.
+    """
+
+    def __init__(self, thread_pool, profiler):
+        self.thread_pool = thread_pool
+        self.profiler = profiler
+
+    def queue(self, operation, callback):
+        self.thread_pool.queue(self.profiler.profiled(operation), callback)
+
+    def __getattr__(self, name):
+        return getattr(self.thread_pool, name)
+
+
+_profiler = None
+
+
+def get_profiler(config):
+    """
+    Returns the process wide profiler, or None if profiling is disabled.
+    :rtype: Profiler
+    """
+    global _profiler
+    if not getattr(config, 'UNIVERSALIMAGES_PROFILE_RATE', 0):
+        return None
+    if _profiler is None:
+        _profiler = Profiler(config.UNIVERSALIMAGES_PROFILE_PATH,
+                             config.UNIVERSALIMAGES_PROFILE_INTERVAL,
+                             config.UNIVERSALIMAGES_PROFILE_SAMPLE_INTERVAL)
+    return _profiler
+
+
+def start_profile(context):
+    """
+    Starts to profile an rmd() request with the probability
+    UNIVERSALIMAGES_PROFILE_RATE.
+    :return: The token for stop_profile or None if the request is not profiled.
+    """
+    profiler = get_profiler(context.config)
+    if profiler is None or 'rmd(' not in (context.request.filters or ''):
+        return None
+    if random.random() >= context.config.UNIVERSALIMAGES_PROFILE_RATE:
+        return None
+    context.metrics.incr('universalimages.profile.sampled')
+    if getattr(context, 'thread_pool', None) is not None:
+        context.thread_pool = ProfiledThreadPool(context.thread_pool, profiler)
+    return profiler.start()
+
+
+def stop_profile(context, token):
+    if isinstance(getattr(context, 'thread_pool', None), ProfiledThreadPool):
+        context.thread_pool = context.thread_pool.thread_pool
+    get_profiler(context.config).stop(token)
+
+
+def profiled(context, fn):
+    """
+    Returns fn, profiled in the thread which runs it if the request
+    of the context is profiled.
+    """
+    thread_pool = getattr(context, 'thread_pool', None)
+    if not isinstance(thread_pool, ProfiledThreadPool):
+        return fn
+    return thread_pool.profiler.profiled(fn)
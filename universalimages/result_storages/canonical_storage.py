@@ -0,0 +1,98 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import logging
+from contextlib import contextmanager
+
+import tornado.gen as gen
+from thumbor.importer import import_class
+from thumbor.result_storages import BaseStorage, ResultStorageResult
+
+from .. import config  # NOQA  Defines the configuration options.
+from ..caches import get_cache
+from ..plan import canonical_key_for, request_key
+
+logger = logging.getLogger('universalimages.result_storages')
+
+ALIAS_PREFIX = b'universalimages-alias:'
+
+
+class Storage(BaseStorage):
+    """
+    Result storage which stores the derivatives of rmd() requests under a
+    canonical key derived from the resolved crop plan. Different URLs which
+    resolve to the same crop and output size share one stored derivative.
+
+    The request URL is stored as a small alias record which points to the
+    canonical key. The actual storage is delegated to the result storage
+    configured in UNIVERSALIMAGES_RESULT_STORAGE.
+    """
+
+    def __init__(self, context):
+        super(Storage, self).__init__(context)
+        storage_class = import_class(
+            '%s.Storage' % context.config.UNIVERSALIMAGES_RESULT_STORAGE)
+        self.storage = storage_class(context)
+        self.aliases = get_cache('aliases', context.config)
+        self.key = None
+
+    @property
+    def is_auto_webp(self):
+        return getattr(self.storage, 'is_auto_webp', False)
+
+    @contextmanager
+    def _keyed(self, key):
+        # The wrapped storage derives its path from the request url.
+        url = self.context.request.url
+        self.context.request.url = key
+        try:
+            yield
+        finally:
+            self.context.request.url = url
+
+    @gen.coroutine
+    def put(self, bytes):
+        key = canonical_key_for(self.context)
+        if key is None:
+            yield gen.maybe_future(self.storage.put(bytes))
+            return
+
+        logger.debug('[RESULT_STORAGE] %s is stored as %s' % (
+            self.context.request.url, key))
+        self.key = key
+        self.aliases.set_async(request_key(self.context), key)
+        with self._keyed(key):
+            yield gen.maybe_future(self.storage.put(bytes))
+        yield gen.maybe_future(self.storage.put(ALIAS_PREFIX + key.encode('utf-8')))
+
+    @gen.coroutine
+    def get(self):
+        key = yield self.aliases.get_async(request_key(self.context))
+        if key is None:
+            result = yield gen.maybe_future(self.storage.get())
+            key = self._alias_target(result)
+            if key is None:
+                raise gen.Return(result)
+            self.aliases.set_async(request_key(self.context), key)
+
+        self.key = key
+        with self._keyed(key):
+            result = yield gen.maybe_future(self.storage.get())
+        raise gen.Return(result)
+
+    def last_updated(self):
+        # Called on the IOLoop after get(). Without a known key, the time of
+        # the alias record is close enough.
+        key = self.key
+        if key is None:
+            return self.storage.last_updated()
+        with self._keyed(key):
+            return self.storage.last_updated()
+
+    def _alias_target(self, result):
+        if result is None:
+            return None
+        buffer = result.buffer if isinstance(result, ResultStorageResult) else result
+        if not buffer or not buffer.startswith(ALIAS_PREFIX):
+            return None
+        return buffer[len(ALIAS_PREFIX):].decode('utf-8')
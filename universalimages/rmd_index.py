@@ -0,0 +1,254 @@
+# coding: utf-8
+from __future__ import unicode_literals, absolute_import
+
+import binascii
+import hashlib
+import io
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+from .plan import CropPlan
+
+# File layout, all integers little endian:
+#   header
+#   ladder:  ladder_count * (width, height)
+#   slots:   slot_count * record number + 1, 0 for an empty slot
+#   records: record_count * fixed size record with one plan per ladder size
+#   heap:    source keys and RMD documents
+MAGIC = b'UIRMDIDX'
+VERSION = 1
+HEADER = struct.Struct('<8sIIII')
+SIZE = struct.Struct('<II')
+SLOT = struct.Struct('<I')
+# key hash, key offset, key length, document offset, document length,
+# width, height, sha1 digest of the source
+RECORD = struct.Struct('<QQIQIII20s')
+# left, top, right, bottom, width, height, flags
+PLAN = struct.Struct('<iiiiiiB')
+PLAN_VALID, PLAN_SHOULD_CROP, PLAN_FIT_IN = 1, 2, 4
+
+IndexRecord = namedtuple('IndexRecord', ['size', 'digest', 'plans', 'document'])
+XmpValue = namedtuple('XmpValue', ['value'])
+
+
+def key_hash(key):
+    return struct.unpack('<Q', hashlib.sha1(key.encode('utf-8')).digest()[:8])[0]
+
+
+def encode_document(values):
+    """
+    Encodes the RMD values of an image as NUL separated UTF-8 key value pairs.
+    :param values: dict of XMP keys and their text values
+    :rtype: bytes
+    """
+    parts = []
+    for key in sorted(values):
+        parts.append(key.encode('utf-8'))
+        parts.append(('%s' % values[key]).encode('utf-8'))
+    return b'\0'.join(parts)
+
+
+class RmdDocument(object):
+    """
+    RMD values read from the index. Provides the part of the pyexiv2
+    ImageMetadata interface the Xmp_API uses, so the rmd filter can use it
+    in place of the parsed XMP.
+    """
+
+    def __init__(self, values):
+        self._values = dict(values)
+        self.xmp_keys = sorted(self._values)
+
+    @classmethod
+    def decode(cls, buffer):
+        """
+        Creates the document from the output of encode_document.
+        """
+        parts = buffer.decode('utf-8').split('\0') if buffer else []
+        return cls(zip(parts[::2], parts[1::2]))
+
+    def __getitem__(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return XmpValue(self._values[key])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self._values)
+
+
+def write_index(path, entries, ladder):
+    """
+    Writes an index file. The file is written next to path and renamed,
+    so readers never see a partially written index.
+    :param entries: Iterable of dicts with the keys source, size, digest
+                    (hex, optional), rmd (dict, optional) and plans
+                    ({'WxH': dumped plan}, optional).
+    :param ladder: The target sizes of the plans [(width, height)]
+    :return: The number of records.
+    """
+    ladder = [tuple(size) for size in ladder]
+    records = []
+    heap = io.BytesIO()
+    seen = set()
+    for entry in entries:
+        if not entry.get('size') or entry['source'] in seen:
+            continue
+        seen.add(entry['source'])
+        key = entry['source'].encode('utf-8')
+        document = encode_document(entry.get('rmd') or {})
+        key_offset = heap.tell()
+        heap.write(key)
+        document_offset = heap.tell()
+        heap.write(document)
+
+        plans = entry.get('plans') or {}
+        packed = []
+        for width, height in ladder:
+            values = plans.get('%dx%d' % (width, height))
+            if values is None:
+                packed.append(PLAN.pack(0, 0, 0, 0, 0, 0, 0))
+            else:
+                flags = PLAN_VALID | (values[4] and PLAN_SHOULD_CROP) | \
+                    (values[5] and PLAN_FIT_IN)
+                packed.append(PLAN.pack(*(list(values[:4]) + values[6:8] + [flags])))
+        digest = binascii.unhexlify(entry.get('digest') or '') or b'\0' * 20
+        records.append((key_hash(entry['source']), RECORD.pack(
+            key_hash(entry['source']), key_offset, len(key), document_offset,
+            len(document), entry['size'][0], entry['size'][1], digest) + b''.join(packed)))
+
+    slot_count = 1
+    while slot_count < 2 * len(records):
+        slot_count *= 2
+    slots = [0] * slot_count
+    for number, (hashed, _) in enumerate(records):
+        slot = hashed & (slot_count - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = number + 1
+
+    record_size = RECORD.size + PLAN.size * len(ladder)
+    heap_offset = (HEADER.size + SIZE.size * len(ladder) + SLOT.size * slot_count +
+                   record_size * len(records))
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with io.open(tmp_path, 'wb') as index:
+        index.write(HEADER.pack(MAGIC, VERSION, len(ladder), slot_count, len(records)))
+        for size in ladder:
+            index.write(SIZE.pack(*size))
+        index.write(struct.pack('<%dI' % slot_count, *slots))
+        for _, record in records:
+            # Offsets in the heap are relative, make them absolute.
+            fields = list(RECORD.unpack_from(record))
+            fields[1] += heap_offset
+            fields[3] += heap_offset
+            index.write(RECORD.pack(*fields) + record[RECORD.size:])
+        index.write(heap.getvalue())
+        index.flush()
+        os.fsync(index.fileno())
+    os.rename(tmp_path, path)
+    return len(records)
+
+
+class RmdIndex(object):
+    """
+    Read only, memory mapped index of source key -> RMD document and
+    precomputed crop plans, built by universalimages-index. All processes
+    of a host share the pages of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, 'rb') as index:
+            self.stat = os.fstat(index.fileno())
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ladder_count, self.slot_count, self.record_count = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError('%s is not an RMD index' % path)
+        offset = HEADER.size
+        self.ladder = [SIZE.unpack_from(self._map, offset + i * SIZE.size)
+                       for i in range(ladder_count)]
+        self._slots = offset + SIZE.size * ladder_count
+        self._records = self._slots + SLOT.size * self.slot_count
+        self.record_size = RECORD.size + PLAN.size * ladder_count
+
+    def lookup(self, source):
+        """
+        Returns the record of the source key or None.
+        :rtype: IndexRecord
+        """
+        if not self.slot_count:
+            return None
+        hashed = key_hash(source)
+        key = source.encode('utf-8')
+        slot = hashed & (self.slot_count - 1)
+        while True:
+            number = SLOT.unpack_from(self._map, self._slots + slot * SLOT.size)[0]
+            if not number:
+                return None
+            offset = self._records + (number - 1) * self.record_size
+            fields = RECORD.unpack_from(self._map, offset)
+            if fields[0] == hashed and \
+                    self._map[fields[1]:fields[1] + fields[2]] == key:
+                return self._read_record(offset, fields)
+            slot = (slot + 1) & (self.slot_count - 1)
+
+    def _read_record(self, offset, fields):
+        _, _, _, document_offset, document_length, width, height, digest = fields
+        plans = {}
+        offset += RECORD.size
+        for target in self.ladder:
+            values = PLAN.unpack_from(self._map, offset)
+            offset += PLAN.size
+            if values[6] & PLAN_VALID:
+                plans[target] = CropPlan(
+                    values[:4], bool(values[6] & PLAN_SHOULD_CROP),
+                    bool(values[6] & PLAN_FIT_IN), values[4], values[5])
+        digest = '' if digest == b'\0' * 20 else binascii.hexlify(digest).decode('ascii')
+        document = RmdDocument.decode(
+            self._map[document_offset:document_offset + document_length])
+        return IndexRecord((width, height), digest, plans, document)
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self.record_count
+
+
+_index = {}
+
+
+def get_rmd_index(config):
+    """
+    Returns the index configured in UNIVERSALIMAGES_RMD_INDEX or None.
+    The file is checked for a replacement at most every
+    UNIVERSALIMAGES_RMD_INDEX_CHECK_INTERVAL seconds.
+    :rtype: RmdIndex
+    """
+    path = getattr(config, 'UNIVERSALIMAGES_RMD_INDEX', None)
+    if not path:
+        return None
+    index, checked = _index.get(path, (None, 0))
+    now = time.time()
+    if now - checked < config.UNIVERSALIMAGES_RMD_INDEX_CHECK_INTERVAL:
+        return index
+    try:
+        stat = os.stat(path)
+        if index is None or (stat.st_ino, stat.st_mtime) != \
+                (index.stat.st_ino, index.stat.st_mtime):
+            # Readers of the old index keep their mapping until it is collected.
+            index = RmdIndex(path)
+    except (OSError, IOError, ValueError):
+        index = None
+    _index[path] = (index, now)
+    return index